@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+from genomeqaml import cache, extract_features, instrument, minhash, orfscan
+from benchmarks import synthetic
+from benchmarks.run_benchmarks import DATA_DIR, stub_tools
+import argparse
+import shutil
+import json
+import time
+import sys
+import os
+__author__ = 'adamkoziol', 'andrewlow'
+
+# Compare the ORF size range features found by orfscan with those predicted by prodigal, sample by sample, to judge
+# whether the scan is close enough for a quick triage of a collection. prodigal must be on the PATH, unless --stub is
+# given, in which case the reference is the genes planted in the synthetic genomes, and is reported as the stub rather
+# than as prodigal
+
+# GC fractions of the synthetic genomes with planted genes, which cover low, average, and high GC genera
+DEFAULT_GC = [0.35, 0.5, 0.65]
+# Shortest ORFs counted by each scan of the sweep, which compares them with the reference alongside orfscan.MIN_LENGTH
+DEFAULT_MIN_LENGTHS = [90, 120, 150, 180, 210, 240, 300]
+TEST_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests', 'test_fastas')
+
+
+def reference_sets(work_dir, num_genomes=10, genome_size=200000, num_contigs=20, gc_values=None, seed=0,
+                   benchmark=True):
+    """
+    Collect the genomes to compare on: the genomes of the tests, the random genomes of the benchmarks, and synthetic
+    genomes with planted genes at each GC fraction. The genomes of the tests are all too short for prodigal, so they
+    check that both methods report no ORFs for them
+    :param work_dir: directory to generate the synthetic genomes in. Generated genomes are reused
+    :param num_genomes: number of synthetic genomes of each set
+    :param genome_size: typical length of the synthetic genomes with planted genes
+    :param num_contigs: typical number of contigs of the synthetic genomes with planted genes
+    :param gc_values: list of the GC fractions of the synthetic genomes with planted genes
+    :param seed: seed of the synthetic genomes
+    :param benchmark: boolean to determine whether the benchmark genomes are included. These have no genes, so the
+    stand-in prodigal's ORFs at fixed intervals are no reference for them
+    :return: dictionary of set name: dictionary of strain name: /sequencepath/strain_name.extension
+    """
+    sets = {'tests': extract_features.filer(extract_features.find_files(TEST_FOLDER))}
+    genome_dir = os.path.join(work_dir, 'orf_accuracy')
+    if benchmark:
+        # The same genomes as the default run of the benchmarks, which have no genes
+        genomes = synthetic.generate_folder(os.path.join(genome_dir, 'benchmark'), num_genomes, seed=seed)
+        sets['benchmark'] = {name: fasta for name, (fasta, _, _) in genomes.items()}
+    for gc in gc_values or DEFAULT_GC:
+        genomes = synthetic.generate_folder(os.path.join(genome_dir, 'coding_gc{}'.format(gc)), num_genomes,
+                                            genome_size=genome_size, num_contigs=num_contigs, gc=gc, seed=seed,
+                                            coding=True)
+        sets['coding_gc{}'.format(gc)] = {name: fasta for name, (fasta, _, _) in genomes.items()}
+    return sets
+
+
+def compare_sample(fasta, reference='prodigal', min_lengths=None):
+    """
+    :param fasta: /sequencepath/strain_name.extension
+    :param reference: name of the reference that sample_orfs runs: 'prodigal', or 'stub' for the stand-in prodigal
+    :param min_lengths: optional list of the shortest ORFs counted by each scan of the sweep
+    :return: dictionary of the ORF size range frequencies from the reference and from orfscan, the time each took, and
+    the ORF size range frequencies of each scan of the sweep, as minimum length: frequencies
+    """
+    start = time.perf_counter()
+    predicted = extract_features.sample_orfs(fasta)
+    reference_time = time.perf_counter() - start
+    contig_lengths, _ = extract_features.sample_stats(fasta)
+    # As in extract_samples, samples that are too short for prodigal have no ORFs
+    too_short = sum(contig_lengths) < extract_features.PRODIGAL_MIN_LENGTH
+    start = time.perf_counter()
+    scan = orfscan.sample_orfs(fasta) if not too_short else (0, 0, 0, 0, 0)
+    scan_time = time.perf_counter() - start
+    sweep = dict()
+    for min_length in min_lengths or list():
+        sweep[str(min_length)] = list(orfscan.orf_distribution(minhash.fasta_sequences(fasta), min_length=min_length)
+                                      if not too_short else (0, 0, 0, 0, 0))
+    return {reference: list(predicted), 'orfscan': list(scan), reference + '_time': reference_time,
+            'orfscan_time': scan_time, 'sweep': sweep}
+
+
+def summarise(comparisons, reference='prodigal'):
+    """
+    :param comparisons: list of dictionaries returned by compare_sample
+    :param reference: name of the reference of the comparisons
+    :return: dictionary of the number of samples, the total of each ORF column from the reference and from orfscan, the
+    mean absolute error of each column, its mean relative error (over the samples in which the reference found any ORFs
+    of the column), the total time of each method, and the error of each scan of the sweep, as minimum length: mean
+    over the samples of the absolute errors of all the columns added together
+    """
+    summary = {'samples': len(comparisons),
+               reference + '_time': sum(comparison[reference + '_time'] for comparison in comparisons),
+               'orfscan_time': sum(comparison['orfscan_time'] for comparison in comparisons),
+               'columns': dict(),
+               'sweep': dict()}
+    for i, column in enumerate(extract_features.ORF_COLUMNS):
+        pairs = [(comparison[reference][i], comparison['orfscan'][i]) for comparison in comparisons]
+        relative = [abs(scan - predicted) / predicted for predicted, scan in pairs if predicted]
+        summary['columns'][column] = {
+            reference: sum(predicted for predicted, _ in pairs),
+            'orfscan': sum(scan for _, scan in pairs),
+            'mean_absolute_error': sum(abs(scan - predicted) for predicted, scan in pairs) / len(pairs) if pairs else 0,
+            'mean_relative_error': sum(relative) / len(relative) if relative else None}
+    for min_length in comparisons[0]['sweep'] if comparisons else list():
+        errors = [sum(abs(scan - predicted) for predicted, scan in zip(comparison[reference],
+                                                                      comparison['sweep'][min_length]))
+                  for comparison in comparisons]
+        summary['sweep'][min_length] = sum(errors) / len(errors)
+    return summary
+
+
+def summary_table(name, summary, reference='prodigal'):
+    """
+    :param name: name of the set of genomes
+    :param summary: dictionary returned by summarise
+    :param reference: name of the reference of the summary
+    :return: the summary as a table of text
+    """
+    reference_time = summary[reference + '_time']
+    speedup = reference_time / summary['orfscan_time'] if summary['orfscan_time'] else float('inf')
+    lines = ['{}: {} samples, {} {:.2f} s, orfscan {:.2f} s ({:.0f}x faster)'.format(
+        name, summary['samples'], reference, reference_time, summary['orfscan_time'], speedup),
+        '{:<12}{:>12}{:>12}{:>16}{:>16}'.format('column', reference, 'orfscan', 'mean abs err', 'mean rel err')]
+    for column, result in summary['columns'].items():
+        relative = '{:.1%}'.format(result['mean_relative_error']) if result['mean_relative_error'] is not None else '-'
+        lines.append('{:<12}{:>12}{:>12}{:>16.1f}{:>16}'.format(column, result[reference], result['orfscan'],
+                                                                result['mean_absolute_error'], relative))
+    if summary['sweep']:
+        lines.append('sum of mean abs err by minimum ORF length: ' + ', '.join(
+            '{}: {:.1f}'.format(min_length, error) for min_length, error in summary['sweep'].items()))
+    return '\n'.join(lines)
+
+
+def run_accuracy(sets, reference='prodigal', min_lengths=None):
+    """
+    :param sets: dictionary of set name: dictionary of strain name: /sequencepath/strain_name.extension
+    :param reference: name of the reference that sample_orfs runs: 'prodigal', or 'stub' for the stand-in prodigal
+    :param min_lengths: optional list of the shortest ORFs counted by each scan of the sweep
+    :return: dictionary of the reference, its version, and of set name: dictionary of the summary of the set, and the
+    comparison of each sample
+    """
+    report = {'reference': reference,
+              'prodigal_version': cache.prodigal_version() if reference == 'prodigal' else None,
+              'sets': dict()}
+    for name, file_dict in sets.items():
+        comparisons = {file_name: compare_sample(fasta, reference, min_lengths)
+                       for file_name, fasta in sorted(file_dict.items())}
+        report['sets'][name] = {'summary': summarise(list(comparisons.values()), reference), 'samples': comparisons}
+        print(summary_table(name, report['sets'][name]['summary'], reference) + '\n')
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report how closely the ORF size range features found by the '
+                                                 'in-process orfscan match those of prodigal.')
+    parser.add_argument('-s', '--sequencepath',
+                        nargs='+',
+                        default=None,
+                        help='Folders of FASTA files to compare on, e.g. real assemblies. Defaults to the genomes of '
+                             'the tests, the benchmark genomes (unless --stub is given), and synthetic genomes with '
+                             'planted genes.')
+    parser.add_argument('-n', '--num_genomes',
+                        type=int,
+                        default=10,
+                        help='Number of synthetic genomes of each set. Default is 10.')
+    parser.add_argument('--genome_size',
+                        type=int,
+                        default=200000,
+                        help='Typical length of the synthetic genomes with planted genes. Default is 200000.')
+    parser.add_argument('--num_contigs',
+                        type=int,
+                        default=20,
+                        help='Typical number of contigs of the synthetic genomes with planted genes. Default is 20.')
+    parser.add_argument('--gc',
+                        type=float,
+                        nargs='+',
+                        default=DEFAULT_GC,
+                        help='GC fractions of the synthetic genomes with planted genes. Default is {}.'.format(
+                            ' '.join(str(gc) for gc in DEFAULT_GC)))
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='Seed of the synthetic genomes. Default is 0.')
+    parser.add_argument('--min_lengths',
+                        type=int,
+                        nargs='*',
+                        default=DEFAULT_MIN_LENGTHS,
+                        help='Shortest ORFs counted by each scan of a sweep, which reports how closely the scan '
+                             'matches the reference at each minimum length. Default is {}. Pass no lengths to skip '
+                             'the sweep.'.format(' '.join(str(length) for length in DEFAULT_MIN_LENGTHS)))
+    parser.add_argument('--stub',
+                        action='store_true',
+                        help='Compare with the stand-in prodigal of the benchmarks, which reports the genes planted in '
+                             'the synthetic genomes, rather than with prodigal. The reference is reported as the stub, '
+                             'and its times are not those of prodigal.')
+    parser.add_argument('-w', '--work_dir',
+                        default=DATA_DIR,
+                        help='Directory to generate the genomes in, which are reused between runs. Default is '
+                             'benchmarks/data.')
+    parser.add_argument('-o', '--output',
+                        default=None,
+                        help='JSON file to save the comparison of every sample to.')
+    args = parser.parse_args()
+    if args.sequencepath:
+        sets = {sequencepath: extract_features.filer(extract_features.find_files(sequencepath))
+                for sequencepath in args.sequencepath}
+    else:
+        sets = reference_sets(args.work_dir, num_genomes=args.num_genomes, genome_size=args.genome_size,
+                              num_contigs=args.num_contigs, gc_values=args.gc, seed=args.seed, benchmark=not args.stub)
+    with stub_tools() if args.stub else instrument.null_context():
+        if shutil.which('prodigal') is None:
+            sys.exit('prodigal is not on the PATH. Install it, or pass --stub to compare with the planted genes')
+        accuracy = run_accuracy(sets, reference='stub' if args.stub else 'prodigal',
+                                min_lengths=args.min_lengths)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(accuracy, output, indent=2, sort_keys=True)
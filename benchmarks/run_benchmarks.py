@@ -0,0 +1,491 @@
+#!/usr/bin/env python3
+from genomeqaml import cache, classify, extract_features, forest, orfscan, resources
+from benchmarks import synthetic
+from contextlib import contextmanager
+import subprocess
+import pickle
+import platform
+import argparse
+import shutil
+import json
+import time
+import sys
+import os
+__author__ = 'adamkoziol', 'andrewlow'
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARK_DIR)
+# Stand-in mash and prodigal executables
+STUB_DIR = os.path.join(BENCHMARK_DIR, 'stubs')
+# Default locations of the generated genomes, and of the saved results
+DATA_DIR = os.path.join(BENCHMARK_DIR, 'data')
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, 'results')
+# Version of the layout of the results files
+RESULTS_VERSION = 1
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+# Number of synthetic samples the benchmark model is trained on
+TRAINING_SAMPLES = 300
+# Default largest number of genomes to run the whole extraction on. Every sample starts two processes, so larger
+# folders take a long time even with the stand-in tools
+EXTRACT_LIMIT = 1000
+# Parameters of the genomes, which must match for two runs to be comparable
+GENOME_PARAMETERS = ['genome_size', 'num_contigs', 'gc', 'seed']
+# Default limit, in seconds, on the time from starting the interpreter to writing the first prediction of classify.py
+# with a model exported to NumPy arrays. Loading pandas or scikit-learn on this path on its own exceeds it
+STARTUP_BUDGET = 0.6
+
+
+class Corpus(object):
+    """
+    Synthetic genomes of one size of a benchmark, and the features of each genome that are known from generating it,
+    from which the inputs of the stages that do not read FASTA files are built
+    """
+
+    def __init__(self, folder, genomes):
+        """
+        :param folder: folder of the FASTA files
+        :param genomes: dictionary returned by synthetic.generate_folder
+        """
+        self.folder = folder
+        self.files = {name: fasta for name, (fasta, _, _) in genomes.items()}
+        # Contig lengths are reverse-sorted, as returned by fasta_stats
+        self.contig_lengths = {name: sorted(lengths, reverse=True) for name, (_, lengths, _) in genomes.items()}
+        self.file_order_lengths = {name: lengths for name, (_, lengths, _) in genomes.items()}
+        # GC% the genomes were generated with, which is close to, but not exactly, that of their sequence
+        self.gc = {name: round(gc * 100, 2) for name, (_, _, gc) in genomes.items()}
+        self.genera = {name: synthetic.GENERA[i % len(synthetic.GENERA)] for i, name in enumerate(sorted(genomes))}
+
+    def rows(self):
+        """
+        :return: list of the report rows of the genomes
+        """
+        return [extract_features.feature_row(name, self.contig_lengths[name], self.gc[name],
+                                             extract_features.orf_distribution(
+                                                 synthetic.sco_lines(self.file_order_lengths[name])),
+                                             self.genera[name])
+                for name in sorted(self.files)]
+
+
+def stage_fasta_stats(corpus, work_dir):
+    return None, lambda: extract_features.fasta_stats(corpus.files)
+
+
+def stage_nx_lx(corpus, work_dir):
+    def nx_lx():
+        # Each of the functions, called separately as they are by existing scripts
+        for function in (extract_features.find_n50, extract_features.find_n75, extract_features.find_n90,
+                         extract_features.find_l50, extract_features.find_l75, extract_features.find_l90):
+            function(corpus.contig_lengths)
+    return None, nx_lx
+
+
+def stage_contig_metrics(corpus, work_dir):
+    return None, lambda: extract_features.find_contig_metrics(corpus.contig_lengths)
+
+
+def stage_find_orf_distribution(corpus, work_dir):
+    sco_dir = os.path.join(work_dir, 'sco')
+    orf_file_dict = {name: os.path.join(sco_dir, name + '.sco') for name in corpus.files}
+
+    def prepare():
+        # find_orf_distribution deletes the reports it parses, so they are written again before each run
+        os.makedirs(sco_dir, exist_ok=True)
+        for name, sco_file in orf_file_dict.items():
+            synthetic.write_sco(sco_file, corpus.file_order_lengths[name])
+    return prepare, lambda: extract_features.find_orf_distribution(orf_file_dict)
+
+
+def stage_orfscan(corpus, work_dir):
+    # The in-process alternative to prodigal, which unlike the stand-in prodigal measures the work of finding the ORFs
+    return None, lambda: [orfscan.sample_orfs(fasta) for fasta in corpus.files.values()]
+
+
+def stage_reporter(corpus, work_dir):
+    report_dir = os.path.join(work_dir, 'reporter')
+    os.makedirs(report_dir, exist_ok=True)
+    dicts = extract_features.rows_to_dicts(corpus.rows())
+    return None, lambda: extract_features.reporter(*dicts, genus_dict=corpus.genera, sequencepath=report_dir)
+
+
+def stage_classify_data(corpus, work_dir):
+    model, schema = benchmark_model(work_dir)
+    test_folder = os.path.join(work_dir, 'classify')
+    os.makedirs(test_folder, exist_ok=True)
+    extract_features.write_report(corpus.rows(), test_folder)
+    report_file = os.path.join(work_dir, 'QAMLreport.csv')
+
+    def prepare():
+        # classify_data appends to the report
+        if os.path.isfile(report_file):
+            os.remove(report_file)
+    return prepare, lambda: classify.classify_data(model, test_folder, None, report_file, schema=schema)
+
+
+def stage_extract(corpus, work_dir):
+    # The whole extraction of the folder, with the stand-in tools, which measures the overhead of the scheduling and
+    # the external processes rather than the tools themselves
+    refseq_database = os.path.join(work_dir, 'refseq.msh')
+    open(refseq_database, 'w').close()
+    return None, lambda: extract_features.main(corpus.folder, report=False, refseq_database=refseq_database,
+                                               num_threads=resources.available_cpus())
+
+
+def stage_extract_batch(corpus, work_dir):
+    # As stage_extract, with the genera found by a single mash dist for each batch of samples
+    refseq_database = os.path.join(work_dir, 'refseq.msh')
+    open(refseq_database, 'w').close()
+    return None, lambda: extract_features.main(corpus.folder, report=False, refseq_database=refseq_database,
+                                               num_threads=resources.available_cpus(), genus_method='batch')
+
+
+# Stages of the benchmark, in the order they are run. Each is a function of the corpus and a scratch directory that
+# returns an optional function to call before each timed run (e.g. to restore files the stage consumes), and the
+# function to time
+STAGES = {'fasta_stats': stage_fasta_stats,
+          'nx_lx': stage_nx_lx,
+          'contig_metrics': stage_contig_metrics,
+          'find_orf_distribution': stage_find_orf_distribution,
+          'orfscan': stage_orfscan,
+          'reporter': stage_reporter,
+          'classify_data': stage_classify_data,
+          'extract': stage_extract,
+          'extract_batch': stage_extract_batch}
+
+
+def benchmark_model(work_dir):
+    """
+    Train a small model on synthetic features, so that classification can be benchmarked without the bundled model
+    :param work_dir: scratch directory
+    :return: model, schema: fitted ExtraTreesClassifier, and its feature schema
+    """
+    import pandas as pd
+    from sklearn.ensemble import ExtraTreesClassifier
+    # Only the features of the genomes are needed, so their sequences are not generated
+    genomes = dict()
+    for index in range(TRAINING_SAMPLES):
+        name, contig_lengths, gc, _ = synthetic.genome_plan(index, 5000, 5, 0.5, seed='training', spread=0.9)
+        genomes[name] = None, contig_lengths, gc
+    dataframe = pd.DataFrame(Corpus(None, genomes).rows(), columns=extract_features.FEATURE_COLUMNS)
+    dataframe['PassFail'] = [i % 3 for i in range(len(dataframe))]
+    dataframe = dataframe.drop('SampleName', axis=1)
+    schema = classify.build_schema(dataframe)
+    features = pd.get_dummies(dataframe, columns=['Genus'], dummy_na=True).reindex(columns=schema['features'])
+    model = ExtraTreesClassifier(n_estimators=100, random_state=0)
+    model.fit(features, dataframe['PassFail'])
+    return model, schema
+
+
+def startup_commands(work_dir):
+    """
+    Prepare a folder of a single synthetic genome that already has a feature report, as classified by a LIMS one
+    sample at a time, and a model exported to NumPy arrays with its schema
+    :param work_dir: scratch directory
+    :return: dictionary of stage name: command line that is timed from the start of the interpreter
+    """
+    model, schema = benchmark_model(work_dir)
+    model_file = os.path.join(work_dir, 'model.p')
+    with open(model_file, 'wb') as model_pickle:
+        pickle.dump(model, model_pickle)
+    schema['model_digest'] = cache.file_digest(model_file)
+    schema_file = os.path.join(work_dir, 'schema.json')
+    classify.write_schema(schema, schema_file)
+    forest_file = os.path.join(work_dir, 'model.npz')
+    forest.export_forest(model, forest_file, model_digest=schema['model_digest'])
+    folder = os.path.join(work_dir, 'sample')
+    extract_features.write_report(Corpus(folder, synthetic.generate_folder(folder, 1)).rows(), folder)
+    classify_script = os.path.join(ROOT_DIR, 'genomeqaml', 'classify.py')
+    return {'startup_interpreter': [sys.executable, '-c', 'pass'],
+            'startup_help': [sys.executable, classify_script, '--help'],
+            'startup_classify': [sys.executable, classify_script, '-t', folder,
+                                 '-r', os.path.join(work_dir, 'QAMLreport.csv'),
+                                 '-m', forest_file,
+                                 '--schema_file', schema_file]}
+
+
+def run_startup(work_dir, repeat=3):
+    """
+    Time classify.py from the start of a new interpreter: printing its help, and classifying a single sample. The
+    interpreter on its own is timed for reference
+    :param work_dir: directory to run the commands in
+    :param repeat: number of times to run each command
+    :return: list of results, as returned by run_benchmarks
+    """
+    scratch = os.path.join(work_dir, 'startup')
+    shutil.rmtree(scratch, ignore_errors=True)
+    os.makedirs(scratch)
+    environ = dict(os.environ)
+    environ['PYTHONPATH'] = os.pathsep.join(path for path in (ROOT_DIR, environ.get('PYTHONPATH')) if path)
+    results = list()
+    for stage, command in startup_commands(scratch).items():
+        def run():
+            subprocess.run(command, stdout=subprocess.DEVNULL, env=environ, check=True)
+        times = sorted(time_stage(None, run, repeat))
+        results.append({'stage': stage, 'genomes': 1, 'best': times[0], 'median': times[len(times) // 2],
+                        'per_genome': times[0]})
+        print('{:<24}{:>8}{:>12.4f}{:>12.4f}{:>16.2f}'.format(stage, 1, times[0], times[len(times) // 2],
+                                                               times[0] * 1e6))
+    shutil.rmtree(scratch, ignore_errors=True)
+    return results
+
+
+@contextmanager
+def stub_tools():
+    """
+    Context manager that puts the stand-in mash and prodigal first on the PATH
+    """
+    path = os.environ.get('PATH', '')
+    os.environ['PATH'] = STUB_DIR + os.pathsep + path
+    try:
+        yield
+    finally:
+        os.environ['PATH'] = path
+
+
+@contextmanager
+def quiet():
+    """
+    Context manager that discards the progress messages printed by the stages
+    """
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+
+def time_stage(prepare, function, repeat):
+    """
+    :param prepare: optional function to call before each run, which is not timed
+    :param function: function to time
+    :param repeat: number of runs
+    :return: list of the wall time of each run, in seconds
+    """
+    times = list()
+    for _ in range(repeat):
+        if prepare is not None:
+            prepare()
+        with quiet():
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def run_benchmarks(sizes, stages, work_dir, repeat=3, genome_size=20000, num_contigs=10, gc=0.5, seed=0,
+                   extract_limit=EXTRACT_LIMIT):
+    """
+    Run each stage on folders of synthetic genomes of each size
+    :param sizes: list of numbers of genomes
+    :param stages: list of names of stages, from STAGES
+    :param work_dir: directory to generate the genomes and run the stages in. Generated genomes are reused
+    :param repeat: number of times to run each stage on each size
+    :param genome_size: typical total length of the genomes
+    :param num_contigs: typical number of contigs of the genomes
+    :param gc: typical fraction of G and C bases
+    :param seed: seed of the genomes
+    :param extract_limit: largest number of genomes to run the extract stages on
+    :return: list of dictionaries of the stage, number of genomes, best and median time, and time per genome of each
+    """
+    results = list()
+    genome_dir = os.path.join(work_dir, 'genomes', 'size{}_contigs{}_gc{}_seed{}'.format(genome_size, num_contigs, gc,
+                                                                                         seed))
+    with stub_tools():
+        for size in sizes:
+            folder = os.path.join(genome_dir, str(size))
+            corpus = Corpus(folder, synthetic.generate_folder(folder, size, genome_size, num_contigs, gc, seed))
+            for stage in stages:
+                if stage in ('extract', 'extract_batch') and size > extract_limit:
+                    continue
+                scratch = os.path.join(work_dir, 'scratch')
+                shutil.rmtree(scratch, ignore_errors=True)
+                os.makedirs(scratch)
+                prepare, function = STAGES[stage](corpus, scratch)
+                times = sorted(time_stage(prepare, function, repeat))
+                result = {'stage': stage,
+                          'genomes': size,
+                          'best': times[0],
+                          'median': times[len(times) // 2],
+                          'per_genome': times[0] / size}
+                print('{:<24}{:>8}{:>12.4f}{:>12.4f}{:>16.2f}'.format(stage, size, result['best'], result['median'],
+                                                                       result['per_genome'] * 1e6))
+                results.append(result)
+                shutil.rmtree(scratch, ignore_errors=True)
+    return results
+
+
+def environment():
+    """
+    :return: dictionary describing the code and machine the benchmarks were run on
+    """
+    import numpy
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARK_DIR,
+                                           stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+        dirty = bool(subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                             cwd=BENCHMARK_DIR, stderr=subprocess.DEVNULL, universal_newlines=True))
+    except (OSError, subprocess.CalledProcessError):
+        revision, dirty = None, None
+    return {'revision': revision,
+            'dirty': dirty,
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpus': resources.available_cpus()}
+
+
+def save_results(results, parameters, results_file, label):
+    """
+    :param results: list of results from run_benchmarks
+    :param parameters: dictionary of the parameters of the run
+    :param results_file: path of the JSON file to write
+    :param label: name of the run e.g. a version or revision
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(results_file)), exist_ok=True)
+    with open(results_file, 'w') as output:
+        json.dump({'results_version': RESULTS_VERSION,
+                   'label': label,
+                   'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'environment': environment(),
+                   'parameters': parameters,
+                   'results': results}, output, indent=2)
+        output.write('\n')
+
+
+def load_results(results_file):
+    """
+    :param results_file: path of a JSON file written by save_results
+    :return: dictionary of the saved run
+    """
+    with open(results_file) as results_json:
+        saved = json.load(results_json)
+    if saved.get('results_version', 0) > RESULTS_VERSION:
+        raise ValueError('{} was written by a newer version of the benchmarks'.format(results_file))
+    return saved
+
+
+def compare(results, baseline, tolerance=0.25):
+    """
+    Compare the best times of a run to those of a baseline run, for each stage and size they have in common
+    :param results: list of results from run_benchmarks
+    :param baseline: list of results of the baseline run
+    :param tolerance: fraction by which a stage may be slower than the baseline before it is a regression
+    :return: lines, regressions: lines of a table of the comparison, and list of the (stage, genomes) that regressed
+    """
+    baseline_times = {(result['stage'], result['genomes']): result['best'] for result in baseline}
+    lines = ['{:<24}{:>8}{:>12}{:>12}{:>10}'.format('stage', 'genomes', 'baseline', 'current', 'ratio')]
+    regressions = list()
+    for result in results:
+        key = result['stage'], result['genomes']
+        if key not in baseline_times:
+            continue
+        ratio = result['best'] / baseline_times[key] if baseline_times[key] else float('inf')
+        regressed = ratio > 1 + tolerance
+        if regressed:
+            regressions.append(key)
+        lines.append('{:<24}{:>8}{:>12.4f}{:>12.4f}{:>10.2f}{}'.format(result['stage'], result['genomes'],
+                                                                       baseline_times[key], result['best'], ratio,
+                                                                       '  slower' if regressed else ''))
+    return lines, regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time each stage of GenomeQAML on folders of synthetic genomes of '
+                                                 'increasing size, with stand-in mash and prodigal executables.')
+    parser.add_argument('-s', '--sizes',
+                        type=int,
+                        nargs='+',
+                        default=DEFAULT_SIZES,
+                        help='Numbers of genomes to run each stage on. Default is {}.'.format(
+                            ' '.join(str(size) for size in DEFAULT_SIZES)))
+    parser.add_argument('--stages',
+                        nargs='+',
+                        choices=list(STAGES) + ['startup'],
+                        default=list(STAGES) + ['startup'],
+                        help='Stages to run. Default is all of them. startup times classify.py from the start of the '
+                             'interpreter, once rather than for each size.')
+    parser.add_argument('-n', '--repeat',
+                        type=int,
+                        default=3,
+                        help='Number of times to run each stage on each size. The best time is compared between '
+                             'runs. Default is 3.')
+    parser.add_argument('--genome_size',
+                        type=int,
+                        default=20000,
+                        help='Typical length of the synthetic genomes. Default is 20000.')
+    parser.add_argument('--num_contigs',
+                        type=int,
+                        default=10,
+                        help='Typical number of contigs of the synthetic genomes. Default is 10.')
+    parser.add_argument('--gc',
+                        type=float,
+                        default=0.5,
+                        help='Typical GC fraction of the synthetic genomes. Default is 0.5.')
+    parser.add_argument('--extract_limit',
+                        type=int,
+                        default=EXTRACT_LIMIT,
+                        help='Largest number of genomes to run the whole extraction on. Default is {}.'.format(
+                            EXTRACT_LIMIT))
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='Seed of the synthetic genomes. Default is 0.')
+    parser.add_argument('-w', '--work_dir',
+                        default=DATA_DIR,
+                        help='Directory to generate the genomes in, which are reused between runs. Default is '
+                             'benchmarks/data.')
+    parser.add_argument('-l', '--label',
+                        default=None,
+                        help='Name of the run, e.g. a version. Defaults to the git revision.')
+    parser.add_argument('-o', '--output',
+                        default=None,
+                        help='JSON file to save the results to. Defaults to benchmarks/results/<label>.json.')
+    parser.add_argument('-c', '--compare',
+                        default=None,
+                        help='JSON results of an earlier run to compare this run to. Exits with status 1 if any stage '
+                             'is slower than the tolerance allows.')
+    parser.add_argument('--startup_budget',
+                        type=float,
+                        default=STARTUP_BUDGET,
+                        help='Seconds that classify.py may take from the start of the interpreter to its first '
+                             'prediction. Exits with status 1 if the startup stage takes longer. Default is {}.'.format(
+                                 STARTUP_BUDGET))
+    parser.add_argument('--tolerance',
+                        type=float,
+                        default=0.25,
+                        help='Fraction by which a stage may be slower than in the compared run. Default is 0.25.')
+    args = parser.parse_args()
+    label = args.label or environment()['revision'] or 'unversioned'
+    print('{:<24}{:>8}{:>12}{:>12}{:>16}'.format('stage', 'genomes', 'best (s)', 'median (s)', 'per genome (us)'))
+    benchmark_results = run_startup(args.work_dir, repeat=args.repeat) if 'startup' in args.stages else list()
+    benchmark_results += run_benchmarks(args.sizes, [stage for stage in args.stages if stage in STAGES], args.work_dir,
+                                       repeat=args.repeat,
+                                       genome_size=args.genome_size,
+                                       num_contigs=args.num_contigs,
+                                       gc=args.gc,
+                                       seed=args.seed,
+                                       extract_limit=args.extract_limit)
+    run_parameters = {'sizes': args.sizes, 'stages': args.stages, 'repeat': args.repeat,
+                      'genome_size': args.genome_size, 'num_contigs': args.num_contigs, 'gc': args.gc,
+                      'seed': args.seed, 'extract_limit': args.extract_limit}
+    save_results(benchmark_results,
+                 run_parameters,
+                 args.output or os.path.join(RESULTS_DIR, '{}.json'.format(label)),
+                 label)
+    failed = False
+    if args.compare:
+        baseline_run = load_results(args.compare)
+        if any(baseline_run['parameters'].get(name) != run_parameters[name] for name in GENOME_PARAMETERS):
+            print('Warning: {} was run on different genomes'.format(args.compare))
+        comparison, slower = compare(benchmark_results, baseline_run['results'], args.tolerance)
+        print('\n'.join(comparison))
+        failed = bool(slower)
+    for result in benchmark_results:
+        if result['stage'] == 'startup_classify' and result['best'] > args.startup_budget:
+            print('classify.py took {:.3f} s to its first prediction, over the budget of {} s'.format(
+                result['best'], args.startup_budget))
+            failed = True
+    if failed:
+        sys.exit(1)
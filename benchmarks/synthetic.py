@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+import random
+import zlib
+import json
+import os
+__author__ = 'adamkoziol', 'andrewlow'
+
+# Deterministic synthetic assemblies for benchmarking. Only the standard library is used, so that the stand-in mash
+# and prodigal executables in benchmarks/stubs can import this module without slowing down every call they handle
+
+# Genera reported by the stand-in mash. Shigella is included, as GenomeQAML reports it as Escherichia
+GENERA = ['Escherichia', 'Listeria', 'Salmonella', 'Shigella', 'Campylobacter', 'Vibrio']
+# Lengths of the ORFs that the stand-in prodigal calls along each contig, in turn. Every bin of the ORF size range
+# frequencies is represented
+ORF_LENGTHS = [240, 630, 1290, 3360, 870, 450, 1800, 510, 960, 3090]
+# Number of bases between consecutive ORFs
+ORF_SPACING = 120
+# Record of the parameters a folder of genomes was generated with, so that it is only generated once
+FOLDER_RECORD = '.synthetic.json'
+# Codons of the genes planted in coding genomes, as in translation table 11
+START_CODON = 'ATG'
+STOP_CODONS = ['TAA', 'TAG', 'TGA']
+SENSE_CODONS = [a + b + c for a in 'ACGT' for b in 'ACGT' for c in 'ACGT' if a + b + c not in STOP_CODONS]
+
+
+def contig_sizes(genome_size, num_contigs, rng):
+    """
+    Split a genome into contigs with log-normally distributed lengths, as is typical of de novo assemblies
+    :param genome_size: total length of the genome
+    :param num_contigs: number of contigs
+    :param rng: random.Random
+    :return: list of contig lengths, which sum to the genome size, longest first
+    """
+    if num_contigs < 1 or genome_size < num_contigs:
+        raise ValueError('A genome of {} bp cannot be split into {} contigs'.format(genome_size, num_contigs))
+    weights = [rng.lognormvariate(0, 1.5) for _ in range(num_contigs)]
+    total = sum(weights)
+    # Every contig has at least one base, and the rounding remainder goes to the longest contig
+    sizes = sorted((1 + int((genome_size - num_contigs) * weight / total) for weight in weights), reverse=True)
+    sizes[0] += genome_size - sum(sizes)
+    return sizes
+
+
+def random_sequence(length, gc, rng):
+    """
+    :param length: number of bases
+    :param gc: fraction of G and C bases
+    :param rng: random.Random
+    :return: random sequence of the length with the expected GC fraction
+    """
+    return ''.join(rng.choices('GCAT', cum_weights=(gc / 2, gc, gc + (1 - gc) / 2, 1), k=length))
+
+
+def reverse_complement(sequence):
+    """
+    :param sequence: sequence of A, C, G, and T
+    :return: the reverse complement of the sequence
+    """
+    return sequence.translate(str.maketrans('ACGT', 'TGCA'))[::-1]
+
+
+def gene_sequence(length, gc, rng):
+    """
+    :param length: length of the gene, including its start and stop codons. Must be a multiple of three
+    :param gc: fraction of G and C bases of the sense codons
+    :param rng: random.Random
+    :return: sequence of a gene with a start codon, random sense codons, and a stop codon
+    """
+    weights = [(gc / 2) ** sum(base in 'GC' for base in codon) * ((1 - gc) / 2) ** sum(base in 'AT' for base in codon)
+               for codon in SENSE_CODONS]
+    return START_CODON + ''.join(rng.choices(SENSE_CODONS, weights=weights, k=length // 3 - 2)) + \
+        rng.choice(STOP_CODONS)
+
+
+def genome_plan(index, genome_size, num_contigs, gc, seed=0, spread=0.2):
+    """
+    Determine the name, contig lengths, and GC fraction of a genome of a synthetic collection. Each genome varies from
+    the requested size, number of contigs, and GC fraction, so that the collection has a spread of features
+    :param index: position of the genome in the collection
+    :param genome_size: typical total length of the genomes
+    :param num_contigs: typical number of contigs of the genomes
+    :param gc: typical fraction of G and C bases
+    :param seed: seed of the collection
+    :param spread: largest fraction by which the size and number of contigs of each genome differ from the typical
+    values. The GC fraction differs by at most a tenth of this
+    :return: name, contig_lengths, gc, rng: strain name, list of contig lengths, GC fraction, and the random.Random to
+    generate the sequence of the genome with
+    """
+    # String seeds are hashed with SHA-512, so the genomes are the same in every process and version of Python
+    rng = random.Random('{}:{}'.format(seed, index))
+    size = max(1, int(genome_size * (1 + rng.uniform(-spread, spread))))
+    contigs = min(size, max(1, int(round(num_contigs * (1 + rng.uniform(-spread, spread))))))
+    genome_gc = min(1.0, max(0.0, gc + rng.uniform(-spread, spread) / 10))
+    return 'synthetic_{:05d}'.format(index), contig_sizes(size, contigs, rng), genome_gc, rng
+
+
+def write_genome(fasta, contig_lengths, gc, rng, line_width=80, coding=False):
+    """
+    Write the FASTA file of a synthetic genome
+    :param fasta: path of the FASTA file to write
+    :param contig_lengths: list of contig lengths
+    :param gc: fraction of G and C bases
+    :param rng: random.Random to generate the sequence with
+    :param line_width: number of bases on each line of sequence
+    :param coding: boolean to determine whether genes are planted at the ORFs that the stand-in prodigal calls, so
+    that the stand-in calls are the true genes of the genome
+    """
+    calls = orf_calls(contig_lengths) if coding else iter(())
+    call = next(calls, None)
+    with open(fasta, 'w') as output:
+        for i, length in enumerate(contig_lengths):
+            sequence = random_sequence(length, gc, rng)
+            while call is not None and call[0] == i + 1:
+                _, start, stop, strand = call
+                gene = gene_sequence(stop - start, gc, rng)
+                if strand == '-':
+                    gene = reverse_complement(gene)
+                sequence = sequence[:start - 1] + gene + sequence[stop - 1:]
+                call = next(calls, None)
+            output.write('>contig_{}_length_{}\n'.format(i + 1, length))
+            for start in range(0, length, line_width):
+                output.write(sequence[start:start + line_width] + '\n')
+
+
+def generate_folder(folder, num_genomes, genome_size=20000, num_contigs=10, gc=0.5, seed=0, spread=0.2,
+                    coding=False):
+    """
+    Generate a folder of synthetic genomes. The genomes only depend on the parameters, so the first n genomes of two
+    folders generated with the same parameters are identical. A folder that was already generated with the same
+    parameters is reused
+    :param folder: folder to write the genomes to
+    :param num_genomes: number of genomes
+    :param genome_size: typical total length of the genomes
+    :param num_contigs: typical number of contigs of the genomes
+    :param gc: typical fraction of G and C bases
+    :param seed: seed of the collection
+    :param spread: variation of the genomes, as in genome_plan
+    :param coding: boolean to determine whether genes are planted in the genomes, as in write_genome
+    :return: dictionary of strain name: tuple of /folder/strain_name.fasta, list of contig lengths, and GC fraction
+    """
+    parameters = {'num_genomes': num_genomes, 'genome_size': genome_size, 'num_contigs': num_contigs, 'gc': gc,
+                  'seed': seed, 'spread': spread, 'coding': coding}
+    record_file = os.path.join(folder, FOLDER_RECORD)
+    try:
+        with open(record_file) as record:
+            complete = json.load(record) == parameters
+    except (IOError, ValueError):
+        complete = False
+    if not complete:
+        os.makedirs(folder, exist_ok=True)
+    genomes = dict()
+    for index in range(num_genomes):
+        name, contig_lengths, genome_gc, rng = genome_plan(index, genome_size, num_contigs, gc, seed, spread)
+        fasta = os.path.join(folder, name + '.fasta')
+        if not complete:
+            write_genome(fasta, contig_lengths, genome_gc, rng, coding=coding)
+        genomes[name] = fasta, contig_lengths, genome_gc
+    if not complete:
+        # The record is written last, so an interrupted generation is started again
+        with open(record_file, 'w') as record:
+            json.dump(parameters, record)
+    return genomes
+
+
+def fasta_contig_lengths(data):
+    """
+    :param data: contents of a FASTA file (bytes)
+    :return: list of the lengths of the contigs in the file, in file order
+    """
+    lengths = list()
+    for record in data.split(b'>')[1:]:
+        sequence = record[record.find(b'\n') + 1:] if b'\n' in record else b''
+        lengths.append(len(sequence) - sum(sequence.count(whitespace) for whitespace in (b'\n', b'\r', b' ')))
+    return lengths
+
+
+def orf_calls(contig_lengths):
+    """
+    Call ORFs along each contig, cycling through ORF_LENGTHS, in place of prodigal
+    :param contig_lengths: list of contig lengths, in file order
+    :return: generator of tuples of contig number, start, stop, and strand, as in prodigal sco output
+    """
+    orf = 0
+    for contig, length in enumerate(contig_lengths):
+        start = 1
+        while True:
+            orf_length = ORF_LENGTHS[orf % len(ORF_LENGTHS)]
+            if start + orf_length > length:
+                break
+            yield contig + 1, start, start + orf_length, '+' if orf % 3 else '-'
+            start += orf_length + ORF_SPACING
+            orf += 1
+
+
+def sco_lines(contig_lengths):
+    """
+    :param contig_lengths: list of contig lengths, in file order
+    :return: generator of the lines of prodigal sco output of the ORFs called by orf_calls
+    """
+    calls = orf_calls(contig_lengths)
+    call = next(calls, None)
+    for contig, length in enumerate(contig_lengths, start=1):
+        yield '# Sequence Data: seqnum={0};seqlen={1};seqhdr="contig_{0}_length_{1}"\n'.format(contig, length)
+        yield '# Model Data: version=Prodigal.v2.6.3;run_type=Single;model="Ab initio";gc_cont=50.00;' \
+              'transl_table=11;uses_sd=1\n'
+        gene = 1
+        while call is not None and call[0] == contig:
+            _, start, stop, strand = call
+            yield '>{}_{}_{}_{}\n'.format(gene, start, stop, strand)
+            gene += 1
+            call = next(calls, None)
+
+
+def write_sco(sco_file, contig_lengths):
+    """
+    :param sco_file: path of the prodigal sco output to write
+    :param contig_lengths: list of contig lengths, in file order
+    """
+    with open(sco_file, 'w') as output:
+        output.writelines(sco_lines(contig_lengths))
+
+
+def screen_genus(data):
+    """
+    :param data: contents of a FASTA file (bytes)
+    :return: genus that the stand-in mash reports for the file. The same sequence always has the same genus
+    """
+    return GENERA[zlib.crc32(data) % len(GENERA)]
+
+
+def screen_line(genus):
+    """
+    :param genus: genus of the hit
+    :return: line of mash screen output with a hit to a reference of the genus
+    """
+    return '0.99\t950/1000\t12\t0\t/refs/{}/species/GCF_000000000.1.fna\tsynthetic reference\n'.format(genus)
+
+
+def dist_line(genus, query):
+    """
+    :param genus: genus of the closest reference
+    :param query: name of the query, as given to mash dist
+    :return: line of mash dist output with the distance of the query to a reference of the genus
+    """
+    return '/refs/{}/species/GCF_000000000.1.fna\t{}\t0.01\t0\t950/1000\n'.format(genus, query)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+import subprocess
+import functools
+import hashlib
+import json
+import os
+__author__ = 'adamkoziol', 'andrewlow'
+
+# Version of the extracted features - increment whenever the way any feature is calculated changes, so that rows
+# cached by earlier versions are no longer used
+FEATURE_VERSION = 1
+# Default upper bound on the total size of the cache
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+
+
+def file_digest(path, chunk_size=1048576):
+    """
+    Calculate the SHA-256 digest of the contents of a file
+    :param path: path of the file
+    :param chunk_size: number of bytes to read at a time
+    :return: hex digest
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def _sketch_digest(sketch_file, size, mtime):
+    return file_digest(sketch_file)
+
+
+def sketch_digest(sketch_file):
+    """
+    Digest of the refseq sketch. Digests are remembered for as long as the file is unchanged, so that the sketch is
+    only read once per process
+    :param sketch_file: path to the refseq database sketch
+    :return: hex digest
+    """
+    stat = os.stat(sketch_file)
+    return _sketch_digest(os.path.abspath(sketch_file), stat.st_size, stat.st_mtime)
+
+
+@functools.lru_cache(maxsize=None)
+def prodigal_version():
+    """
+    Find the version of prodigal on the $PATH
+    :return: version string reported by prodigal -v, or 'unavailable' if prodigal could not be run
+    """
+    try:
+        process = subprocess.run(['prodigal', '-v'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        return 'unavailable'
+    # prodigal writes its version to stderr
+    return (process.stderr or process.stdout).decode(errors='replace').strip()
+
+
+def cache_context(refseq_database, genus_method='mash', orf_method='prodigal'):
+    """
+    Everything other than the FASTA itself that determines the extracted features. Rows cached with a different
+    context are never used
+    :param refseq_database: Path to reduced refseq database sketch
+    :param genus_method: method used to determine genera
+    :param orf_method: method used to find ORFs
+    :return: dictionary of context name: value
+    """
+    context = {'feature_version': FEATURE_VERSION,
+               'genus_method': genus_method,
+               'refseq_sketch': sketch_digest(refseq_database)}
+    if orf_method == 'orfscan':
+        from genomeqaml import orfscan
+        # The context of prodigal rows is unchanged, so that rows cached before ORFs could be scanned are still used
+        context['orfscan'] = orfscan.SCAN_VERSION
+    else:
+        context['prodigal'] = prodigal_version()
+    return context
+
+
+class FeatureCache(object):
+    """
+    Persistent cache of the feature row of each sample, keyed by a digest of the FASTA contents and the context in
+    which the features were extracted. Each row is stored as a small JSON file, and the least recently used rows are
+    evicted once the cache exceeds its size limit
+    """
+
+    def __init__(self, directory, context, max_size=DEFAULT_CACHE_SIZE):
+        """
+        :param directory: directory in which to store the cache. Created if it does not exist
+        :param context: dictionary of context name: value e.g. from cache_context
+        :param max_size: maximum total size of the cache in bytes
+        """
+        self.directory = directory
+        self.context = context
+        self.max_size = max_size
+        self.context_digest = hashlib.sha256(json.dumps(context, sort_keys=True).encode()).hexdigest()
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(size for _, size, _ in self.entries())
+
+    def entries(self):
+        """
+        :return: list of tuples of path, size, and time of last use of every entry in the cache
+        """
+        entries = list()
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.json'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def lookup(self, fasta, file_name):
+        """
+        Calculate the digest of a FASTA file, and retrieve its cached row
+        :param fasta: /sequencepath/strain_name.extension
+        :param file_name: strain name to report in the row
+        :return: digest, row: digest of the FASTA contents, and the cached row (None if the sample is not cached)
+        """
+        digest = file_digest(fasta)
+        return digest, self.get(digest, file_name)
+
+    def path(self, digest):
+        key = hashlib.sha256((digest + self.context_digest).encode()).hexdigest()
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, digest, file_name):
+        """
+        Retrieve the cached row of a sample
+        :param digest: digest of the FASTA contents
+        :param file_name: strain name to report in the row
+        :return: dictionary of report column: value, or None if the sample is not in the cache
+        """
+        path = self.path(digest)
+        try:
+            with open(path) as entry:
+                cached = json.load(entry)
+            # Update the modification time, which is used to find the least recently used entries
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        if cached.get('context') != self.context:
+            return None
+        row = {'SampleName': file_name}
+        row.update(cached['row'])
+        return row
+
+    def put(self, digest, row):
+        """
+        Store the row of a sample, and evict old entries if the cache is too large
+        :param digest: digest of the FASTA contents
+        :param row: dictionary of report column: value
+        """
+        path = self.path(digest)
+        # The sample name is not part of the content, so it is not cached
+        cached = {'context': self.context,
+                  'row': {column: value for column, value in row.items() if column != 'SampleName'}}
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as entry:
+            json.dump(cached, entry)
+        try:
+            self.size -= os.path.getsize(path)
+        except OSError:
+            pass
+        # Replace the entry atomically, so that concurrent readers never see a partial file
+        os.replace(tmp_path, path)
+        self.size += os.path.getsize(path)
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is within three quarters of its size limit
+        """
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        self.size = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if self.size <= self.max_size * 0.75:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+
+    def prune(self):
+        """
+        Remove every entry that was cached with a different context e.g. after the refseq sketch or prodigal have
+        been updated
+        :return: number of entries removed
+        """
+        removed = 0
+        for path, size, _ in self.entries():
+            try:
+                with open(path) as entry:
+                    current = json.load(entry).get('context') == self.context
+            except (IOError, OSError, ValueError):
+                current = False
+            if not current:
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                self.size -= size
+                removed += 1
+        return removed
+
+    def clear(self):
+        """
+        Remove every entry from the cache
+        """
+        for path, _, _ in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.size = 0
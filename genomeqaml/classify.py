@@ -1,56 +1,354 @@
 #!/usr/bin/env python
 import os
+import sys
+import json
 import pickle
 import argparse
-import pandas as pd
-import multiprocessing
-from genomeqaml import extract_features
+import csv
+from genomeqaml import cache, instrument, resources, tools
+# numpy, pandas, scikit-learn (through pickle), and the feature extraction module are imported by the functions that
+# use them, so that --help, and classifying a folder that already has a feature report, do not wait for them to load
 
+# Names of the classes predicted by the model, and the columns of the classification report
+CLASSES = {0: 'Fail', 1: 'Pass', 2: 'Reference'}
+REPORT_COLUMNS = ['Sample', 'Predicted_Class', 'Percent_Fail', 'Percent_Pass', 'Percent_Ref']
+# Version of the layout of the feature schema written alongside a trained model
+SCHEMA_VERSION = 1
+# Genera that read_csv reads as missing, which the model was trained with in Genus_nan
+MISSING_GENERA = ('', 'NA', 'nan')
 
-def classify_data(model, test_folder, refseq_database, report_file, threads=4):
-    # Extract features from the training folder.
-    if not os.path.isfile(os.path.join(test_folder, 'extracted_features.csv')):
+
+def data_file(name):
+    """
+    Find one of the files distributed with GenomeQAML (model.p, schema.json, refseq.msh). These are installed to the
+    root of the environment, but are alongside this module in a source checkout
+    :param name: name of the file
+    :return: path of the file
+    """
+    current_dir = os.path.dirname(os.path.realpath(__file__))
+    for directory in (os.path.join(current_dir, '..'), current_dir, sys.prefix):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            return path
+    return os.path.join(current_dir, '..', name)
+
+
+def default_model_file():
+    """
+    :return: path of the bundled model. A model exported to NumPy arrays is preferred, as it loads quickly and does not
+    need scikit-learn
+    """
+    forest_file = data_file('model.npz')
+    return forest_file if os.path.isfile(forest_file) else data_file('model.p')
+
+
+def load_model(model_file=None):
+    """
+    :param model_file: path of the pickled classifier, or of a classifier exported with forest.export_forest (.npz).
+    Defaults to the bundled model
+    :return: classifier
+    """
+    model_file = model_file or default_model_file()
+    if model_file.endswith('.npz'):
+        from genomeqaml import forest
+        return forest.load_forest(model_file)
+    with open(model_file, 'rb') as model:
+        return pickle.load(model)
+
+
+def model_digest(model_file):
+    """
+    :param model_file: path of the pickled or exported classifier
+    :return: digest of the pickled classifier. Exported classifiers record the digest of the model they came from
+    """
+    if model_file.endswith('.npz'):
+        from genomeqaml import forest
+        return forest.load_forest(model_file).model_digest
+    return cache.file_digest(model_file)
+
+
+def build_schema(dataframe, model_file=None, orf_method='prodigal'):
+    """
+    Describe the features that a model is trained on, so that new samples can be matched to them without the
+    training data
+    :param dataframe: training dataframe of extracted features and PassFail, as passed to fit_model
+    :param model_file: optional path of the pickled model trained on the dataframe. Its digest is recorded, so that the
+    schema can be checked against the model
+    :param orf_method: method that the ORFs of the training data were found with: 'prodigal' or 'orfscan'
+    :return: dictionary of the schema version, feature version, model digest, ORF method, the ordered feature names,
+    and the genera
+    """
+    import pandas as pd
+    features = list(pd.get_dummies(dataframe, columns=['Genus'], dummy_na=True).columns[1:])
+    features.remove('PassFail')
+    return {'schema_version': SCHEMA_VERSION,
+            'feature_version': cache.FEATURE_VERSION,
+            'model_digest': cache.file_digest(model_file) if model_file else None,
+            'orf_method': orf_method,
+            'features': features,
+            'genera': sorted(str(genus) for genus in dataframe['Genus'].dropna().unique())}
+
+
+def write_schema(schema, schema_file):
+    """
+    :param schema: dictionary from build_schema
+    :param schema_file: path of the JSON schema file to write
+    """
+    with open(schema_file, 'w') as output:
+        json.dump(schema, output, indent=2)
+        output.write('\n')
+
+
+def load_schema(schema_file=None, dataframe_file=None):
+    """
+    Load the feature schema of a model. Models trained before schemas were written only have the pickled training
+    dataframe, so the schema is built from the dataframe if there is no schema file
+    :param schema_file: path of the JSON schema file. Defaults to the bundled schema.json
+    :param dataframe_file: path of the pickled training dataframe to fall back to. Defaults to the bundled dataframe.p
+    :return: dictionary from build_schema
+    """
+    schema_file = schema_file or data_file('schema.json')
+    if not os.path.isfile(schema_file):
+        import pandas as pd
+        return build_schema(pd.read_pickle(dataframe_file or data_file('dataframe.p')))
+    with open(schema_file) as schema_json:
+        schema = json.load(schema_json)
+    if schema.get('schema_version', 0) > SCHEMA_VERSION:
+        raise ValueError('{} was written by a newer version of GenomeQAML'.format(schema_file))
+    return schema
+
+
+def check_schema(schema, model_file, orf_method='prodigal'):
+    """
+    Ensure that a schema describes the features of a model, and that the model can classify samples whose ORFs are
+    found with orf_method
+    :param schema: dictionary from build_schema
+    :param model_file: path of the pickled or exported model
+    :param orf_method: method that the ORFs of the samples to classify are found with: 'prodigal' or 'orfscan'
+    """
+    if schema.get('model_digest') and schema['model_digest'] != model_digest(model_file):
+        raise ValueError('The feature schema does not belong to the model in {}'.format(model_file))
+    if schema.get('feature_version', cache.FEATURE_VERSION) != cache.FEATURE_VERSION:
+        raise ValueError('The model was trained on features from a different version of GenomeQAML')
+    check_orf_method(schema, orf_method)
+
+
+def check_orf_method(schema, orf_method):
+    """
+    Ensure that a model was trained on ORFs found with the same method as the samples to classify. The ORF columns of
+    orfscan are only approximately those of prodigal, so a model trained on one is not used with the other. Schemas
+    that do not record the method, such as that of the bundled model, were trained on prodigal ORFs
+    :param schema: dictionary from build_schema
+    :param orf_method: method that the ORFs of the samples to classify are found with: 'prodigal' or 'orfscan'
+    """
+    trained_method = schema.get('orf_method', 'prodigal')
+    if trained_method != orf_method:
+        raise ValueError('The model was trained on ORFs found with {}, so it can not classify samples whose ORFs are '
+                         'found with {}. Supply a model trained on {} features, e.g. with scikit_learn_test.py '
+                         '--orf_method {}'.format(trained_method, orf_method, orf_method, orf_method))
+
+
+def read_features(sequencepath):
+    """
+    Read the extracted features of a folder, from its columnar feature store if it is up to date, or its CSV report
+    otherwise
+    :param sequencepath: path of folder containing FASTA genomes
+    :return: dataframe of extracted features
+    """
+    import numpy as np
+    import pandas as pd
+    from genomeqaml import extract_features
+    feature_store = extract_features.open_store(sequencepath)
+    if feature_store is None:
+        return pd.read_csv(os.path.join(sequencepath, extract_features.REPORT_FILE))
+    test_df = pd.DataFrame({column: feature_store.column(column) for column in feature_store.columns})
+    # Match read_csv, which treats a genus of NA as missing
+    test_df['Genus'] = test_df['Genus'].replace('NA', np.nan)
+    return test_df
+
+
+def features_frame(rows):
+    """
+    Build a dataframe of feature rows, matching the dataframe read from an extracted_features.csv report
+    :param rows: iterable of dictionaries of report column: value
+    :return: dataframe
+    """
+    import numpy as np
+    import pandas as pd
+    from genomeqaml import extract_features
+    test_df = pd.DataFrame(list(rows), columns=extract_features.FEATURE_COLUMNS)
+    missing = [column for column in extract_features.FEATURE_COLUMNS if test_df[column].isnull().any()]
+    if missing:
+        raise ValueError('Feature rows are missing values for {}'.format(', '.join(missing)))
+    # read_csv treats a genus of NA as missing, so the model was trained with these samples in Genus_nan
+    test_df['Genus'] = test_df['Genus'].replace('NA', np.nan)
+    return test_df
+
+
+def align_features(test_df, features):
+    """
+    One-hot encode the genera of the samples to be classified, and match the columns to the training data
+    :param test_df: dataframe of extracted features
+    :param features: ordered list of the features of the model, from the schema
+    :return: dataframe of the features to pass to the model
+    """
+    import pandas as pd
+    dataframe = pd.get_dummies(test_df, columns=['Genus'], dummy_na=True)
+    # Genera that were not part of the training set are dropped, genera that are not part of the test set are added as
+    # zeros, and the columns are put in the order of the training data
+    return dataframe.reindex(columns=features, fill_value=0)
+
+
+def classify_features(model, test_df, features):
+    """
+    Classify samples from their extracted features
+    :param model: classifier
+    :param test_df: dataframe of extracted features
+    :param features: ordered list of the features of the model, from the schema
+    :return: list of tuples of strain name, predicted class, and percent probabilities of fail, pass, and reference
+    """
+    if len(test_df) == 0:
+        return list()
+    return predictions(model, test_df['SampleName'], model.predict_proba(align_features(test_df, features)))
+
+
+def read_feature_columns(sequencepath):
+    """
+    Read the extracted features of a folder, as read_features does, without building a dataframe, so that pandas does
+    not need to be loaded to classify them
+    :param sequencepath: path of folder containing FASTA genomes
+    :return: dictionary of report column: sequence of the values of each sample. Values read from the CSV report are
+    strings
+    """
+    from genomeqaml import extract_features
+    feature_store = extract_features.open_store(sequencepath)
+    if feature_store is not None:
+        return {column: feature_store.column(column) for column in feature_store.columns}
+    with open(os.path.join(sequencepath, extract_features.REPORT_FILE), newline='') as report:
+        reader = csv.reader(report)
+        header = next(reader)
+        columns = {column: list() for column in header}
+        for row in reader:
+            for column, value in zip(header, row):
+                columns[column].append(value)
+    return columns
+
+
+def feature_matrix(columns, features):
+    """
+    One-hot encode the genera of the samples to be classified, and put the features in the order of the training data,
+    as align_features does for a dataframe
+    :param columns: dictionary of report column: sequence of values, from read_feature_columns
+    :param features: ordered list of the features of the model, from the schema
+    :return: array of the features to pass to the model, of shape (number of samples, number of features)
+    """
+    import numpy as np
+    genera = ['nan' if not isinstance(genus, str) or genus in MISSING_GENERA else genus for genus in columns['Genus']]
+    matrix = np.zeros((len(genera), len(features)))
+    for i, feature in enumerate(features):
+        if feature.startswith('Genus_'):
+            matrix[:, i] = [genus == feature[len('Genus_'):] for genus in genera]
+        elif feature in columns:
+            matrix[:, i] = np.asarray(columns[feature], dtype=np.float64)
+    return matrix
+
+
+def classify_columns(model, columns, features):
+    """
+    Classify samples from their extracted features, as classify_features does, without pandas unless the model is a
+    scikit-learn model that was fitted with feature names
+    :param model: classifier
+    :param columns: dictionary of report column: sequence of values, from read_feature_columns
+    :param features: ordered list of the features of the model, from the schema
+    :return: list of tuples of strain name, predicted class, and percent probabilities of fail, pass, and reference
+    """
+    from genomeqaml import forest
+    if len(columns['SampleName']) == 0:
+        return list()
+    x = feature_matrix(columns, features)
+    if getattr(model, 'feature_names_in_', None) is not None and not isinstance(model, forest.ArrayForest):
+        # scikit-learn warns about arrays passed to models that were fitted with a dataframe
+        import pandas as pd
+        x = pd.DataFrame(x, columns=features)
+    return predictions(model, columns['SampleName'], model.predict_proba(x))
+
+
+def predictions(model, sample_names, probabilities):
+    """
+    :param model: classifier
+    :param sample_names: sequence of strain names
+    :param probabilities: array of the class probabilities of each sample, returned by model.predict_proba
+    :return: list of tuples of strain name, predicted class, and percent probabilities of fail, pass, and reference
+    """
+    import numpy as np
+    # The same as model.predict, without evaluating the trees a second time
+    result = model.classes_.take(np.argmax(probabilities, axis=1))
+    return [(sample_name, CLASSES.get(result[i], 'ND'), round(probabilities[i][0] * 100.0, 2),
+             round(probabilities[i][1] * 100.0, 2), round(probabilities[i][2] * 100.0, 2))
+            for i, sample_name in enumerate(sample_names)]
+
+
+def report_line(result):
+    """
+    :param result: tuple of strain name, predicted class, and percent probabilities of fail, pass, and reference
+    :return: line of the classification report
+    """
+    sample_name, output, fail_prob, pass_prob, ref_prob = result
+    return ','.join([sample_name, output] + ['%.2f' % prob for prob in (fail_prob, pass_prob, ref_prob)]) + '\n'
+
+
+def classify_data(model, test_folder, refseq_database, report_file, threads=4, genus_method='mash', tool_threads=None,
+                  cache_dir=None, schema=None, results_db=None, instrumentation=None, tool_runner=None, failures=None,
+                  orf_method='prodigal'):
+    # Extract features from the training folder. With a feature cache, only samples that have not been seen before are
+    # extracted, so the report is always brought up to date. The instrumentation (an instrument.Recorder) measures
+    # the extraction, as well as reading the features, classifying them, and writing the results. Samples whose tools
+    # fail (see tools.ToolRunner) are not classified, and are recorded in the failures dictionary. ORFs are found with
+    # prodigal, unless orf_method is 'orfscan', which needs a model trained on orfscan features. The digests of the
+    # samples calculated during the extraction are reused for the results database
+    from genomeqaml import extract_features
+    # The schema of the bundled model is used unless another is provided
+    schema = schema or load_schema()
+    check_orf_method(schema, orf_method)
+    digests = None
+    # Reports do not record how their ORFs were found, so they are only reused for prodigal features
+    if cache_dir or orf_method != 'prodigal' or not extract_features.report_exists(test_folder):
         print('Extracting features!')
+        digests = dict() if results_db else None
         extract_features.main(sequencepath=test_folder,
                               report=True,
                               refseq_database=refseq_database,
-                              num_threads=threads)
-    test_df = pd.read_csv(os.path.join(test_folder, 'extracted_features.csv'))
-    dataframe = pd.get_dummies(test_df, columns=['Genus'], dummy_na=True)
-    current_dir = os.path.dirname(os.path.realpath(__file__))
-    df = pickle.load(open(os.path.join(current_dir, '..', 'dataframe.p'), 'rb'))
-    training_dataframe = pd.get_dummies(df, columns=['Genus'], dummy_na=True)
-    for column in dataframe:
-        if column not in training_dataframe:
-            dataframe.drop(column, axis=1, inplace=True)
-    # Add any genera that weren't in our test set but were in the training set.
-    for column in training_dataframe:
-        if 'Genus' in column and column not in dataframe:
-            not_present = [0] * len(dataframe)
-            dataframe[column] = not_present
-    # Then, add any features that were part of training data but not part of test data
-    features = list(dataframe.columns[1:len(dataframe.columns)])
-    x = dataframe[features]
-    result = model.predict(x)
-    probabilities = model.predict_proba(x)
-    output = 'ND'
-    for i in range(len(result)):
-        if result[i] == 0:
-            output = 'Fail'
-        elif result[i] == 1:
-            output = 'Pass'
-        elif result[i] == 2:
-            output = 'Reference'
-        fail_prob = '%.2f' % round(probabilities[i][0] * 100.0, 2)
-        pass_prob = '%.2f' % round(probabilities[i][1] * 100.0, 2)
-        ref_prob = '%.2f' % round(probabilities[i][2] * 100.0, 2)
+                              num_threads=threads,
+                              genus_method=genus_method,
+                              orf_method=orf_method,
+                              tool_threads=tool_threads,
+                              cache_dir=cache_dir,
+                              results_db=results_db,
+                              instrumentation=instrumentation,
+                              tool_runner=tool_runner,
+                              failures=failures,
+                              digests=digests)
+    with instrument.stage(instrumentation, 'read_features'):
+        columns = read_feature_columns(test_folder)
+    with instrument.stage(instrumentation, 'classify'):
+        results = classify_columns(model, columns, schema['features'])
+    with instrument.stage(instrumentation, 'write_results'):
         with open(report_file, 'a+') as report:
-            report.write(test_df['SampleName'][i] + ',' + output + ',' + fail_prob + ',' + pass_prob + ',' + ref_prob
-                         + '\n')
+            for result in results:
+                report.write(report_line(result))
+        if results_db:
+            from genomeqaml import database
+            # All the predictions are recorded in a single transaction
+            with database.ResultsDatabase(results_db) as results_database:
+                results_database.add_predictions(results,
+                                                 genera=dict(zip(columns['SampleName'], columns['Genus'])),
+                                                 digests=digests,
+                                                 model_digest=schema.get('model_digest'),
+                                                 folder=test_folder)
 
 
 if __name__ == '__main__':
-    num_cpus = multiprocessing.cpu_count()
+    num_cpus = resources.available_cpus()
     parser = argparse.ArgumentParser()
     parser.add_argument('-t', '--test_folder',
                         type=str,
@@ -64,15 +362,100 @@ if __name__ == '__main__':
                         type=int,
                         default=num_cpus,
                         help='Number of threads to run the feature extraction module with.'
-                             ' Defaults to number of CPUs on your machine.')
+                             ' Defaults to the number of CPUs available, taking CPU affinity and cgroup quotas into'
+                             ' account.')
+    parser.add_argument('--tool_threads',
+                        type=int,
+                        default=None,
+                        help='Number of threads to give each external tool. By default, tools are single-threaded'
+                             ' unless there are fewer samples than CPUs.')
+    parser.add_argument('-g', '--genus_method',
+                        choices=['mash', 'batch', 'minhash'],
+                        default='mash',
+                        help='Determine genera with the mash executable (default), with a single mash dist for each'
+                             ' batch of samples (batch), or by screening the RefSeq sketch in-process with minhash.')
+    parser.add_argument('-o', '--orf_method',
+                        choices=['prodigal', 'orfscan'],
+                        default='prodigal',
+                        help='Predict ORFs with the prodigal executable (default), or find them in-process with a fast,'
+                             ' approximate six-frame scan that does not need prodigal, for quick triage. The bundled'
+                             ' model was trained on prodigal ORFs, so orfscan needs a --model_file and --schema_file'
+                             ' trained on orfscan features.')
+    parser.add_argument('-c', '--cache_dir',
+                        type=str,
+                        default=None,
+                        help='Directory of a persistent cache of extracted features. Samples that have already been'
+                             ' extracted are read from the cache.')
+    parser.add_argument('-m', '--model_file',
+                        type=str,
+                        default=None,
+                        help='Model to classify samples with: a pickled model, or a model exported to NumPy arrays'
+                             ' (.npz) with genomeqaml/forest.py, which does not need scikit-learn. Defaults to the'
+                             ' bundled model.')
+    parser.add_argument('--schema_file',
+                        type=str,
+                        default=None,
+                        help='Feature schema of the model, written alongside it by scikit_learn_test.py. Defaults to'
+                             ' the bundled schema.json.')
+    parser.add_argument('--results_db',
+                        type=str,
+                        default=None,
+                        help='Path of a SQLite database to also record the extracted features and predictions in.'
+                             ' Created if it does not exist. Query it with genomeqaml/database.py.')
+    parser.add_argument('--metrics',
+                        type=str,
+                        default=None,
+                        help='Write the wall time, CPU time, child process CPU time, bytes read, and peak RSS of every'
+                             ' stage of the run, and of each sample, to this file as lines of JSON.')
+    parser.add_argument('--summary',
+                        action='store_true',
+                        help='Print a table of the total time and resources used by each stage at the end of the run.')
+    parser.add_argument('--profile',
+                        type=str,
+                        default=None,
+                        help='Run every stage under cProfile, and write the combined profile of each stage to this'
+                             ' directory.')
+    parser.add_argument('--tool_timeout',
+                        type=float,
+                        default=None,
+                        help='Kill mash or prodigal if a single run on a sample takes longer than this many seconds. By'
+                             ' default, tools are not time limited.')
+    parser.add_argument('--tool_retries',
+                        type=int,
+                        default=tools.DEFAULT_RETRIES,
+                        help='Number of times to run mash or prodigal again if it fails or times out. Samples whose'
+                             ' tools still fail are not classified, and the run exits with status 1. Default is {}.'
+                             .format(tools.DEFAULT_RETRIES))
     args = parser.parse_args()
-    cur_dir = os.path.dirname(os.path.realpath(__file__))
-    model_file = pickle.load(open(os.path.join(cur_dir, '..', 'model.p'), 'rb'))
-    with open(args.report_file, 'w') as f:
-        f.write('Sample,Predicted_Class,Percent_Fail,Percent_Pass,Percent_Ref\n')
-    classify_data(model=model_file,
-                  test_folder=args.test_folder,
-                  refseq_database=os.path.join(cur_dir, '..', 'refseq.msh'),
-                  report_file=args.report_file,
-                  threads=args.num_threads)
+    if args.tool_timeout is not None and args.tool_timeout <= 0 or args.tool_retries < 0:
+        parser.error('--tool_timeout must be positive, and --tool_retries must not be negative')
+    failed_samples = dict()
+    model_path = args.model_file or default_model_file()
+    with instrument.recording(metrics_file=args.metrics, summary=args.summary,
+                              profile_dir=args.profile) as run_instrumentation:
+        with instrument.stage(run_instrumentation, 'load_model'):
+            feature_schema = load_schema(args.schema_file)
+            try:
+                check_schema(feature_schema, model_path, args.orf_method)
+            except ValueError as error:
+                parser.error(str(error))
+            classification_model = load_model(model_path)
+        with open(args.report_file, 'w') as f:
+            f.write(','.join(REPORT_COLUMNS) + '\n')
+        classify_data(model=classification_model,
+                      test_folder=args.test_folder,
+                      refseq_database=data_file('refseq.msh'),
+                      report_file=args.report_file,
+                      threads=args.num_threads,
+                      genus_method=args.genus_method,
+                      orf_method=args.orf_method,
+                      tool_threads=args.tool_threads,
+                      cache_dir=args.cache_dir,
+                      schema=feature_schema,
+                      results_db=args.results_db,
+                      instrumentation=run_instrumentation,
+                      tool_runner=tools.ToolRunner(timeout=args.tool_timeout, retries=args.tool_retries),
+                      failures=failed_samples)
     print('Classification complete! Results can be found in {}'.format(args.report_file))
+    if failed_samples:
+        sys.exit(1)
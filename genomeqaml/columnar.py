@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+import shutil
+import json
+import os
+__author__ = 'adamkoziol', 'andrewlow'
+
+# Type of columns of UTF-8 strings. All other columns have a NumPy dtype string e.g. '<i8'
+STRING = 'str'
+SCHEMA_FILE = 'schema.json'
+STORE_VERSION = 1
+
+
+class ColumnStore(object):
+    """
+    Directory of typed columns, each held in its own flat binary file, that can be memory-mapped without parsing.
+    Numeric columns are little-endian arrays. String columns are a file of UTF-8 data, and a file of the offset of the
+    end of each string. Rows are appended in groups, and schema.json records the number of rows that are complete, so
+    a group that was interrupted part way through is never read
+    """
+
+    def __init__(self, directory):
+        """
+        Open an existing store
+        :param directory: directory of the store
+        """
+        self.directory = directory
+        with open(os.path.join(directory, SCHEMA_FILE)) as schema_json:
+            self.schema = json.load(schema_json)
+        if self.schema.get('version', 0) > STORE_VERSION:
+            raise ValueError('{} was written by a newer version of GenomeQAML'.format(directory))
+
+    @classmethod
+    def create(cls, directory, columns):
+        """
+        Create an empty store
+        :param directory: directory of the store. Created if it does not exist
+        :param columns: list of tuples of column name, and STRING or a NumPy dtype string
+        :return: ColumnStore
+        """
+        import numpy as np
+        os.makedirs(directory, exist_ok=True)
+        schema = {'version': STORE_VERSION,
+                  'columns': [{'name': name, 'dtype': dtype, 'file': 'column{:02d}'.format(i)}
+                              for i, (name, dtype) in enumerate(columns)],
+                  'num_rows': 0,
+                  'row_groups': list()}
+        for column in schema['columns']:
+            open(os.path.join(directory, column['file'] + '.bin'), 'wb').close()
+            if column['dtype'] == STRING:
+                with open(os.path.join(directory, column['file'] + '.offsets'), 'wb') as offsets:
+                    offsets.write(np.zeros(1, dtype='<u8').tobytes())
+        write_schema(schema, directory)
+        return cls(directory)
+
+    def __len__(self):
+        return self.schema['num_rows']
+
+    @property
+    def columns(self):
+        """
+        :return: list of column names
+        """
+        return [column['name'] for column in self.schema['columns']]
+
+    def path(self, column, extension='.bin'):
+        return os.path.join(self.directory, column['file'] + extension)
+
+    def string_offsets(self, column):
+        return self.map(self.path(column, '.offsets'), '<u8', len(self) + 1)
+
+    def map(self, path, dtype, count):
+        """
+        Memory-map the first count items of a column file
+        """
+        import numpy as np
+        if count == 0:
+            # Empty files cannot be memory-mapped
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', shape=(count,))
+
+    def append(self, rows):
+        """
+        Append a group of rows to every column
+        :param rows: list of dictionaries of column name: value
+        """
+        import numpy as np
+        if not rows:
+            return
+        self.truncate()
+        for column in self.schema['columns']:
+            values = [row[column['name']] for row in rows]
+            if column['dtype'] == STRING:
+                encoded = [str(value).encode() for value in values]
+                end = int(self.string_offsets(column)[-1])
+                ends = end + np.cumsum([len(value) for value in encoded], dtype='<u8')
+                with open(self.path(column), 'ab') as data:
+                    data.write(b''.join(encoded))
+                with open(self.path(column, '.offsets'), 'ab') as offsets:
+                    offsets.write(ends.astype('<u8').tobytes())
+            else:
+                with open(self.path(column), 'ab') as data:
+                    data.write(np.asarray(values, dtype=column['dtype']).tobytes())
+        # The rows are only part of the store once the schema records them
+        self.schema['num_rows'] += len(rows)
+        self.schema['row_groups'].append(len(rows))
+        write_schema(self.schema, self.directory)
+
+    def truncate(self):
+        """
+        Remove anything written to the column files after the last complete row group
+        """
+        import numpy as np
+        for column in self.schema['columns']:
+            if column['dtype'] == STRING:
+                offsets = self.string_offsets(column)
+                sizes = ((self.path(column), int(offsets[-1])), (self.path(column, '.offsets'), offsets.nbytes))
+                del offsets
+            else:
+                sizes = ((self.path(column), len(self) * np.dtype(column['dtype']).itemsize),)
+            for path, size in sizes:
+                if os.path.getsize(path) > size:
+                    with open(path, 'r+b') as column_file:
+                        column_file.truncate(size)
+
+    def column(self, name):
+        """
+        :param name: column name
+        :return: read-only memory-mapped array for numeric columns, or a list of strings for string columns
+        """
+        for column in self.schema['columns']:
+            if column['name'] == name:
+                break
+        else:
+            raise KeyError(name)
+        if column['dtype'] != STRING:
+            return self.map(self.path(column), column['dtype'], len(self))
+        offsets = self.string_offsets(column)
+        data = self.map(self.path(column), 'u1', int(offsets[-1])).tobytes()
+        return [data[start:end].decode() for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+    def rows(self):
+        """
+        :return: generator of dictionaries of column name: value
+        """
+        columns = [(name, self.column(name)) for name in self.columns]
+        for i in range(len(self)):
+            yield {name: values[i].item() if hasattr(values[i], 'item') else values[i] for name, values in columns}
+
+
+def write_schema(schema, directory):
+    tmp_file = os.path.join(directory, '{}.{}.tmp'.format(SCHEMA_FILE, os.getpid()))
+    with open(tmp_file, 'w') as schema_json:
+        json.dump(schema, schema_json, indent=2)
+    os.replace(tmp_file, os.path.join(directory, SCHEMA_FILE))
+
+
+def replace_store(source, destination):
+    """
+    Move a complete store into place, replacing any store already there
+    :param source: directory of the new store
+    :param destination: directory to move it to
+    """
+    if os.path.isdir(destination):
+        old = '{}.{}.old'.format(destination, os.getpid())
+        os.rename(destination, old)
+        os.rename(source, destination)
+        shutil.rmtree(old, ignore_errors=True)
+    else:
+        os.rename(source, destination)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import subprocess
+import struct
+import shutil
+import gzip
+import zlib
+import os
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+__author__ = 'adamkoziol', 'andrewlow'
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+# Extensions of compressed files, which are not part of the strain name
+COMPRESSION_EXTENSIONS = ('.gz', '.bgz', '.zst', '.zstd')
+# Number of bytes of decompressed data to read at a time
+CHUNK_SIZE = 1048576
+
+
+def compression(path):
+    """
+    Determine the compression of a file from its contents, rather than its extension
+    :param path: path of the file
+    :return: 'bgzf' (blocked gzip, as written by bgzip), 'gzip', 'zstd', or None if the file is not compressed
+    """
+    with open(path, 'rb') as handle:
+        header = handle.read(18)
+    if header.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    if not header.startswith(GZIP_MAGIC):
+        return None
+    # BGZF blocks are gzip members with a BC extra field holding the size of the block
+    if len(header) == 18 and header[3] & 4 and header[12:14] == b'BC':
+        return 'bgzf'
+    return 'gzip'
+
+
+def strip_extension(file_name):
+    """
+    :param file_name: name of a file e.g. strain_name.fasta.gz
+    :return: the name without any compression extension e.g. strain_name.fasta
+    """
+    for extension in COMPRESSION_EXTENSIONS:
+        if file_name.endswith(extension):
+            return file_name[:-len(extension)]
+    return file_name
+
+
+def read_chunks(path, chunk_size=CHUNK_SIZE, threads=1):
+    """
+    Stream the decompressed contents of a file, which may be uncompressed, gzip, bgzip, or zstd compressed
+    :param path: path of the file
+    :param chunk_size: approximate number of bytes to yield at a time
+    :param threads: number of threads to decompress the blocks of bgzip files with
+    :return: generator of chunks of the decompressed contents (bytes)
+    """
+    method = compression(path)
+    if method == 'bgzf':
+        with open(path, 'rb') as handle:
+            yield from bgzf_chunks(handle, chunk_size=chunk_size, threads=threads)
+    elif method == 'zstd':
+        yield from zstd_chunks(path, chunk_size=chunk_size)
+    else:
+        with (gzip.open(path, 'rb') if method == 'gzip' else open(path, 'rb')) as handle:
+            yield from iter(lambda: handle.read(chunk_size), b'')
+
+
+def read_bgzf_block(handle):
+    """
+    Read the next compressed block of a BGZF file
+    :param handle: binary file handle
+    :return: tuple of the raw deflate data, CRC32, and size of the decompressed block, or None at the end of the file
+    """
+    header = handle.read(12)
+    if not header:
+        return None
+    if len(header) < 12 or not header.startswith(GZIP_MAGIC):
+        raise ValueError('Invalid BGZF block header')
+    extra = handle.read(struct.unpack('<H', header[10:12])[0])
+    # Find the BC subfield, which holds the total size of the block minus one
+    position = 0
+    block_size = None
+    while position + 4 <= len(extra):
+        subfield_length = struct.unpack('<H', extra[position + 2:position + 4])[0]
+        if extra[position:position + 2] == b'BC':
+            block_size = struct.unpack('<H', extra[position + 4:position + 6])[0] + 1
+        position += 4 + subfield_length
+    if block_size is None:
+        raise ValueError('BGZF block without a block size')
+    remainder = handle.read(block_size - 12 - len(extra))
+    if len(remainder) != block_size - 12 - len(extra):
+        raise ValueError('Truncated BGZF block')
+    crc, size = struct.unpack('<II', remainder[-8:])
+    return remainder[:-8], crc, size
+
+
+def inflate_block(block):
+    """
+    Decompress a single BGZF block. zlib releases the GIL, so blocks can be decompressed by several threads at once
+    :param block: tuple returned by read_bgzf_block
+    :return: decompressed data
+    """
+    data, crc, size = block
+    decompressed = zlib.decompress(data, -15)
+    if len(decompressed) != size or zlib.crc32(decompressed) != crc:
+        raise ValueError('Corrupt BGZF block')
+    return decompressed
+
+
+def inflate_blocks(blocks):
+    """
+    :param blocks: list of tuples returned by read_bgzf_block
+    :return: decompressed data of all the blocks
+    """
+    return b''.join(inflate_block(block) for block in blocks)
+
+
+def bgzf_chunks(handle, chunk_size=CHUNK_SIZE, threads=1, blocks_per_task=16):
+    """
+    Decompress a BGZF file. Each block is an independent deflate stream, so runs of blocks are decompressed in
+    parallel, while the data is still yielded in file order
+    :param handle: binary file handle
+    :param chunk_size: number of bytes of compressed blocks to read at a time when decompressing in a single thread
+    :param threads: number of threads to decompress blocks with
+    :param blocks_per_task: number of consecutive blocks each thread decompresses at a time. A block holds at most
+    64 kB, which is too little to be worth handing to another thread on its own
+    :return: generator of chunks of the decompressed contents
+    """
+    if threads <= 1:
+        blocks = list()
+        blocks_size = 0
+        for block in iter(lambda: read_bgzf_block(handle), None):
+            blocks.append(block)
+            blocks_size += len(block[0])
+            if blocks_size >= chunk_size:
+                yield inflate_blocks(blocks)
+                blocks = list()
+                blocks_size = 0
+        if blocks:
+            yield inflate_blocks(blocks)
+        return
+    executor = ThreadPoolExecutor(max_workers=threads)
+    # Keep a couple of tasks queued for each thread, and yield the results in order
+    pending = deque()
+    try:
+        blocks = list()
+        for block in iter(lambda: read_bgzf_block(handle), None):
+            blocks.append(block)
+            if len(blocks) == blocks_per_task:
+                pending.append(executor.submit(inflate_blocks, blocks))
+                blocks = list()
+                if len(pending) > threads * 2:
+                    yield pending.popleft().result()
+        if blocks:
+            pending.append(executor.submit(inflate_blocks, blocks))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def zstd_chunks(path, chunk_size=CHUNK_SIZE):
+    """
+    Decompress a zstd file with the zstandard package if it is installed, or the zstd executable otherwise
+    :param path: path of the file
+    :param chunk_size: number of bytes to yield at a time
+    :return: generator of chunks of the decompressed contents
+    """
+    if zstandard is not None:
+        with open(path, 'rb') as handle:
+            reader = zstandard.ZstdDecompressor().stream_reader(handle, read_across_frames=True)
+            yield from iter(lambda: reader.read(chunk_size), b'')
+        return
+    if shutil.which('zstd') is None:
+        raise ImportError('Reading zstd-compressed files requires the zstandard package, or the zstd executable')
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen(['zstd', '-dcq', path], stdout=subprocess.PIPE, stderr=devnull)
+        try:
+            with process.stdout:
+                yield from iter(lambda: process.stdout.read(chunk_size), b'')
+            process.wait()
+        finally:
+            # Only reached with zstd still running if the caller stopped reading early
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+    if process.returncode:
+        raise ValueError('Could not decompress {}'.format(path))
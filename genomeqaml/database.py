@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+from datetime import datetime, timezone
+from genomeqaml import cache, extract_features
+import argparse
+import sqlite3
+import csv
+import sys
+import os
+__author__ = 'adamkoziol', 'andrewlow'
+
+# Columns of the feature report stored in the features table, other than the sample name and genus
+FEATURE_COLUMNS = [column for column in extract_features.FEATURE_COLUMNS if column not in ('SampleName', 'Genus')]
+PREDICTION_COLUMNS = ['sample', 'digest', 'genus', 'prediction', 'percent_fail', 'percent_pass', 'percent_ref',
+                      'model_digest', 'created']
+
+
+def quote(column):
+    # Feature names include characters such as > and %, so they are always quoted
+    return '"{}"'.format(column.replace('"', '""'))
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS features (
+    id INTEGER PRIMARY KEY,
+    sample TEXT NOT NULL,
+    digest TEXT,
+    genus TEXT,
+    folder TEXT,
+    created TEXT NOT NULL,
+    {features},
+    UNIQUE (sample, digest)
+);
+CREATE INDEX IF NOT EXISTS features_sample ON features (sample);
+CREATE INDEX IF NOT EXISTS features_digest ON features (digest);
+CREATE INDEX IF NOT EXISTS features_genus ON features (genus, created);
+CREATE TABLE IF NOT EXISTS predictions (
+    id INTEGER PRIMARY KEY,
+    sample TEXT NOT NULL,
+    digest TEXT,
+    genus TEXT,
+    prediction TEXT NOT NULL,
+    percent_fail REAL,
+    percent_pass REAL,
+    percent_ref REAL,
+    model_digest TEXT,
+    created TEXT NOT NULL,
+    UNIQUE (sample, digest, model_digest)
+);
+CREATE INDEX IF NOT EXISTS predictions_sample ON predictions (sample);
+CREATE INDEX IF NOT EXISTS predictions_digest ON predictions (digest);
+CREATE INDEX IF NOT EXISTS predictions_genus ON predictions (genus, created);
+CREATE INDEX IF NOT EXISTS predictions_prediction ON predictions (prediction, created);
+""".format(features=',\n    '.join('{} {}'.format(quote(column), 'REAL' if column == 'GC%' else 'INTEGER')
+                                   for column in FEATURE_COLUMNS))
+
+
+def timestamp(when=None):
+    """
+    :param when: datetime, or date string. Defaults to now
+    :return: UTC timestamp string, which sorts chronologically
+    """
+    if when is None:
+        when = datetime.now(timezone.utc)
+    if isinstance(when, datetime):
+        if when.tzinfo is not None:
+            when = when.astimezone(timezone.utc)
+        return when.strftime('%Y-%m-%d %H:%M:%S')
+    return str(when)
+
+
+def sample_digests(sequencepath, sample_names):
+    """
+    :param sequencepath: path of folder containing FASTA genomes
+    :param sample_names: strain names of the samples to calculate the digest of
+    :return: dictionary of strain name: digest of the FASTA contents, for each sample with a FASTA file in the folder
+    """
+    file_dict = extract_features.filer(extract_features.find_files(sequencepath))
+    return {sample_name: cache.file_digest(file_dict[sample_name]) for sample_name in sample_names
+            if sample_name in file_dict}
+
+
+def genus_name(genus):
+    # Genera that could not be determined are missing (NaN) once read with pandas
+    return genus if isinstance(genus, str) else 'NA'
+
+
+class ResultsDatabase(object):
+    """
+    SQLite database of extracted features and predictions. A sample is recorded once for each FASTA digest (and model,
+    for predictions), so repeated runs over the same samples replace their earlier results instead of adding to them
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path of the database file. Created if it does not exist
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def add_features(self, rows, digests=None, folder=None, created=None):
+        """
+        Insert the feature rows of a group of samples in a single transaction
+        :param rows: list of dictionaries of report column: value
+        :param digests: optional dictionary of strain name: digest of the FASTA contents
+        :param folder: optional folder that the samples are in. Without digests, the digests of the FASTA files in the
+        folder are calculated, which reads every file again - pass the digests when the caller already has them
+        :param created: time of the results. Defaults to now
+        """
+        if digests is None and folder is not None:
+            digests = sample_digests(folder, [row['SampleName'] for row in rows])
+        digests = digests or dict()
+        folder = os.path.abspath(folder) if folder is not None else None
+        created = timestamp(created)
+        columns = ['sample', 'digest', 'genus', 'folder', 'created'] + FEATURE_COLUMNS
+        statement = 'INSERT OR REPLACE INTO features ({}) VALUES ({})'.format(', '.join(map(quote, columns)),
+                                                                             ', '.join('?' * len(columns)))
+        with self.connection:
+            self.connection.executemany(statement, [
+                [row['SampleName'], digests.get(row['SampleName']), genus_name(row['Genus']), folder, created] +
+                [row[column] for column in FEATURE_COLUMNS] for row in rows])
+
+    def add_predictions(self, results, genera=None, digests=None, model_digest=None, folder=None, created=None):
+        """
+        Insert the predictions of a group of samples in a single transaction
+        :param results: list of tuples of strain name, predicted class, and percent probabilities of fail, pass, and
+        reference, as returned by classify.classify_features
+        :param genera: optional dictionary of strain name: genus
+        :param digests: optional dictionary of strain name: digest of the FASTA contents
+        :param model_digest: optional digest of the model that made the predictions
+        :param folder: optional folder that the samples are in. Without digests, the digests of the FASTA files in the
+        folder are calculated, which reads every file again - pass the digests when the caller already has them
+        :param created: time of the predictions. Defaults to now
+        """
+        if digests is None and folder is not None:
+            digests = sample_digests(folder, [result[0] for result in results])
+        genera = genera or dict()
+        digests = digests or dict()
+        created = timestamp(created)
+        statement = 'INSERT OR REPLACE INTO predictions ({}) VALUES ({})'.format(
+            ', '.join(PREDICTION_COLUMNS), ', '.join('?' * len(PREDICTION_COLUMNS)))
+        with self.connection:
+            self.connection.executemany(statement, [
+                (sample_name, digests.get(sample_name), genus_name(genera.get(sample_name)), prediction, fail_prob,
+                 pass_prob, ref_prob, model_digest, created)
+                for sample_name, prediction, fail_prob, pass_prob, ref_prob in results])
+
+    def query(self, table, sample=None, digest=None, genus=None, prediction=None, since=None, until=None):
+        """
+        Find results matching all of the given criteria
+        :param table: 'features' or 'predictions'
+        :param sample: strain name
+        :param digest: digest of the FASTA contents
+        :param genus: genus
+        :param prediction: predicted class (Fail, Pass, or Reference). Only for predictions
+        :param since: datetime or date string of the earliest results to include
+        :param until: datetime or date string. Only results from before this time are included
+        :return: list of dictionaries of column: value, oldest first
+        """
+        if table not in ('features', 'predictions'):
+            raise ValueError('Unknown table {}'.format(table))
+        conditions = list()
+        parameters = list()
+        for column, value in (('sample', sample), ('digest', digest), ('genus', genus), ('prediction', prediction)):
+            if value is not None:
+                conditions.append('{} = ?'.format(column))
+                parameters.append(value)
+        if since is not None:
+            conditions.append('created >= ?')
+            parameters.append(timestamp(since))
+        if until is not None:
+            conditions.append('created < ?')
+            parameters.append(timestamp(until))
+        statement = 'SELECT * FROM {}{} ORDER BY created, id'.format(
+            table, ' WHERE ' + ' AND '.join(conditions) if conditions else '')
+        return [dict(row) for row in self.connection.execute(statement, parameters)]
+
+    def features(self, **criteria):
+        """
+        :param criteria: sample, digest, genus, since, and/or until, as for query
+        :return: list of dictionaries of column: value
+        """
+        return self.query('features', **criteria)
+
+    def predictions(self, **criteria):
+        """
+        :param criteria: sample, digest, genus, prediction, since, and/or until, as for query
+        :return: list of dictionaries of column: value
+        """
+        return self.query('predictions', **criteria)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query a GenomeQAML results database. For example, all the Fail '
+                                                 'calls for Listeria since May 2024: '
+                                                 '-p Fail -g Listeria --since 2024-05-01')
+    parser.add_argument('database',
+                        help='Path of the results database.')
+    parser.add_argument('-t', '--table',
+                        choices=['predictions', 'features'],
+                        default='predictions',
+                        help='Table to query. Default is predictions.')
+    parser.add_argument('-s', '--sample',
+                        help='Strain name.')
+    parser.add_argument('-g', '--genus',
+                        help='Genus.')
+    parser.add_argument('-p', '--prediction',
+                        choices=['Fail', 'Pass', 'Reference'],
+                        help='Predicted class.')
+    parser.add_argument('--since',
+                        help='Only include results from this time (UTC) onwards e.g. 2024-05-01.')
+    parser.add_argument('--until',
+                        help='Only include results from before this time (UTC).')
+    args = parser.parse_args()
+    with ResultsDatabase(args.database) as database:
+        criteria = {'sample': args.sample, 'genus': args.genus, 'since': args.since, 'until': args.until}
+        if args.table == 'predictions':
+            criteria['prediction'] = args.prediction
+        results = database.query(args.table, **criteria)
+    if results:
+        writer = csv.DictWriter(sys.stdout, fieldnames=list(results[0]))
+        writer.writeheader()
+        writer.writerows(results)
@@ -1,62 +1,454 @@
 #!/usr/bin/env python3
-from genewrappers.biotools import mash
-from Bio.SeqUtils import GC
-import multiprocessing
-from Bio import SeqIO
+from genomeqaml import cache, columnar, compression, instrument, resources, tools
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import namedtuple
 from glob import glob
+import itertools
 import subprocess
-import shutil
-import click
-import time
+import tempfile
+import io
+import json
+import csv
 import os
 __author__ = 'adamkoziol', 'andrewlow'
 
+# Columns of the feature report. The contig and ORF columns are the size range frequencies, largest sizes first
+CONTIG_COLUMNS = ['Contigs>1000000', 'Contigs>500000', 'Contigs>100000', 'Contigs>50000', 'Contigs>10000',
+                  'Contigs>5000', 'Contigs<5000']
+ORF_COLUMNS = ['TotalORFs', 'ORFs>3000', 'ORFs>1000', 'ORFs>500', 'ORFs<500']
+FEATURE_COLUMNS = ['SampleName', 'TotalLength', 'NumContigs', 'LongestContig'] + CONTIG_COLUMNS + ORF_COLUMNS + \
+    ['N50', 'N75', 'N90', 'L50', 'L75', 'L90', 'GC%', 'Genus']
+# Type of each column in the columnar feature store. Everything other than the name, GC%, and genus is an integer
+FEATURE_TYPES = [(column, columnar.STRING if column in ('SampleName', 'Genus') else '<f8' if column == 'GC%' else '<i8')
+                 for column in FEATURE_COLUMNS]
+# Feature report in CSV format, and in columnar format
+REPORT_FILE = 'extracted_features.csv'
+REPORT_STORE = 'extracted_features.columns'
+# Index of the size, modification time, and digest of the FASTA file of each sample in the feature report
+REPORT_INDEX = 'extracted_features.index.json'
+# prodigal exits with an error for samples shorter than it can train on. Such samples have no ORFs
+PRODIGAL_MIN_LENGTH = 20000
+# Number of samples compared to the sketch by each mash dist of the batch genus method, and the largest mash distance
+# of a reference that is reported, which matches the 0.95 identity cutoff of mash screen
+GENUS_BATCH_SIZE = 50
+MAX_DISTANCE = 0.05
+# Contig sizes separating the bins of the contig size range frequencies, smallest first
+CONTIG_BIN_EDGES = [5000, 10000, 50000, 100000, 500000, 1000000]
+# Composition of the sequence of a FASTA file, as found by fasta_map_scan. The first three fields match fasta_scan
+SequenceScan = namedtuple('SequenceScan', ['contig_lengths', 'gc_count', 'total_length', 'n_count', 'soft_masked'])
+# Bytes that are ignored within sequence lines
+WHITESPACE = b' \t\r\n'
 
-def main(sequencepath, report, refseq_database, num_threads=12):
+
+def main(sequencepath, report, refseq_database, num_threads=12, genus_method='mash', tool_threads=None,
+         cache_dir=None, cache_size=cache.DEFAULT_CACHE_SIZE, incremental=False, batch_size=None, report_format='csv',
+         results_db=None, instrumentation=None, tool_runner=None, failures=None, orf_method='prodigal', digests=None):
     """
     Run the appropriate functions in order
     :param sequencepath: path of folder containing FASTA genomes
     :param report: boolean to determine whether a report is to be created
     :param refseq_database: Path to reduced refseq database sketch
-    :param num_threads: Number of threads to run mash/other stuff on
+    :param num_threads: Total number of CPUs to use for mash/other stuff
+    :param genus_method: 'mash' to screen samples with the mash executable, 'batch' to compare batches of samples to the
+    sketch with a single mash dist each, or 'minhash' to screen them in-process
+    :param tool_threads: Number of threads to give each external tool. By default, CPUs not needed to process every
+    sample at once are shared between the tools
+    :param cache_dir: optional directory in which to cache the rows of samples between runs
+    :param cache_size: maximum size of the cache in bytes
+    :param incremental: boolean to determine whether only new or changed samples are added to an existing report
+    :param batch_size: write the rows to the report batch_size samples at a time, rather than keeping every row until
+    all the samples are complete, so that memory use does not grow with the number of samples. Requires report
+    :param report_format: 'csv', 'columns' (columnar feature store), or 'both'
+    :param results_db: optional path of a SQLite results database to record the rows of the report in
+    :param instrumentation: optional instrument.Recorder to measure the run, each stage of every sample, and the
+    writing of the report with
+    :param tool_runner: optional tools.ToolRunner with the time limit and retries of mash and prodigal
+    :param failures: optional dictionary to record the samples whose tools failed in, as strain name: reason. These
+    samples are left out of the report
+    :param orf_method: 'prodigal' to predict ORFs with the prodigal executable, or 'orfscan' to find them in-process
+    with the faster, approximate orfscan module
+    :param digests: optional dictionary to record the digest of the FASTA contents of each sample in, as strain name:
+    digest. The digests are also recorded whenever a results database or incremental report needs them
     :return: gc_dict, contig_dist_dict, longest_contig_dict, genome_length_dict, num_contigs_dict, n50_dict, n75_dict, \
-        n90_dict, l50_dict, l75_dict, l90_dict, orf_dist_dict
+        n90_dict, l50_dict, l75_dict, l90_dict, orf_dist_dict. None if batch_size is set, as the rows are not kept
+    """
+    with instrument.stage(instrumentation, 'extract_features'):
+        files = find_files(sequencepath)
+        file_dict = filer(files)
+        rows = list()
+        if digests is None and report and (results_db or incremental):
+            digests = dict()
+        if report and incremental:
+            # Keep the rows of unchanged samples, and only extract the rest
+            rows, file_dict, index = plan_update(file_dict, sequencepath)
+            print('{} samples are unchanged since the last report'.format(len(rows)))
+            digests.update((file_name, state['digest']) for file_name, state in index.items())
+        print('Extracting features from {} samples'.format(len(file_dict)))
+        feature_cache = open_feature_cache(cache_dir, refseq_database, genus_method, cache_size, orf_method)
+        failures = failures if failures is not None else dict()
+        # Each sample is processed as soon as there is a free worker, and its row is returned once it is complete
+        samples = extract_samples(file_dict,
+                                  refseq_database=refseq_database,
+                                  num_threads=num_threads,
+                                  genus_method=genus_method,
+                                  tool_threads=tool_threads,
+                                  feature_cache=feature_cache,
+                                  instrumentation=instrumentation,
+                                  tool_runner=tool_runner,
+                                  failures=failures,
+                                  orf_method=orf_method,
+                                  digests=digests)
+        results_database = open_results_database(results_db) if report else None
+        try:
+            if report and batch_size:
+                # Rows are written to the report as they are extracted, and are not kept
+                write_report(itertools.chain(rows, (row for _, row in samples)), sequencepath, batch_size=batch_size,
+                             report_format=report_format, results_database=results_database,
+                             instrumentation=instrumentation, digests=digests)
+                rows = None
+            else:
+                rows.extend(row for _, row in samples)
+                if report:
+                    write_report(rows, sequencepath, report_format=report_format, results_database=results_database,
+                                 instrumentation=instrumentation, digests=digests)
+        finally:
+            if results_database is not None:
+                results_database.close()
+        if report and incremental:
+            # Record the state of the newly extracted samples, so that they are skipped next time. Samples that failed
+            # are not in the report, and are tried again. Their digests were calculated as they were extracted
+            for file_name, fasta in file_dict.items():
+                if file_name not in failures:
+                    index[file_name] = file_state(fasta)
+                    index[file_name]['digest'] = digests[file_name]
+            write_index(index, sequencepath)
+        if failures:
+            print('Features could not be extracted from {} samples: {}'.format(len(failures),
+                                                                             ', '.join(sorted(failures))))
+        print('Features extracted!')
+        return rows_to_dicts(rows) if rows is not None else None
+
+
+def extract_folders(sequencepaths, refseq_database, report=True, num_threads=12, genus_method='mash',
+                    tool_threads=None, cache_dir=None, cache_size=cache.DEFAULT_CACHE_SIZE, report_format='csv',
+                    results_db=None, tool_runner=None, failures=None, orf_method='prodigal'):
+    """
+    Extract the features of the samples of several folders at once. The samples of every folder share a single pool
+    of workers, so the tools of one folder overlap with those of the next, rather than each folder being processed in
+    turn
+    :param sequencepaths: list of paths of folders containing FASTA genomes
+    :param refseq_database: Path to reduced refseq database sketch
+    :param report: boolean to determine whether a report is to be created in each folder
+    :param num_threads: Total number of CPUs to use
+    :param genus_method: 'mash' to screen samples with the mash executable, 'batch' to compare batches of samples to the
+    sketch with a single mash dist each, or 'minhash' to screen them in-process
+    :param tool_threads: Number of threads to give each external tool
+    :param cache_dir: optional directory in which to cache the rows of samples between runs
+    :param cache_size: maximum size of the cache in bytes
+    :param report_format: 'csv', 'columns' (columnar feature store), or 'both'
+    :param results_db: optional path of a SQLite results database to record the rows of the reports in
+    :param tool_runner: optional tools.ToolRunner with the time limit and retries of mash and prodigal
+    :param failures: optional dictionary to record the samples whose tools failed in, as (folder, strain name): reason
+    :param orf_method: 'prodigal' to predict ORFs with the prodigal executable, or 'orfscan' to find them in-process
+    with the faster, approximate orfscan module
+    :return: dictionary of folder: list of dictionaries of report column: value, sorted by strain name
     """
-    files = find_files(sequencepath)
-    file_dict = filer(files)
-    print('Using MASH to determine genera of samples')
-    genus_dict = find_genus(files=file_dict,
-                            database=refseq_database,
-                            sequencepath=sequencepath,
-                            threads=num_threads)
-    file_records = fasta_records(file_dict)
-    print('Collecting basic quality metrics')
-    contig_len_dict, gc_dict = fasta_stats(file_dict, file_records)
-    contig_dist_dict = find_contig_distribution(contig_len_dict)
-    longest_contig_dict = find_largest_contig(contig_len_dict)
-    genome_length_dict = find_genome_length(contig_len_dict)
-    num_contigs_dict = find_num_contigs(contig_len_dict)
-    n50_dict = find_n50(contig_len_dict, genome_length_dict)
-    n75_dict = find_n75(contig_len_dict, genome_length_dict)
-    n90_dict = find_n90(contig_len_dict, genome_length_dict)
-    l50_dict = find_l50(contig_len_dict, genome_length_dict)
-    l75_dict = find_l75(contig_len_dict, genome_length_dict)
-    l90_dict = find_l90(contig_len_dict, genome_length_dict)
-    print('Using prodigal to calculate number of ORFs in each sample')
-    orf_file_dict = predict_orfs(file_dict, num_threads=num_threads)
-    orf_dist_dict = find_orf_distribution(orf_file_dict)
-    if report:
-        reporter(gc_dict, contig_dist_dict, longest_contig_dict, genome_length_dict, num_contigs_dict, n50_dict,
-                 n75_dict, n90_dict, l50_dict, l75_dict, l90_dict, orf_dist_dict, genus_dict, sequencepath)
+    # Strain names are only unique within a folder, so samples are keyed by the position of their folder as well
+    file_dict = dict()
+    samples = dict()
+    for i, sequencepath in enumerate(sequencepaths):
+        for file_name, fasta in filer(find_files(sequencepath)).items():
+            key = '{}.{}'.format(i, file_name)
+            file_dict[key] = fasta
+            samples[key] = (sequencepath, file_name)
+    print('Extracting features from {} samples in {} folders'.format(len(file_dict), len(sequencepaths)))
+    folder_rows = {sequencepath: list() for sequencepath in sequencepaths}
+    sample_failures = dict()
+    sample_digests = dict() if report and results_db else None
+    for key, row in extract_samples(file_dict,
+                                    refseq_database=refseq_database,
+                                    num_threads=num_threads,
+                                    genus_method=genus_method,
+                                    tool_threads=tool_threads,
+                                    feature_cache=open_feature_cache(cache_dir, refseq_database, genus_method,
+                                                                     cache_size, orf_method),
+                                    tool_runner=tool_runner,
+                                    failures=sample_failures,
+                                    orf_method=orf_method,
+                                    digests=sample_digests):
+        sequencepath, row['SampleName'] = samples[key]
+        folder_rows[sequencepath].append(row)
+    if failures is not None:
+        failures.update((samples[key], reason) for key, reason in sample_failures.items())
+    results_database = open_results_database(results_db) if report else None
+    try:
+        for sequencepath, rows in folder_rows.items():
+            rows.sort(key=lambda feature_row: feature_row['SampleName'])
+            if report:
+                digests = {samples[key][1]: digest for key, digest in sample_digests.items()
+                           if samples[key][0] == sequencepath} if sample_digests is not None else None
+                write_report(rows, sequencepath, report_format=report_format, results_database=results_database,
+                             digests=digests)
+    finally:
+        if results_database is not None:
+            results_database.close()
     print('Features extracted!')
-    return gc_dict, contig_dist_dict, longest_contig_dict, genome_length_dict, num_contigs_dict, n50_dict, n75_dict, \
-        n90_dict, l50_dict, l75_dict, l90_dict, orf_dist_dict
+    return folder_rows
+
+
+def open_results_database(results_db):
+    """
+    :param results_db: path of a SQLite results database, or None
+    :return: database.ResultsDatabase, or None if there is no path
+    """
+    if results_db is None:
+        return None
+    # Imported here, as the database module depends on this one
+    from genomeqaml import database
+    return database.ResultsDatabase(results_db)
+
+
+def open_feature_cache(cache_dir, refseq_database, genus_method='mash', cache_size=cache.DEFAULT_CACHE_SIZE,
+                       orf_method='prodigal'):
+    """
+    :param cache_dir: directory of the cache. May be None
+    :param refseq_database: Path to reduced refseq database sketch
+    :param genus_method: method used to determine genera
+    :param cache_size: maximum size of the cache in bytes
+    :param orf_method: method used to find ORFs
+    :return: FeatureCache for the extraction context, or None if there is no cache directory
+    """
+    if not cache_dir:
+        return None
+    return cache.FeatureCache(cache_dir,
+                              context=cache.cache_context(refseq_database, genus_method, orf_method),
+                              max_size=cache_size)
+
+
+def extract_samples(file_dict, refseq_database, num_threads=12, genus_method='mash', tool_threads=None,
+                    feature_cache=None, instrumentation=None, tool_runner=None, failures=None, orf_method='prodigal',
+                    executor=None, digests=None):
+    """
+    Extract the features of each sample as a small pipeline: the FASTA statistics are collected first, then the genus
+    and ORF prediction tasks are run, and finally the feature row is assembled. The tasks of all the samples share a
+    single pool of workers, so the external tools of different samples overlap, and the row of each sample is yielded
+    as soon as it is complete. New samples are only started as earlier samples progress, so rows are available early.
+    Compressed samples are instead decompressed once by a single task, which streams them to every consumer at once.
+    With the batch genus method, samples wait for their genus until a batch is full, or until no more samples can join
+    it soon, and the batch is then compared to the sketch by a single mash dist.
+    A sample whose tools fail is reported as soon as it fails, and left out, while the other samples carry on
+    :param file_dict: dictionary of strain name: /sequencepath/strain_name.extension
+    :param refseq_database: Path to reduced refseq database sketch
+    :param num_threads: Total number of CPUs to use. This is split between the number of concurrent tasks, and the
+    number of threads given to each external tool
+    :param genus_method: 'mash' to screen samples with the mash executable, 'batch' to compare batches of samples to the
+    sketch with a single mash dist each, or 'minhash' to screen them in-process
+    :param tool_threads: Number of threads to give each external tool. Calculated by split_cpus if not provided
+    :param feature_cache: optional FeatureCache. Samples found in the cache are not processed, and the rows of all other
+    samples are added to it
+    :param instrumentation: optional instrument.Recorder to measure each task of every sample with
+    :param tool_runner: optional tools.ToolRunner with the time limit and retries of mash and prodigal. By default,
+    tools are not time limited, and are retried once
+    :param failures: optional dictionary to record the samples whose tools failed in, as strain name: reason
+    :param orf_method: 'prodigal' to predict ORFs with the prodigal executable, or 'orfscan' to find them in-process
+    with the faster, approximate orfscan module
+    :param executor: optional concurrent.futures executor to run the tasks on, which may be shared with other calls so
+    that they stay within a single CPU budget. Its workers should be sized with resources.split_cpus, and tool_threads
+    given. By default, a pool of workers sized from num_threads is created for the call
+    :param digests: optional dictionary to record the digest of the FASTA contents of each sample in, as strain name:
+    digest. The digests calculated to look samples up in the feature cache are reused, so each file is only read once
+    for its digest
+    :return: generator of strain name, dictionary of report column: value
+    """
+    budget = resources.split_cpus(num_threads, num_samples=len(file_dict), tool_threads=tool_threads)
+    tool_runner = tool_runner or tools.ToolRunner()
+    if genus_method == 'minhash':
+        from genomeqaml import minhash
+        # Load the sketch before the workers start, so that it is only read once
+        minhash.load_index(refseq_database)
+    if orf_method == 'orfscan':
+        from genomeqaml import orfscan
+    samples = iter(sorted(file_dict.items()))
+    # Dictionary of future: (strain name, task name), and strain name: dictionary of completed task results
+    futures = dict()
+    results = dict()
+    # Samples waiting for the next mash dist of the batch genus method, and whether every sample has been started
+    genus_queue = list()
+    started = {'all': False}
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=budget.workers)
+
+    def submit(file_name, task, function, *args):
+        results[file_name]['pending'] += 1
+        if instrumentation is not None:
+            futures[executor.submit(instrumentation.call, task, file_name, function, *args)] = (file_name, task)
+        else:
+            futures[executor.submit(function, *args)] = (file_name, task)
+
+    def submit_batch():
+        batch = [sample for sample in genus_queue if sample[0] in results and 'failed' not in results[sample[0]]]
+        del genus_queue[:]
+        if not batch:
+            return
+        for file_name, _ in batch:
+            results[file_name]['pending'] += 1
+        arguments = (dist_genus, batch, refseq_database, budget.tool_threads, tool_runner)
+        if instrumentation is not None:
+            arguments = (instrumentation.call, 'genus_batch', None) + arguments
+        futures[executor.submit(*arguments)] = (batch, 'genus_batch')
+
+    def start_extraction(file_name, fasta):
+        if compression.compression(fasta) is not None:
+            # mash reads gzip and bgzip files itself, so the batch genus method finds their genus in a batch, rather
+            # than from the stream
+            batched = genus_method == 'batch' and compression.compression(fasta) != 'zstd'
+            submit(file_name, 'stream', stream_sample, fasta, None if batched else refseq_database, genus_method,
+                   budget.tool_threads, True, tool_runner, orf_method)
+        else:
+            submit(file_name, 'stats', sample_stats, fasta)
+
+    def start_sample():
+        try:
+            file_name, fasta = next(samples)
+        except StopIteration:
+            started['all'] = True
+            return
+        results[file_name] = {'fasta': fasta, 'pending': 0}
+        if feature_cache is not None:
+            submit(file_name, 'lookup', feature_cache.lookup, fasta, file_name)
+        elif digests is not None:
+            submit(file_name, 'lookup', uncached_lookup, fasta)
+        else:
+            start_extraction(file_name, fasta)
+
+    def completed(future, key, task):
+        """
+        :return: list of strain name, task name, and a future holding the result of the task for the sample. A batch
+        of genera holds a result for each sample of the batch
+        """
+        if task != 'genus_batch':
+            return [(key, task, future)]
+        outcomes = list()
+        for file_name, genus in future.result().items():
+            outcome = Future()
+            if isinstance(genus, tools.ToolError):
+                outcome.set_exception(genus)
+            else:
+                outcome.set_result((file_name, genus))
+            outcomes.append((file_name, 'genus', outcome))
+        return outcomes
+
+    try:
+        # Keep enough samples in flight to give every worker a task, and to fill a batch of the batch genus method
+        for _ in range(budget.workers * 2 + (GENUS_BATCH_SIZE if genus_method == 'batch' else 0)):
+            start_sample()
+        while futures or genus_queue:
+            # A batch is screened once it is full, or once no more samples can join it soon
+            if genus_queue and (len(genus_queue) >= GENUS_BATCH_SIZE or not futures or
+                                (started['all'] and all(task not in ('lookup', 'stats', 'stream')
+                                                        for _, task in futures.values()))):
+                submit_batch()
+                if not futures:
+                    continue
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                for file_name, task, outcome in completed(future, *futures.pop(future)):
+                    sample = results[file_name]
+                    sample['pending'] -= 1
+                    try:
+                        sample[task] = outcome.result()
+                    except tools.ToolError as error:
+                        if 'failed' not in sample:
+                            sample['failed'] = str(error)
+                            print('Features could not be extracted from {}: {}'.format(file_name, error))
+                            if failures is not None:
+                                failures[file_name] = str(error)
+                    if 'failed' in sample:
+                        # Wait for any other task of the sample to finish before moving on to the next sample
+                        if not sample['pending']:
+                            del results[file_name]
+                            start_sample()
+                        continue
+                    if task == 'lookup':
+                        digest, row = sample['lookup']
+                        if digests is not None:
+                            digests[file_name] = digest
+                        if row is None:
+                            start_extraction(file_name, sample['fasta'])
+                        else:
+                            del results[file_name]
+                            yield file_name, row
+                            start_sample()
+                        continue
+                    if task == 'stats':
+                        contig_lengths, _ = sample['stats']
+                        # Samples without any sequence have no genus or ORFs - don't run the tools on them
+                        if sum(contig_lengths):
+                            if genus_method == 'minhash':
+                                submit(file_name, 'genus', minhash_genus, file_name, sample['fasta'], refseq_database)
+                            elif genus_method == 'batch':
+                                genus_queue.append((file_name, sample['fasta']))
+                            else:
+                                submit(file_name, 'genus', screen_genus, (file_name, sample['fasta'], refseq_database,
+                                                                          budget.tool_threads), tool_runner)
+                            if orf_method != 'orfscan':
+                                submit(file_name, 'orfs', sample_orfs, sample['fasta'], tool_runner)
+                            elif sum(contig_lengths) < PRODIGAL_MIN_LENGTH:
+                                # Matches prodigal, which finds no ORFs in samples this short
+                                sample['orfs'] = (0, 0, 0, 0, 0)
+                            else:
+                                submit(file_name, 'orfs', orfscan.sample_orfs, sample['fasta'])
+                        else:
+                            sample['genus'] = (file_name, 'NA')
+                            sample['orfs'] = (0, 0, 0, 0, 0)
+                    if task == 'stream':
+                        sample['stats'], genus, orfs = sample['stream']
+                        contig_lengths, _ = sample['stats']
+                        if not sum(contig_lengths):
+                            sample['genus'] = (file_name, 'NA')
+                            sample['orfs'] = (0, 0, 0, 0, 0)
+                        else:
+                            sample['orfs'] = orfs
+                            if genus is None and genus_method == 'batch':
+                                genus_queue.append((file_name, sample['fasta']))
+                            else:
+                                sample['genus'] = (file_name, genus)
+                    if 'genus' in sample and 'orfs' in sample:
+                        del results[file_name]
+                        contig_lengths, gc = sample['stats']
+                        _, genus = sample['genus']
+                        row = feature_row(file_name, contig_lengths, gc, sample['orfs'], genus)
+                        if feature_cache is not None:
+                            digest, _ = sample['lookup']
+                            feature_cache.put(digest, row)
+                        yield file_name, row
+                        start_sample()
+    finally:
+        # If the caller stops early, don't start any more tasks
+        for future in futures:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait=True)
+        elif futures:
+            wait(futures)
+
+
+def uncached_lookup(fasta):
+    """
+    Calculate the digest of a FASTA file for a run without a feature cache, in the same form as
+    cache.FeatureCache.lookup
+    :param fasta: /sequencepath/strain_name.extension
+    :return: digest, row: digest of the FASTA contents, and None, as there is no cached row
+    """
+    return cache.file_digest(fasta), None
 
 
 def find_files(sequencepath):
     """
     Use glob to find all FASTA files in the provided sequence path. NOTE: FASTA files must have an extension such as
-    .fasta, .fa, or .fas. Extensions of .fsa, .tfa, ect. are not currently supported
+    .fasta, .fa, or .fas. Extensions of .fsa, .tfa, ect. are not currently supported. Files may be compressed with gzip,
+    bgzip, or zstd e.g. .fasta.gz
     :param sequencepath: path of folder containing FASTA genomes
     :return: list of FASTA files
     """
@@ -74,88 +466,337 @@ def filer(filelist):
     # Initialise the dictionary
     filedict = dict()
     for seqfile in filelist:
-        # Split off the file extension and remove the path from the name
-        strainname = os.path.splitext(os.path.basename(seqfile))[0]
+        # Split off the file extension (and any compression extension) and remove the path from the name
+        strainname = os.path.splitext(compression.strip_extension(os.path.basename(seqfile)))[0]
         # Populate the dictionary
         filedict[strainname] = seqfile
     return filedict
 
 
-def fasta_records(files):
+def find_genus(files, database, sequencepath=None, threads=12, workers=None, tool_runner=None):
     """
-    Use SeqIO to create dictionaries of all records for each FASTA file
-    :param files: dictionary of stain name: /sequencepath/strain_name.extension
-    :return: file_records: dictionary of all contig records for all strains
+    Uses MASH to find the genus of fasta files. mash screen pools all the queries passed to a single invocation, so
+    samples are instead screened by a small number of concurrent workers that share the available threads
+    :param files: File dictionary returned by filer method.
+    :param database: Path to reduced refseq database sketch.
+    :param sequencepath: Path to sequences. No longer used, as the screen output is read from the stdout of mash
+    :param threads: Total number of threads to run mash with.
+    :param workers: Number of concurrent mash screen processes. Defaults to one per thread, up to the number of files
+    :param tool_runner: optional tools.ToolRunner with the time limit and retries of mash
+    :return: genus_dict: Dictionary of genus for each sample. Will return NA if genus could not be found.
     """
-    # Initialise the dictionary
-    file_records = dict()
-    for file_name, fasta in files.items():
-        # Create a dictionary of records for each file
-        record_dict = SeqIO.to_dict(SeqIO.parse(fasta, "fasta"))
-        # Set the records dictionary as the value for file_records
-        file_records[file_name] = record_dict
-    return file_records
+    genus_dict = dict()
+    if not files:
+        return genus_dict
+    if workers is None:
+        workers = min(len(files), threads)
+    workers = max(1, min(workers, len(files)))
+    # Split the threads between the workers
+    mash_threads = max(1, threads // workers)
+    screen_args = [(file_name, fasta, database, mash_threads) for file_name, fasta in files.items()]
+    from multiprocessing.pool import ThreadPool
+    # The workers spend their time waiting on mash, so threads are sufficient
+    pool = ThreadPool(processes=workers)
+    try:
+        for file_name, genus in pool.imap_unordered(lambda args: screen_genus(args, tool_runner), screen_args):
+            genus_dict[file_name] = genus
+    finally:
+        pool.close()
+        pool.join()
+    return genus_dict
 
 
-def find_genus(files, database, sequencepath, threads=12):
+def find_genus_batch(files, database, threads=12, batch_size=GENUS_BATCH_SIZE, tool_runner=None):
     """
-    Uses MASH to find the genus of fasta files.
+    Find the genus of fasta files by comparing them to the sketch with mash dist, which reports each query separately,
+    rather than screening them one at a time as find_genus does. Each batch of samples is compared by a single mash
+    dist, so the sketch is loaded once per batch rather than once per sample. mash dist estimates the distance between
+    whole genomes rather than the containment that mash screen reports, so samples close to the identity cutoff may
+    be given a genus by one method and NA by the other
     :param files: File dictionary returned by filer method.
     :param database: Path to reduced refseq database sketch.
-    :param sequencepath: Path to sequences
     :param threads: Number of threads to run mash with.
+    :param batch_size: Number of samples to compare with each mash dist
+    :param tool_runner: optional tools.ToolRunner with the time limit and retries of mash
     :return: genus_dict: Dictionary of genus for each sample. Will return NA if genus could not be found.
     """
     genus_dict = dict()
-    tmpdir = os.path.join(sequencepath, str(time.time()).split('.')[-1])
-    if not os.path.isdir(tmpdir):
-        os.makedirs(tmpdir)
-    for file_name, fasta in files.items():
-        mash.screen(database, fasta,
-                    threads=threads,
-                    w='',
-                    i=0.95,
-                    output_file=os.path.join(tmpdir, 'screen.tab'))
-        screen_output = mash.read_mash_screen(os.path.join(tmpdir, 'screen.tab'))
-        try:
-            os.remove(os.path.join(tmpdir, 'screen.tab'))
-        except IOError:
-            pass
-        try:
-            genus = screen_output[0].query_id.split('/')[-3]
-            if genus == 'Shigella':
-                genus = 'Escherichia'
+    samples = sorted(files.items())
+    for start in range(0, len(samples), batch_size):
+        for file_name, genus in dist_genus(samples[start:start + batch_size], database, threads, tool_runner).items():
+            if isinstance(genus, tools.ToolError):
+                raise genus
             genus_dict[file_name] = genus
-        except IndexError:
-            genus_dict[file_name] = 'NA'
+    return genus_dict
+
+
+def dist_genus(batch, database, threads=1, tool_runner=None):
+    """
+    Find the genus of a batch of samples with a single mash dist against the sketch. The genus is that of the closest
+    reference within the same 0.95 identity cutoff as mash screen, taking one minus the mash distance as the identity.
+    If mash fails on the batch, each sample is compared on its own, so that only the samples that mash cannot read fail
+    :param batch: list of tuples of strain name, /sequencepath/strain_name.extension. Files may be compressed with gzip
+    or bgzip, which mash reads itself
+    :param database: Path to reduced refseq database sketch.
+    :param threads: Number of threads to run mash with.
+    :param tool_runner: optional tools.ToolRunner with the time limit and retries of mash
+    :return: dictionary of strain name: genus (NA if the genus could not be found), or the tools.ToolError raised for
+    the sample if it could not be compared
+    """
+    tool_runner = tool_runner or tools.ToolRunner()
+    try:
+        hits = tool_runner.run(['mash', 'dist', '-p', str(threads), '-d', str(MAX_DISTANCE), database] +
+                               [fasta for _, fasta in batch], read_dist)
+    except tools.ToolError as error:
+        if len(batch) == 1 or not error.retry:
+            return {file_name: error for file_name, _ in batch}
+        genus_dict = dict()
+        for sample in batch:
+            genus_dict.update(dist_genus([sample], database, threads, tool_runner))
+        return genus_dict
+    return {file_name: parse_genus(hits.get(fasta, list())) for file_name, fasta in batch}
+
+
+def screen_genus(screen_args, tool_runner=None):
+    """
+    Run mash screen on a single sample, and parse the genus from the best hit. The screen output is read from the
+    stdout of mash, so each sample needs no output file
+    :param screen_args: tuple of strain name, /sequencepath/strain_name.extension, path to the refseq database sketch,
+    and number of threads to run mash with
+    :param tool_runner: optional tools.ToolRunner with the time limit and retries of mash
+    :return: file_name, genus: strain name, and its genus (NA if the genus could not be found)
+    """
+    file_name, fasta, database, threads = screen_args
+    tool_runner = tool_runner or tools.ToolRunner()
+    if compression.compression(fasta) is not None:
+        # mash is fed the decompressed sequence on stdin
+        _, genus, _ = stream_sample(fasta, refseq_database=database, threads=threads, orfs=False,
+                                    tool_runner=tool_runner)
+        return file_name, genus
+    screen_output = tool_runner.run(['mash', 'screen', database, fasta, '-p', str(threads), '-w', '-i', '0.95'],
+                                    read_screen)
+    return file_name, parse_genus(screen_output)
+
 
-    shutil.rmtree(tmpdir)
+def find_genus_minhash(files, database):
+    """
+    Find the genus of fasta files by screening them in-process against the MASH sketch, rather than calling mash. The
+    sketch is only loaded once per process
+    :param files: File dictionary returned by filer method.
+    :param database: Path to reduced refseq database sketch.
+    :return: genus_dict: Dictionary of genus for each sample. Will return NA if genus could not be found.
+    """
+    genus_dict = dict()
+    for file_name, fasta in files.items():
+        _, genus_dict[file_name] = minhash_genus(file_name, fasta, database)
     return genus_dict
 
 
-def fasta_stats(files, records):
+def minhash_genus(file_name, fasta, database):
+    """
+    Find the genus of a single sample by screening it in-process against the MASH sketch
+    :param file_name: strain name
+    :param fasta: /sequencepath/strain_name.extension
+    :param database: Path to reduced refseq database sketch.
+    :return: file_name, genus: strain name, and its genus (NA if the genus could not be found)
+    """
+    from genomeqaml import minhash
+    return file_name, parse_genus(minhash.load_index(database).screen(fasta, min_identity=0.95))
+
+
+def parse_genus(screen_output):
+    """
+    Determine the genus from the best hit of sorted mash screen results
+    :param screen_output: list of mash screen results, sorted by identity
+    :return: genus: genus of the best hit. Shigella is reported as Escherichia, and NA is returned if there are no hits
+    """
+    try:
+        genus = screen_output[0].query_id.split('/')[-3]
+    except IndexError:
+        return 'NA'
+    if genus == 'Shigella':
+        genus = 'Escherichia'
+    return genus
+
+
+def fasta_scan(fasta, chunk_size=1048576, threads=1):
+    """
+    Stream through a FASTA file in large binary chunks, and collect the length of each contig, as well as the number of
+    G, C, and S bases in the file. No sequence objects are created, so memory use is independent of genome size.
+    Whitespace within sequence lines is ignored, and lowercase bases are counted in the same way as uppercase bases.
+    Compressed files are decompressed as they are read
+    :param fasta: /sequencepath/strain_name.extension
+    :param chunk_size: number of bytes to read from the file at a time
+    :param threads: number of threads to decompress bgzip files with
+    :return: contig_lengths, gc_count, total_length: list of the length of each contig (in file order), number of GC
+    bases, and the total number of bases in the file
+    """
+    scanner = FastaScanner()
+    for chunk in compression.read_chunks(fasta, chunk_size=chunk_size, threads=threads):
+        scanner.feed(chunk)
+    return scanner.result()
+
+
+def fasta_map_scan(fasta):
+    """
+    Memory-map an uncompressed FASTA file, and find the same contig lengths and GC count as fasta_scan with vectorised
+    operations on the raw bytes, along with the number of N bases and soft-masked (lowercase) bases. Header lines
+    are found from the positions of the line breaks, and bases are counted across the whole file, less the bytes of
+    the header lines, so the sequence is never copied or parsed
+    :param fasta: /sequencepath/strain_name.extension
+    :return: SequenceScan of the list of the length of each contig (in file order), number of GC bases, total number
+    of bases, number of N bases, and number of lowercase bases
+    """
+    import numpy as np
+    if not os.path.getsize(fasta):
+        return SequenceScan(list(), 0, 0, 0, 0)
+    data = np.memmap(fasta, dtype=np.uint8, mode='r')
+    size = data.size
+    newlines = np.flatnonzero(data == 10)
+    # A '>' at the start of a line begins a header, which runs to the end of the line
+    line_starts = np.concatenate(([0], newlines + 1))
+    line_starts = line_starts[line_starts < size]
+    headers = line_starts[data[line_starts] == 62]
+    if not headers.size:
+        return SequenceScan(list(), 0, 0, 0, 0)
+    header_ends = np.append(newlines, size)[np.searchsorted(newlines, headers)]
+    # The sequence of each contig lies between the end of its header and the start of the next header, and its
+    # length is the number of bytes in between, less any whitespace
+    sequence_starts = header_ends
+    sequence_ends = np.append(headers[1:], size)
+    # Only look up the few bytes that could be whitespace, rather than every byte
+    candidates = np.flatnonzero(data <= 32)
+    whitespace = candidates[np.isin(data[candidates], np.frombuffer(WHITESPACE, dtype=np.uint8))]
+    contig_lengths = (sequence_ends - sequence_starts) - (np.searchsorted(whitespace, sequence_ends) -
+                                                          np.searchsorted(whitespace, sequence_starts))
+    # Count the bases of the whole file, and remove those of the header lines, and any text before the first header
+    header_lengths = header_ends - headers
+    header_bytes = np.repeat(headers - np.cumsum(header_lengths) + header_lengths, header_lengths) + \
+        np.arange(header_lengths.sum())
+    excluded = np.concatenate((data[:headers[0]], data[header_bytes]))
+    gc_count, n_count, soft_masked = np.subtract(base_counts(data), base_counts(excluded)).tolist()
+    return SequenceScan([int(length) for length in contig_lengths], gc_count, int(contig_lengths.sum()), n_count,
+                        soft_masked)
+
+
+def base_counts(data):
+    """
+    :param data: array of bytes (uint8)
+    :return: gc_count, n_count, soft_masked: number of G, C, and S bases and of N bases (in either case), and number of
+    lowercase letters
+    """
+    import numpy as np
+    # Setting the 0x20 bit makes uppercase letters lowercase, and only G and g become g, and so on
+    folded = data | 32
+    gc_count = sum(int(np.count_nonzero(folded == base)) for base in b'gcs')
+    n_count = int(np.count_nonzero(folded == ord('n')))
+    soft_masked = int(np.count_nonzero(data >= ord('a'))) - int(np.count_nonzero(data > ord('z')))
+    return gc_count, n_count, soft_masked
+
+
+class FastaScanner(object):
+    """
+    Incremental version of fasta_scan, which is fed the contents of a FASTA file one chunk at a time, so that the
+    contents can be shared with other consumers as they are read
+    """
+
+    def __init__(self):
+        self.contig_lengths = list()
+        self.gc_count = 0
+        self.total_length = 0
+        # Length of the contig currently being parsed - None until the first header has been seen
+        self.current_length = None
+        # Track whether the current position is within a header line, and whether it is at the start of a line, as
+        # both headers and line breaks can be split across chunks
+        self.in_header = False
+        self.line_start = True
+
+    def feed(self, chunk):
+        """
+        :param chunk: the next chunk of the file (bytes)
+        """
+        position = 0
+        chunk_length = len(chunk)
+        while position < chunk_length:
+            if self.in_header:
+                # Skip to the end of the header line
+                end = chunk.find(b'\n', position)
+                if end == -1:
+                    break
+                self.in_header = False
+                self.line_start = True
+                position = end + 1
+            elif self.line_start and chunk[position] == 62:
+                # A '>' at the start of a line begins a new contig
+                if self.current_length is not None:
+                    self.contig_lengths.append(self.current_length)
+                self.current_length = 0
+                self.in_header = True
+                position += 1
+            else:
+                # The sequence continues until the next line that begins with '>'
+                end = chunk.find(b'\n>', position)
+                if end == -1:
+                    sequence = chunk[position:]
+                    self.line_start = chunk.endswith(b'\n')
+                    position = chunk_length
+                else:
+                    sequence = chunk[position:end + 1]
+                    self.line_start = True
+                    position = end + 1
+                # Any text before the first header is not part of a contig
+                if self.current_length is not None:
+                    sequence = sequence.translate(None, b' \t\r\n')
+                    sequence_length = len(sequence)
+                    self.current_length += sequence_length
+                    self.total_length += sequence_length
+                    self.gc_count += sequence_length - len(sequence.translate(None, b'GCSgcs'))
+
+    def result(self):
+        """
+        :return: contig_lengths, gc_count, total_length, as returned by fasta_scan
+        """
+        contig_lengths = list(self.contig_lengths)
+        if self.current_length is not None:
+            contig_lengths.append(self.current_length)
+        return contig_lengths, self.gc_count, self.total_length
+
+
+def sample_stats(fasta):
+    """
+    Parse the lengths of all contigs of a single sample, as well as its total GC%
+    :param fasta: /sequencepath/strain_name.extension
+    :return: contig_lengths, gc: reverse-sorted list of all contig lengths, and GC% formatted to two decimal places
+    """
+    if compression.compression(fasta) is None:
+        return scan_stats(*fasta_map_scan(fasta)[:3])
+    return scan_stats(*fasta_scan(fasta))
+
+
+def scan_stats(contig_lengths, gc_count, total_length):
+    """
+    :param contig_lengths: list of the length of each contig, as returned by fasta_scan
+    :param gc_count: number of GC bases
+    :param total_length: total number of bases
+    :return: contig_lengths, gc: reverse-sorted list of all contig lengths, and GC% formatted to two decimal places
+    """
+    # Calculate the GC% of the total genome sequence - format to have two decimal places
+    gc = float('{:0.2f}'.format(gc_count * 100.0 / total_length if total_length else 0.0))
+    # Sort the contig sizes in reverse order (e.g. largest to smallest)
+    return sorted(contig_lengths, reverse=True), gc
+
+
+def fasta_stats(files):
     """
     Parse the lengths of all contigs for each sample, as well as the total GC%
     :param files: dictionary of stain name: /sequencepath/strain_name.extension
-    :param records: Dictionary of strain name: SeqIO records
     :return: contig_len_dict, gc_dict: dictionaries of list of all contig length, and total GC% for all strains
     """
     # Initialise dictionaries
     contig_len_dict = dict()
     gc_dict = dict()
-    for file_name in files:
-        # Initialise variables to store appropriate values parsed from contig records
-        contig_lengths = list()
-        fasta_sequence = str()
-        for contig, record in records[file_name].items():
-            # Append the length of the contig to the list
-            contig_lengths.append(len(record.seq))
-            # Add the contig sequence to the string
-            fasta_sequence += record.seq
-        # Set the reverse sorted (e.g. largest to smallest) list of contig sizes as the value
-        contig_len_dict[file_name] = sorted(contig_lengths, reverse=True)
-        # Calculate the GC% of the total genome sequence using GC - format to have two decimal places
-        gc_dict[file_name] = float('{:0.2f}'.format(GC(fasta_sequence)))
+    for file_name, fasta in files.items():
+        contig_len_dict[file_name], gc_dict[file_name] = sample_stats(fasta)
     return contig_len_dict, gc_dict
 
 
@@ -168,53 +809,81 @@ def find_contig_distribution(contig_lengths_dict):
     # Initialise the dictionary
     contig_len_dist_dict = dict()
     for file_name, contig_lengths in contig_lengths_dict.items():
-        # Initialise integers to store the number of contigs that fall into the different bin sizes
-        over_1000000 = 0
-        over_500000 = 0
-        over_100000 = 0
-        over_50000 = 0
-        over_10000 = 0
-        over_5000 = 0
-        other = 0
-        for contig_length in contig_lengths:
-            # Depending on the size of the contig, increment the appropriate integer
-            if contig_length > 1000000:
-                over_1000000 += 1
-            elif contig_length > 500000:
-                over_500000 += 1
-            elif contig_length > 100000:
-                over_100000 += 1
-            elif contig_length > 50000:
-                over_50000 += 1
-            elif contig_length > 10000:
-                over_10000 += 1
-            elif contig_length > 5000:
-                over_5000 += 1
-            else:
-                other += 1
-        # Populate the dictionary with a tuple of each of the size range frequencies
-        contig_len_dist_dict[file_name] = (over_1000000,
-                                           over_500000,
-                                           over_100000,
-                                           over_50000,
-                                           over_10000,
-                                           over_5000,
-                                           other)
+        contig_len_dist_dict[file_name] = contig_distribution(contig_lengths)
     return contig_len_dist_dict
 
 
+def contig_distribution(contig_lengths):
+    """
+    Determine the frequency of different contig size ranges for a single strain
+    :param contig_lengths: list of all contig lengths
+    :return: tuple of the number of contigs over 1000000, 500000, 100000, 50000, 10000, and 5000 bp, and all others
+    """
+    import numpy as np
+    # The number of bin edges that are smaller than a contig gives the index of its bin, counting up from the smallest
+    bins = np.searchsorted(CONTIG_BIN_EDGES, np.asarray(contig_lengths, dtype=np.int64), side='left')
+    # Reverse the counts so that the largest contigs come first
+    return tuple(int(count) for count in np.bincount(bins, minlength=len(CONTIG_BIN_EDGES) + 1)[::-1])
+
+
+def contig_metrics(contig_lengths, thresholds=(50, 75, 90)):
+    """
+    Calculate the assembly metrics of a single strain from one cumulative sum of its contig lengths. For each threshold
+    x, Nx is the largest contig such that at least x% of the total genome size is contained in contigs equal to or
+    larger than this contig, and Lx is the number of contigs required to achieve the Nx
+    :param contig_lengths: reverse-sorted list (or array) of all contig lengths
+    :param thresholds: percentages of the total genome length for which to calculate Nx and Lx e.g. (25, 50, 95)
+    :return: metrics: dictionary of metric name: value e.g. TotalLength, NumContigs, LongestContig, N50, L50
+    """
+    import numpy as np
+    lengths = np.asarray(contig_lengths, dtype=np.int64)
+    # Running total of the contig lengths - the final entry is the total genome length
+    cumulative_lengths = np.cumsum(lengths)
+    total_length = int(cumulative_lengths[-1]) if lengths.size else 0
+    metrics = {'TotalLength': total_length,
+               'NumContigs': int(lengths.size),
+               # As the lengths are sorted in descending order, the largest contig is the first entry
+               'LongestContig': int(lengths[0]) if lengths.size else 0}
+    # Find the first contig at which the running total reaches each fraction of the genome length
+    targets = total_length * (np.asarray(thresholds, dtype=np.float64) / 100)
+    indices = np.minimum(np.searchsorted(cumulative_lengths, targets, side='left'), max(lengths.size - 1, 0))
+    for threshold, index in zip(thresholds, indices):
+        metrics['N{}'.format(threshold)] = int(lengths[index]) if lengths.size else 0
+        metrics['L{}'.format(threshold)] = int(index) + 1 if lengths.size else 0
+    return metrics
+
+
+def find_contig_metrics(contig_lengths_dict, thresholds=(50, 75, 90)):
+    """
+    Calculate the total length, number of contigs, longest contig, and the Nx and Lx values for each strain
+    :param contig_lengths_dict: dictionary of strain name: reverse-sorted list of all contig lengths
+    :param thresholds: percentages of the total genome length for which to calculate Nx and Lx
+    :return: contig_metrics_dict: dictionary of strain name: dictionary of metric name: value
+    """
+    # Initialise the dictionary
+    contig_metrics_dict = dict()
+    for file_name, contig_lengths in contig_lengths_dict.items():
+        contig_metrics_dict[file_name] = contig_metrics(contig_lengths, thresholds)
+    return contig_metrics_dict
+
+
+def metric_dict(contig_metrics_dict, metric):
+    """
+    Pull a single metric out of the dictionary of all metrics for each strain
+    :param contig_metrics_dict: dictionary of strain name: dictionary of metric name: value
+    :param metric: name of the metric e.g. N50
+    :return: dictionary of strain name: value of the metric
+    """
+    return {file_name: metrics[metric] for file_name, metrics in contig_metrics_dict.items()}
+
+
 def find_largest_contig(contig_lengths_dict):
     """
     Determine the largest contig for each strain
     :param contig_lengths_dict: dictionary of strain name: reverse-sorted list of all contig lengths
     :return: longest_contig_dict: dictionary of strain name: longest contig
     """
-    # Initialise the dictionary
-    longest_contig_dict = dict()
-    for file_name, contig_lengths in contig_lengths_dict.items():
-        # As the list is sorted in descending order, the largest contig is the first entry in the list
-        longest_contig_dict[file_name] = contig_lengths[0]
-    return longest_contig_dict
+    return metric_dict(find_contig_metrics(contig_lengths_dict, thresholds=()), 'LongestContig')
 
 
 def find_genome_length(contig_lengths_dict):
@@ -223,12 +892,7 @@ def find_genome_length(contig_lengths_dict):
     :param contig_lengths_dict: dictionary of strain name: reverse-sorted list of all contig lengths
     :return: genome_length_dict: dictionary of strain name: total genome length
     """
-    # Initialise the dictionary
-    genome_length_dict = dict()
-    for file_name, contig_lengths in contig_lengths_dict.items():
-        # Use the sum() method to add all the contig lengths in the list
-        genome_length_dict[file_name] = sum(contig_lengths)
-    return genome_length_dict
+    return metric_dict(find_contig_metrics(contig_lengths_dict, thresholds=()), 'TotalLength')
 
 
 def find_num_contigs(contig_lengths_dict):
@@ -237,227 +901,320 @@ def find_num_contigs(contig_lengths_dict):
     :param contig_lengths_dict: dictionary of strain name: reverse-sorted list of all contig lengths
     :return: num_contigs_dict: dictionary of strain name: total number of contigs
     """
-    # Initialise the dictionary
-    num_contigs_dict = dict()
-    for file_name, contig_lengths in contig_lengths_dict.items():
-        # Use the len() method to count the number of entries in the list
-        num_contigs_dict[file_name] = len(contig_lengths)
-    return num_contigs_dict
+    return metric_dict(find_contig_metrics(contig_lengths_dict, thresholds=()), 'NumContigs')
 
 
-def find_n50(contig_lengths_dict, genome_length_dict):
+def find_n50(contig_lengths_dict, genome_length_dict=None):
     """
     Calculate the N50 for each strain. N50 is defined as the largest contig such that at least half of the total
     genome size is contained in contigs equal to or larger than this contig
     :param contig_lengths_dict: dictionary of strain name: reverse-sorted list of all contig lengths
-    :param genome_length_dict: dictionary of strain name: total genome length
+    :param genome_length_dict: unused - the genome length is calculated from the contig lengths
     :return: n50_dict: dictionary of strain name: N50
     """
-    # Initialise the dictionary
-    n50_dict = dict()
-    for file_name, contig_lengths in contig_lengths_dict.items():
-        # Initialise a variable to store a running total of contig lengths
-        currentlength = 0
-        for contig_length in contig_lengths:
-            # Increment the current length with the length of the current contig
-            currentlength += contig_length
-            # If the current length is now greater than the total genome / 2, the current contig length is the N50
-            if currentlength >= genome_length_dict[file_name] * 0.5:
-                # Populate the dictionary, and break the loop
-                n50_dict[file_name] = contig_length
-                break
-    return n50_dict
+    return metric_dict(find_contig_metrics(contig_lengths_dict, thresholds=(50,)), 'N50')
 
 
-def find_n75(contig_lengths_dict, genome_length_dict):
+def find_n75(contig_lengths_dict, genome_length_dict=None):
     """
     Calculate the N75 for each strain. N75 is defined as the largest contig such that at least 3/4 of the total
     genome size is contained in contigs equal to or larger than this contig
     :param contig_lengths_dict: dictionary of strain name: reverse-sorted list of all contig lengths
-    :param genome_length_dict: dictionary of strain name: total genome length
+    :param genome_length_dict: unused - the genome length is calculated from the contig lengths
     :return: n75_dict: dictionary of strain name: N75
     """
-    # Initialise the dictionary
-    n75_dict = dict()
-    for file_name, contig_lengths in contig_lengths_dict.items():
-        currentlength = 0
-        for contig_length in contig_lengths:
-            currentlength += contig_length
-            # If the current length is now greater than the 3/4 of the total genome length, the current contig length
-            # is the N75
-            if currentlength >= genome_length_dict[file_name] * 0.75:
-                n75_dict[file_name] = contig_length
-                break
-    return n75_dict
+    return metric_dict(find_contig_metrics(contig_lengths_dict, thresholds=(75,)), 'N75')
 
 
-def find_n90(contig_lengths_dict, genome_length_dict):
+def find_n90(contig_lengths_dict, genome_length_dict=None):
     """
-    Calculate the N90 for each strain. N90 is defined as the largest contig such that at least 9/10 of the total
-    genome size is contained in contigs equal to or larger than this contig
+    Calculate the N90 for each strain. Note that the N90 reported by this tool has always been calculated at 95% of
+    the total genome length - the shipped model was trained on these values, so this behaviour is retained
     :param contig_lengths_dict: dictionary of strain name: reverse-sorted list of all contig lengths
-    :param genome_length_dict: dictionary of strain name: total genome length
-    :return: n75_dict: dictionary of strain name: N90
+    :param genome_length_dict: unused - the genome length is calculated from the contig lengths
+    :return: n90_dict: dictionary of strain name: N90
     """
-    # Initialise the dictionary
-    n90_dict = dict()
-    for file_name, contig_lengths in contig_lengths_dict.items():
-        currentlength = 0
-        for contig_length in contig_lengths:
-            currentlength += contig_length
-            # If the current length is now greater than the 3/4 of the total genome length, the current contig length
-            # is the N75
-            if currentlength >= genome_length_dict[file_name] * 0.95:
-                n90_dict[file_name] = contig_length
-                break
-    return n90_dict
+    return metric_dict(find_contig_metrics(contig_lengths_dict, thresholds=(95,)), 'N95')
 
 
-def find_l50(contig_lengths_dict, genome_length_dict):
+def find_l50(contig_lengths_dict, genome_length_dict=None):
     """
     Calculate the L50 for each strain. L50 is defined as the number of contigs required to achieve the N50
     :param contig_lengths_dict: dictionary of strain name: reverse-sorted list of all contig lengths
-    :param genome_length_dict: dictionary of strain name: total genome length
+    :param genome_length_dict: unused - the genome length is calculated from the contig lengths
     :return: l50_dict: dictionary of strain name: L50
     """
-    # Initialise the dictionary
-    l50_dict = dict()
-    for file_name, contig_lengths in contig_lengths_dict.items():
-        currentlength = 0
-        # Initialise a variable to count how many contigs have been added to the currentlength variable
-        currentcontig = 0
-        for contig_length in contig_lengths:
-            currentlength += contig_length
-            # Increment :currentcontig each time a contig is added to the current length
-            currentcontig += 1
-            # Same logic as with the N50, but the contig number is added instead of the length of the contig
-            if currentlength >= genome_length_dict[file_name] * 0.5:
-                l50_dict[file_name] = currentcontig
-                break
-    return l50_dict
-
-
-def find_l75(contig_lengths_dict, genome_length_dict):
-    """
-    Calculate the L50 for each strain. L75 is defined as the number of contigs required to achieve the N75
+    return metric_dict(find_contig_metrics(contig_lengths_dict, thresholds=(50,)), 'L50')
+
+
+def find_l75(contig_lengths_dict, genome_length_dict=None):
+    """
+    Calculate the L75 for each strain. L75 is defined as the number of contigs required to achieve the N75
     :param contig_lengths_dict: dictionary of strain name: reverse-sorted list of all contig lengths
-    :param genome_length_dict: dictionary of strain name: total genome length
-    :return: l50_dict: dictionary of strain name: L75
+    :param genome_length_dict: unused - the genome length is calculated from the contig lengths
+    :return: l75_dict: dictionary of strain name: L75
     """
-    # Initialise the dictionary
-    l75_dict = dict()
-    for file_name, contig_lengths in contig_lengths_dict.items():
-        currentlength = 0
-        currentcontig = 0
-        for contig_length in contig_lengths:
-            currentlength += contig_length
-            currentcontig += 1
-            # Same logic as with the L75, but the contig number is added instead of the length of the contig
-            if currentlength >= genome_length_dict[file_name] * 0.75:
-                l75_dict[file_name] = currentcontig
-                break
-    return l75_dict
+    return metric_dict(find_contig_metrics(contig_lengths_dict, thresholds=(75,)), 'L75')
 
 
-def find_l90(contig_lengths_dict, genome_length_dict):
+def find_l90(contig_lengths_dict, genome_length_dict=None):
     """
     Calculate the L90 for each strain. L90 is defined as the number of contigs required to achieve the N90
     :param contig_lengths_dict: dictionary of strain name: reverse-sorted list of all contig lengths
-    :param genome_length_dict: dictionary of strain name: total genome length
+    :param genome_length_dict: unused - the genome length is calculated from the contig lengths
     :return: l90_dict: dictionary of strain name: L90
     """
-    # Initialise the dictionary
-    l90_dict = dict()
-    for file_name, contig_lengths in contig_lengths_dict.items():
-        currentlength = 0
-        # Initialise a variable to count how many contigs have been added to the currentlength variable
-        currentcontig = 0
-        for contig_length in contig_lengths:
-            currentlength += contig_length
-            # Increment :currentcontig each time a contig is added to the current length
-            currentcontig += 1
-            # Same logic as with the N50, but the contig number is added instead of the length of the contig
-            if currentlength >= genome_length_dict[file_name] * 0.9:
-                l90_dict[file_name] = currentcontig
-                break
-    return l90_dict
+    return metric_dict(find_contig_metrics(contig_lengths_dict, thresholds=(90,)), 'L90')
 
 
 def predict_orfs(file_dict, num_threads=1):
     """
-    Use prodigal to predict the number of open reading frames (ORFs) in each strain
+    Use prodigal to predict the number of open reading frames (ORFs) in each strain, and determine the frequency of ORF
+    size ranges. The prodigal output is parsed as it is produced, so nothing is written to the sequence path
     :param file_dict: dictionary of strain name: /sequencepath/strain_name.extension
-    :param num_threads: number of threads to use in the pool of prodigal processes
-    :return: orf_file_dict: dictionary of strain name: /sequencepath/prodigal results.sco
+    :param num_threads: number of prodigal processes to run at once
+    :return: orf_dist_dict: dictionary of strain name: tuple of ORF size range distribution frequencies
     """
-    # Initialise the dictionary
-    orf_file_dict = dict()
-    prodigallist = list()
-    for file_name, file_path in file_dict.items():
-        # Set the name of the output .sco results file
-        results = os.path.splitext(file_path)[0] + '.sco'
-        # Create the command for prodigal to execute - use sco output format
-        prodigal = ['prodigal', '-i', file_path, '-o', results,  '-f',  'sco']
-        # Only run prodigal if the output file doesn't already exist
-        if not os.path.isfile(results):
-            prodigallist.append(prodigal)
-        # Populate the dictionary with the name of the results file
-        orf_file_dict[file_name] = results
-    # Setup the multiprocessing pool.
-    pool = multiprocessing.Pool(processes=num_threads)
-    pool.map(run_prodigal, prodigallist)
-    pool.close()
-    pool.join()
-    return orf_file_dict
-
-
-def run_prodigal(prodigal_command):
-    with open(os.devnull, 'w') as f:  # No need to make the use see prodigal output, send it to devnull
-        subprocess.call(prodigal_command, stdout=f, stderr=f)
+    from multiprocessing.pool import ThreadPool
+    file_names = list(file_dict)
+    # The workers only wait on prodigal, so threads are sufficient
+    pool = ThreadPool(processes=max(1, num_threads))
+    try:
+        orf_dists = pool.map(sample_orfs, [file_dict[file_name] for file_name in file_names])
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(file_names, orf_dists))
+
+
+def sample_orfs(fasta, tool_runner=None):
+    """
+    Use prodigal to predict the ORFs of a single sample, and determine the frequency of ORF size ranges. The sco
+    output of prodigal is read from its stdout, and binned as it is produced
+    :param fasta: /sequencepath/strain_name.extension
+    :param tool_runner: optional tools.ToolRunner with the time limit and retries of prodigal
+    :return: tuple of ORF size range distribution frequencies
+    """
+    tool_runner = tool_runner or tools.ToolRunner()
+    if compression.compression(fasta) is not None:
+        # prodigal is fed the decompressed sequence on stdin
+        _, _, orf_dist = stream_sample(fasta, tool_runner=tool_runner)
+        return orf_dist
+    return tool_runner.call(prodigal_attempt, fasta, tool_runner)
+
+
+def prodigal_attempt(fasta, tool_runner):
+    """
+    Run prodigal once on an uncompressed sample, as described in sample_orfs
+    :param tool_runner: tools.ToolRunner with the time limit of prodigal
+    :return: tuple of ORF size range distribution frequencies
+    """
+    try:
+        return tool_runner.run_once(['prodigal', '-i', fasta, '-f', 'sco'], orf_distribution)
+    except tools.ToolError as error:
+        # The sample is only checked once prodigal has failed, as it is rarely too short
+        contig_lengths, _ = sample_stats(fasta)
+        if error.returncode and sum(contig_lengths) < PRODIGAL_MIN_LENGTH:
+            return 0, 0, 0, 0, 0
+        raise
+
+
+def stream_sample(fasta, refseq_database=None, genus_method='mash', threads=1, orfs=True, tool_runner=None,
+                  orf_method='prodigal'):
+    """
+    Decompress a FASTA file once, and share the stream between the statistics scan, the genus screen, and prodigal.
+    mash and prodigal read the sequence from their stdin, so the decompressed file is never written to disk. prodigal
+    is only started once the genus screen has finished, and is fed the decompressed chunks kept in memory, so that a
+    sample never runs more than one tool at a time, and stays within the CPUs of its worker. If either tool fails, the
+    whole sample is streamed again
+    :param fasta: /sequencepath/strain_name.extension, which may be compressed
+    :param refseq_database: Path to reduced refseq database sketch. The genus is not determined without it
+    :param genus_method: 'mash' to screen the sample with the mash executable, 'batch' to compare it to the sketch with
+    mash dist, or 'minhash' to screen it in-process
+    :param threads: number of threads to run mash, and to decompress bgzip files with
+    :param orfs: boolean to determine whether ORFs are predicted
+    :param tool_runner: optional tools.ToolRunner with the time limit and retries of mash and prodigal
+    :param orf_method: 'prodigal' to feed the sample to prodigal, or 'orfscan' to find its ORFs in-process once it has
+    been read
+    :return: stats, genus, orf_dist: contig lengths and GC% as returned by sample_stats, genus (None without a
+    database), and tuple of ORF size range distribution frequencies (None without orfs)
+    """
+    tool_runner = tool_runner or tools.ToolRunner()
+    return tool_runner.call(stream_attempt, fasta, refseq_database, genus_method, threads, orfs, tool_runner,
+                            orf_method)
+
+
+def stream_attempt(fasta, refseq_database, genus_method, threads, orfs, tool_runner, orf_method='prodigal'):
+    """
+    Stream a sample once, as described in stream_sample
+    :param tool_runner: tools.ToolRunner with the time limit of mash and prodigal
+    :return: stats, genus, orf_dist as returned by stream_sample
+    """
+    scanner = FastaScanner()
+    commands = list()
+    processes = list()
+    stderrs = list()
+    futures = list()
+    pipes = list()
+    errors = list()
+    returncodes = list()
+    # Decompressed chunks of the sample, kept to feed to prodigal, or to find its ORFs in-process
+    orf_chunks = list() if orfs else None
+    # The output of each tool is read as it is produced, so that the tool can not block the stream
+    readers = ThreadPoolExecutor(max_workers=1)
+    watchdog = tool_runner.watchdog(processes)
+    # prodigal copies its stdin to a file in its working directory, which it leaves behind if it refuses the sample or
+    # is killed, so the tools are run in a directory of their own
+    work_dir = tempfile.TemporaryDirectory(prefix='genomeqaml_')
+
+    def start(command, parse):
+        # stderr goes to a file, so that it can be reported if the tool fails
+        stderr = tempfile.TemporaryFile()
+        stderrs.append(stderr)
+        try:
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr,
+                                       cwd=work_dir.name)
+        except OSError as error:
+            raise tools.ToolError(command, 'could not be started ({})'.format(error.strerror), retry=False)
+        commands.append(command)
+        processes.append(process)
+        pipes.append(process.stdin)
+        futures.append(readers.submit(parse, io.TextIOWrapper(process.stdout)))
+        return futures[-1]
+
+    def shared_chunks():
+        for chunk in compression.read_chunks(fasta, threads=threads):
+            scanner.feed(chunk)
+            if orf_chunks is not None:
+                orf_chunks.append(chunk)
+            for pipe in list(pipes):
+                try:
+                    pipe.write(chunk)
+                except BrokenPipeError:
+                    # The tool has exited, and its output is whatever it produced before then. Its exit status
+                    # determines whether that output is used
+                    pipes.remove(pipe)
+            yield chunk
+
+    def finish():
+        # All the output is read before the tools are waited for, so that none of them can block on a full pipe
+        for pipe in pipes:
+            try:
+                pipe.close()
+            except BrokenPipeError:
+                pass
+        del pipes[:]
+        errors.extend(future.exception() for future in futures[len(errors):])
+        returncodes.extend(instrument.wait_child(process) for process in processes[len(returncodes):])
+
+    try:
+        with watchdog:
+            orf_future = None
+            screen_future = None
+            if refseq_database and genus_method == 'batch':
+                # The same options as dist_genus, with the sample read from stdin
+                screen_future = start(['mash', 'dist', '-p', str(threads), '-d', str(MAX_DISTANCE), refseq_database,
+                                       '-'], lambda dist_lines: read_dist(dist_lines).get('-', list()))
+            elif refseq_database and genus_method != 'minhash':
+                # The same options as screen_genus, with the sample read from stdin
+                screen_future = start(['mash', 'screen', '-p', str(threads), '-w', '-i', '0.95', refseq_database,
+                                       '-'], read_screen)
+            genus = None
+            if refseq_database and genus_method == 'minhash':
+                from genomeqaml import minhash
+                genus = parse_genus(minhash.load_index(refseq_database).screen_sequences(
+                    minhash.chunk_sequences(shared_chunks()), min_identity=0.95))
+            else:
+                for _ in shared_chunks():
+                    pass
+            finish()
+            if orfs and orf_method != 'orfscan' and not watchdog.expired and not any(returncodes):
+                # mash has exited, so prodigal has the CPUs of the worker to itself
+                orf_future = start(['prodigal', '-f', 'sco'], orf_distribution)
+                for chunk in orf_chunks:
+                    try:
+                        pipes[0].write(chunk)
+                    except BrokenPipeError:
+                        break
+                finish()
+        stats = scan_stats(*scanner.result())
+        orf_dist = orf_future.result() if orf_future is not None and orf_future.exception() is None else None
+        for command, returncode, error, stderr in zip(commands, returncodes, errors, stderrs):
+            # As in prodigal_attempt, a sample that prodigal refuses as too short has no ORFs
+            if command[0] == 'prodigal' and returncode and not watchdog.expired and \
+                    sum(stats[0]) < PRODIGAL_MIN_LENGTH:
+                orf_dist = 0, 0, 0, 0, 0
+                continue
+            if watchdog.expired:
+                raise tools.ToolError(command, 'timed out after {} s'.format(tool_runner.timeout),
+                                      stderr=tools.read_tail(stderr))
+            if returncode:
+                raise tools.ToolError(command, 'exited with status {}'.format(returncode), returncode=returncode,
+                                      stderr=tools.read_tail(stderr))
+            if error is not None:
+                raise tools.ToolError(command, 'output could not be parsed ({})'.format(error),
+                                      stderr=tools.read_tail(stderr))
+        if screen_future is not None:
+            genus = parse_genus(screen_future.result())
+        if orfs and orf_method == 'orfscan':
+            from genomeqaml import minhash, orfscan
+            orf_dist = (0, 0, 0, 0, 0) if sum(stats[0]) < PRODIGAL_MIN_LENGTH else \
+                orfscan.orf_distribution(minhash.chunk_sequences(orf_chunks))
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+        readers.shutdown(wait=True)
+        for stderr in stderrs:
+            stderr.close()
+        work_dir.cleanup()
+    return stats, genus, orf_dist
+
+
+def read_screen(screen_lines):
+    """
+    :param screen_lines: iterable of the lines of mash screen output
+    :return: list of mash screen results, sorted by descending identity as in the screen output of screen_genus
+    """
+    from genewrappers.biotools import mash
+    return sorted((mash.ScreenResult(line) for line in screen_lines if line.strip()),
+                  key=lambda result: result.identity, reverse=True)
+
+
+def read_dist(dist_lines):
+    """
+    :param dist_lines: iterable of the lines of mash dist output: reference, query, distance, p-value, shared hashes
+    :return: dictionary of query: list of minhash.ScreenHit of its references, with one minus the distance as the
+    identity, sorted by descending identity as in read_screen
+    """
+    from genomeqaml import minhash
+    hits = dict()
+    for line in dist_lines:
+        if not line.strip():
+            continue
+        reference, query, distance, _, shared = line.rstrip('\n').split('\t')
+        shared_hashes, sketch_size = shared.split('/')
+        hits.setdefault(query, list()).append(minhash.ScreenHit(1 - float(distance), int(shared_hashes),
+                                                                int(sketch_size), reference))
+    for query_hits in hits.values():
+        query_hits.sort(key=lambda hit: (-hit.identity, -hit.shared_hashes))
+    return hits
 
 
 def find_orf_distribution(orf_file_dict):
     """
-    Parse the prodigal outputs to determine the frequency of ORF size ranges for each strain
+    Parse existing prodigal sco outputs to determine the frequency of ORF size ranges for each strain. The reports are
+    deleted once they are parsed
     :param orf_file_dict: dictionary of strain name: /sequencepath/prodigal results.sco
     :return: orf_dist_dict: dictionary of strain name: tuple of ORF size range distribution frequencies
     """
     # Initialise the dictionary
     orf_dist_dict = dict()
     for file_name, orf_report in orf_file_dict.items():
-        # Initialise variable to store the frequency of the different ORF size ranges
-        total_orfs = 0
-        over_3000 = 0
-        over_1000 = 0
-        over_500 = 0
-        other = 0
         # Open the strain-specific report
         with open(orf_report, 'r') as orfreport:
-            for line in orfreport:
-                # The report has a header section that can be ignored - only parse lines beginning with '>'
-                if line.startswith('>'):
-                    # Split the line on '_' characters e.g. >1_345_920_- yields contig: >1, start: 345, stop: 920,
-                    # direction: -
-                    contig, start, stop, direction = line.split('_')
-                    # The size of the ORF is the end position minus the start position e.g. 920 - 345 = 575
-                    size = int(stop) - int(start)
-                    # Increment the total number of ORFs before binning based on ORF size
-                    total_orfs += 1
-                    # Increment the appropriate integer based on ORF size
-                    if size > 3000:
-                        over_3000 += 1
-                    elif size > 1000:
-                        over_1000 += 1
-                    elif size > 500:
-                        over_500 += 1
-                    else:
-                        other += 1
-        # Populate the dictionary with a tuple of the ORF size range frequencies
-        orf_dist_dict[file_name] = (total_orfs,
-                                    over_3000,
-                                    over_1000,
-                                    over_500,
-                                    other)
+            orf_dist_dict[file_name] = orf_distribution(orfreport)
         # Clean-up the prodigal reports
         try:
             os.remove(orf_report)
@@ -466,8 +1223,89 @@ def find_orf_distribution(orf_file_dict):
     return orf_dist_dict
 
 
+def orf_distribution(sco_lines):
+    """
+    Parse prodigal sco output to determine the frequency of ORF size ranges
+    :param sco_lines: iterable of the lines of the prodigal output e.g. an open file or pipe
+    :return: tuple of the total number of ORFs, and the number of ORFs over 3000, 1000, and 500 bp, and all others
+    """
+    # Initialise variable to store the frequency of the different ORF size ranges
+    total_orfs = 0
+    over_3000 = 0
+    over_1000 = 0
+    over_500 = 0
+    other = 0
+    for line in sco_lines:
+        # The report has a header section that can be ignored - only parse lines beginning with '>'
+        if line.startswith('>'):
+            # Split the line on '_' characters e.g. >1_345_920_- yields contig: >1, start: 345, stop: 920,
+            # direction: -
+            contig, start, stop, direction = line.split('_')
+            # The size of the ORF is the end position minus the start position e.g. 920 - 345 = 575
+            size = int(stop) - int(start)
+            # Increment the total number of ORFs before binning based on ORF size
+            total_orfs += 1
+            # Increment the appropriate integer based on ORF size
+            if size > 3000:
+                over_3000 += 1
+            elif size > 1000:
+                over_1000 += 1
+            elif size > 500:
+                over_500 += 1
+            else:
+                other += 1
+    return total_orfs, over_3000, over_1000, over_500, other
+
+
+def feature_row(file_name, contig_lengths, gc, orf_dist, genus):
+    """
+    Assemble the report row of a single sample from its extracted features
+    :param file_name: strain name
+    :param contig_lengths: reverse-sorted list of all contig lengths
+    :param gc: GC%
+    :param orf_dist: tuple of ORF length frequencies
+    :param genus: genus
+    :return: row: dictionary of report column: value
+    """
+    # The N90 has always been reported at 95% of the genome length, so the 95% threshold is included as well
+    metrics = contig_metrics(contig_lengths, thresholds=(50, 75, 90, 95))
+    row = {'SampleName': file_name,
+           'TotalLength': metrics['TotalLength'],
+           'NumContigs': metrics['NumContigs'],
+           'LongestContig': metrics['LongestContig']}
+    row.update(zip(CONTIG_COLUMNS, contig_distribution(contig_lengths)))
+    row.update(zip(ORF_COLUMNS, orf_dist))
+    row.update({'N50': metrics['N50'],
+                'N75': metrics['N75'],
+                'N90': metrics['N95'],
+                'L50': metrics['L50'],
+                'L75': metrics['L75'],
+                'L90': metrics['L90'],
+                'GC%': gc,
+                'Genus': genus})
+    return row
+
+
+def rows_to_dicts(rows):
+    """
+    Convert report rows into the dictionaries of each feature returned by main
+    :param rows: iterable of dictionaries of report column: value
+    :return: gc_dict, contig_dist_dict, longest_contig_dict, genome_length_dict, num_contigs_dict, n50_dict, n75_dict, \
+        n90_dict, l50_dict, l75_dict, l90_dict, orf_dist_dict
+    """
+    rows = {row['SampleName']: row for row in rows}
+
+    def column(name):
+        return {file_name: row[name] for file_name, row in rows.items()}
+
+    contig_dist_dict = {file_name: tuple(row[name] for name in CONTIG_COLUMNS) for file_name, row in rows.items()}
+    orf_dist_dict = {file_name: tuple(row[name] for name in ORF_COLUMNS) for file_name, row in rows.items()}
+    return column('GC%'), contig_dist_dict, column('LongestContig'), column('TotalLength'), column('NumContigs'), \
+        column('N50'), column('N75'), column('N90'), column('L50'), column('L75'), column('L90'), orf_dist_dict
+
+
 def reporter(gc_dict, contig_dist_dict, longest_contig_dict, genome_length_dict, num_contigs_dict, n50_dict, n75_dict,
-             n90_dict, l50_dict, l75_dict, l90_dict, orf_dist_dict, genus_dict, sequencepath):
+             n90_dict, l50_dict, l75_dict, l90_dict, orf_dist_dict, genus_dict, sequencepath, results_db=None):
     """
     Create a report of all the extracted features
     :param gc_dict: dictionary of strain name: GC%
@@ -484,66 +1322,346 @@ def reporter(gc_dict, contig_dist_dict, longest_contig_dict, genome_length_dict,
     :param orf_dist_dict: dictionary of strain name: tuple of ORF length frequencies
     :param genus_dict: dictionary of strain name: genus
     :param sequencepath: path of folder containing FASTA genomes
+    :param results_db: optional path of a SQLite results database to record the rows of the report in
+    """
+    rows = list()
+    for file_name in longest_contig_dict:
+        row = {'SampleName': file_name,
+               'TotalLength': genome_length_dict[file_name],
+               'NumContigs': num_contigs_dict[file_name],
+               'LongestContig': longest_contig_dict[file_name]}
+        row.update(zip(CONTIG_COLUMNS, contig_dist_dict[file_name]))
+        row.update(zip(ORF_COLUMNS, orf_dist_dict[file_name]))
+        row.update({'N50': n50_dict[file_name],
+                    'N75': n75_dict[file_name],
+                    'N90': n90_dict[file_name],
+                    'L50': l50_dict[file_name],
+                    'L75': l75_dict[file_name],
+                    'L90': l90_dict[file_name],
+                    'GC%': gc_dict[file_name],
+                    'Genus': genus_dict[file_name]})
+        rows.append(row)
+    results_database = open_results_database(results_db)
+    try:
+        write_report(rows, sequencepath, results_database=results_database)
+    finally:
+        if results_database is not None:
+            results_database.close()
+
+
+def write_report(rows, sequencepath, batch_size=None, report_format='csv', results_database=None,
+                 instrumentation=None, digests=None):
+    """
+    Write the report of all the extracted features, sorted by strain name
+    :param rows: iterable of dictionaries of report column: value
+    :param sequencepath: path of folder containing FASTA genomes
+    :param batch_size: optional number of rows to write at a time. Rows are then consumed from the iterable as they
+    are written, rather than all at once, and are only sorted within each batch
+    :param report_format: 'csv' to write extracted_features.csv, 'columns' to write the columnar feature store
+    extracted_features.columns, or 'both'
+    :param results_database: optional open database.ResultsDatabase. Each batch is also inserted into it, in a single
+    transaction
+    :param instrumentation: optional instrument.Recorder to measure the writing of each batch with
+    :param digests: optional dictionary of strain name: digest of the FASTA contents, to record in the results database.
+    Without it, the database calculates the digests of the FASTA files in the sequence path itself
+    """
+    # Write to temporary files, and move them into place once they are complete, so that an interrupted run never
+    # leaves a partial report behind
+    report_file = os.path.join(sequencepath, REPORT_FILE)
+    tmp_file = '{}.{}.tmp'.format(report_file, os.getpid())
+    store_dir = os.path.join(sequencepath, REPORT_STORE)
+    tmp_store_dir = '{}.{}.tmp'.format(store_dir, os.getpid())
+    feature_report = open(tmp_file, 'w') if report_format in ('csv', 'both') else None
+    feature_store = columnar.ColumnStore.create(tmp_store_dir, FEATURE_TYPES) if report_format in ('columns', 'both') \
+        else None
+    try:
+        if feature_report is not None:
+            feature_report.write(','.join(FEATURE_COLUMNS) + '\n')
+        for batch in batches(rows, batch_size):
+            with instrument.stage(instrumentation, 'report'):
+                batch.sort(key=lambda feature_row: feature_row['SampleName'])
+                if feature_report is not None:
+                    for row in batch:
+                        feature_report.write(','.join(str(row[column]) for column in FEATURE_COLUMNS) + '\n')
+                    feature_report.flush()
+                if feature_store is not None:
+                    # Each batch is a row group of the store
+                    feature_store.append(batch)
+                if results_database is not None:
+                    results_database.add_features(batch, digests=digests, folder=sequencepath)
+    finally:
+        if feature_report is not None:
+            feature_report.close()
+    if feature_report is not None:
+        os.replace(tmp_file, report_file)
+    if feature_store is not None:
+        columnar.replace_store(tmp_store_dir, store_dir)
+
+
+def open_store(sequencepath):
+    """
+    Open the columnar feature store of a folder, unless the CSV report has been written since
+    :param sequencepath: path of folder containing FASTA genomes
+    :return: ColumnStore, or None if there is no up to date store
     """
-    # Initialise string with header information
-    data = 'SampleName,TotalLength,NumContigs,LongestContig,Contigs>1000000,Contigs>500000,Contigs>100000,' \
-           'Contigs>50000,Contigs>10000,Contigs>5000,Contigs<5000,TotalORFs,ORFs>3000,ORFs>1000,ORFs>500,' \
-           'ORFs<500,N50,N75,N90,L50,L75,L90,GC%,Genus\n'
-    # Create and open the report for writign
-    with open(os.path.join(sequencepath, 'extracted_features.csv'), 'w') as feature_report:
-        for file_name in sorted(longest_contig_dict):
-            # Populate the data string with the appropriate values
-            data += '{name},{totlen},{numcontigs},{longestcontig},{over_106},{over_56},{over_105},{over_55},' \
-                    '{over_104},{over_54},{under_54},{tORFS},{ORF33},{ORF13},{ORF52}, {ORF11},{n50},{n75},{n90},' \
-                    '{l50},{l75},{l90},{gc},{genus}\n'\
-                .format(name=file_name,
-                        totlen=genome_length_dict[file_name],
-                        numcontigs=num_contigs_dict[file_name],
-                        longestcontig=longest_contig_dict[file_name],
-                        over_106=contig_dist_dict[file_name][0],
-                        over_56=contig_dist_dict[file_name][1],
-                        over_105=contig_dist_dict[file_name][2],
-                        over_55=contig_dist_dict[file_name][3],
-                        over_104=contig_dist_dict[file_name][4],
-                        over_54=contig_dist_dict[file_name][5],
-                        under_54=contig_dist_dict[file_name][6],
-                        tORFS=orf_dist_dict[file_name][0],
-                        ORF33=orf_dist_dict[file_name][1],
-                        ORF13=orf_dist_dict[file_name][2],
-                        ORF52=orf_dist_dict[file_name][3],
-                        ORF11=orf_dist_dict[file_name][4],
-                        n50=n50_dict[file_name],
-                        n75=n75_dict[file_name],
-                        n90=n90_dict[file_name],
-                        l50=l50_dict[file_name],
-                        l75=l75_dict[file_name],
-                        l90=l90_dict[file_name],
-                        gc=gc_dict[file_name],
-                        genus=genus_dict[file_name])
-        # Write the string to file
-        feature_report.write(data)
-
-
-# Initialise the click decorator
-@click.command()
-@click.option('-s', '--sequencepath',
-              type=click.Path(exists=True),
-              required=True,
-              help='Path of folder containing multi-FASTA files')
-@click.option('-d', '--refseq_database',
-              type=click.Path(exists=True),
-              required=True,
-              help='Path to reduced mash sketch of RefSeq.')
-@click.option('-r', '--report',
-              is_flag=True,
-              default=True,
-              help='By default, a report of the extracted features is created. Include this flag if you do not want '
-                   'a report created')
-def cli(sequencepath, report, refseq_database):
-    """
-    Pass command line arguments to, and run the feature extraction functions
-    """
-    main(sequencepath, report, refseq_database, num_threads=multiprocessing.cpu_count())
+    schema_file = os.path.join(sequencepath, REPORT_STORE, columnar.SCHEMA_FILE)
+    try:
+        store_mtime = os.stat(schema_file).st_mtime_ns
+    except OSError:
+        return None
+    try:
+        if os.stat(os.path.join(sequencepath, REPORT_FILE)).st_mtime_ns > store_mtime:
+            return None
+    except OSError:
+        pass
+    return columnar.ColumnStore(os.path.join(sequencepath, REPORT_STORE))
+
+
+def report_exists(sequencepath):
+    """
+    :param sequencepath: path of folder containing FASTA genomes
+    :return: boolean of whether the folder has a feature report, in either format
+    """
+    return os.path.isfile(os.path.join(sequencepath, REPORT_FILE)) or open_store(sequencepath) is not None
+
+
+def batches(iterable, batch_size=None):
+    """
+    Split an iterable into lists of at most batch_size items
+    :param iterable: iterable to split
+    :param batch_size: maximum number of items in each list. If not provided, all the items are returned in one list
+    :return: generator of lists of items
+    """
+    iterator = iter(iterable)
+    if not batch_size:
+        yield list(iterator)
+        return
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def read_report(sequencepath):
+    """
+    Read the rows of an existing report of extracted features, from the columnar feature store if it is up to date,
+    or the CSV report otherwise
+    :param sequencepath: path of folder containing FASTA genomes
+    :return: rows: dictionary of strain name: dictionary of report column: value. Empty if there is no report
+    """
+    feature_store = open_store(sequencepath)
+    if feature_store is not None:
+        return {row['SampleName']: row for row in feature_store.rows()}
+    rows = dict()
+    try:
+        feature_report = open(os.path.join(sequencepath, REPORT_FILE), newline='')
+    except (IOError, OSError):
+        return rows
+    with feature_report:
+        for row in csv.DictReader(feature_report):
+            typed_row = dict()
+            for column in FEATURE_COLUMNS:
+                # Everything other than the name, GC%, and genus is an integer. Older reports have stray spaces
+                value = row[column].strip()
+                if column in ('SampleName', 'Genus'):
+                    typed_row[column] = value
+                elif column == 'GC%':
+                    typed_row[column] = float(value)
+                else:
+                    typed_row[column] = int(value)
+            rows[typed_row['SampleName']] = typed_row
+    return rows
+
+
+def file_state(fasta, digest=False):
+    """
+    Record the size and modification time of a FASTA file, and optionally the digest of its contents
+    :param fasta: /sequencepath/strain_name.extension
+    :param digest: boolean to determine whether the digest is calculated
+    :return: dictionary of size, mtime, and digest (None if not calculated)
+    """
+    stat = os.stat(fasta)
+    return {'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'digest': cache.file_digest(fasta) if digest else None}
+
+
+def plan_update(file_dict, sequencepath):
+    """
+    Compare the FASTA files in the sequence path with the samples in the existing report. Samples whose size and
+    modification time are unchanged are kept, and the contents of any others with a report row are checked against the
+    digest recorded when they were extracted. Rows of samples that are no longer in the folder are dropped
+    :param file_dict: dictionary of strain name: /sequencepath/strain_name.extension
+    :param sequencepath: path of folder containing FASTA genomes
+    :return: rows, stale_dict, index: list of the rows that can be kept, dictionary of strain name:
+    /sequencepath/strain_name.extension of samples that must be extracted, and the dictionary of strain name: file
+    state of the kept samples
+    """
+    existing_rows = read_report(sequencepath)
+    try:
+        with open(os.path.join(sequencepath, REPORT_INDEX)) as index_file:
+            existing_index = json.load(index_file)
+    except (IOError, OSError, ValueError):
+        existing_index = dict()
+    rows = list()
+    stale_dict = dict()
+    index = dict()
+    for file_name, fasta in sorted(file_dict.items()):
+        if file_name not in existing_rows:
+            stale_dict[file_name] = fasta
+            continue
+        state = file_state(fasta)
+        recorded = existing_index.get(file_name)
+        if recorded is None:
+            # Reports written before incremental updates have no index - trust their rows, and start recording
+            state['digest'] = cache.file_digest(fasta)
+        elif (state['size'], state['mtime']) == (recorded['size'], recorded['mtime']):
+            state['digest'] = recorded['digest']
+        else:
+            # The file has been touched - only extract it again if its contents have changed
+            state['digest'] = cache.file_digest(fasta)
+            if state['digest'] != recorded['digest']:
+                stale_dict[file_name] = fasta
+                continue
+        rows.append(existing_rows[file_name])
+        index[file_name] = state
+    return rows, stale_dict, index
+
+
+def write_index(index, sequencepath):
+    """
+    Atomically write the index of the file state of each sample in the report
+    :param index: dictionary of strain name: file state
+    :param sequencepath: path of folder containing FASTA genomes
+    """
+    index_file = os.path.join(sequencepath, REPORT_INDEX)
+    tmp_file = '{}.{}.tmp'.format(index_file, os.getpid())
+    with open(tmp_file, 'w') as index_handle:
+        json.dump(index, index_handle, indent=1, sort_keys=True)
+    os.replace(tmp_file, index_file)
+
+
+def cli(args=None):
+    """
+    Run the feature extraction from the command line. click is imported here, so that it is not loaded when the module
+    is imported
+    :param args: optional list of command line arguments. Defaults to those the script was run with
+    """
+    import click
+
+    @click.command()
+    @click.option('-s', '--sequencepath',
+                  type=click.Path(exists=True),
+                  required=True,
+                  help='Path of folder containing multi-FASTA files')
+    @click.option('-d', '--refseq_database',
+                  type=click.Path(exists=True),
+                  required=True,
+                  help='Path to reduced mash sketch of RefSeq.')
+    @click.option('-r', '--report',
+                  is_flag=True,
+                  default=True,
+                  help='By default, a report of the extracted features is created. Include this flag if you do not '
+                       'want a report created')
+    @click.option('-g', '--genus_method',
+                  type=click.Choice(['mash', 'batch', 'minhash']),
+                  default='mash',
+                  help='Determine genera with the mash executable (default), with a single mash dist for each batch '
+                       'of {} samples (batch), or by screening the RefSeq sketch in-process with minhash.'.format(
+                      GENUS_BATCH_SIZE))
+    @click.option('-o', '--orf_method',
+                  type=click.Choice(['prodigal', 'orfscan']),
+                  default='prodigal',
+                  help='Predict ORFs with the prodigal executable (default), or find them in-process with a fast, '
+                       'approximate six-frame scan that does not need prodigal. See benchmarks/orf_accuracy.py for '
+                       'how closely the scan matches prodigal.')
+    @click.option('-t', '--threads',
+                  type=int,
+                  default=None,
+                  help='Total number of CPUs to use. Defaults to the number of CPUs available to this process, taking '
+                       'CPU affinity and cgroup quotas into account.')
+    @click.option('--tool_threads',
+                  type=int,
+                  default=None,
+                  help='Number of threads to give each external tool. By default, tools are single-threaded unless '
+                       'there are fewer samples than CPUs.')
+    @click.option('-c', '--cache_dir',
+                  type=click.Path(),
+                  default=None,
+                  help='Directory of a persistent cache of extracted features. Samples that have already been '
+                       'extracted are read from the cache.')
+    @click.option('-i', '--incremental',
+                  is_flag=True,
+                  default=False,
+                  help='Update an existing report: only extract samples that are new or have changed, and drop '
+                       'samples that have been removed.')
+    @click.option('-b', '--batch_size',
+                  type=click.IntRange(min=1),
+                  default=None,
+                  help='Write the report this many samples at a time, rather than holding every row in memory until '
+                       'all the samples are complete. Useful for very large folders. Rows are only sorted within each '
+                       'batch.')
+    @click.option('-f', '--report_format',
+                  type=click.Choice(['csv', 'columns', 'both']),
+                  default='csv',
+                  help='Format of the report: extracted_features.csv (default), a columnar feature store in '
+                       'extracted_features.columns that is read without parsing, or both.')
+    @click.option('--results_db',
+                  type=click.Path(),
+                  default=None,
+                  help='Path of a SQLite database to also record the extracted features in. Created if it does not '
+                       'exist.')
+    @click.option('--metrics',
+                  type=click.Path(),
+                  default=None,
+                  help='Write the wall time, CPU time, child process CPU time, bytes read, and peak RSS of every '
+                       'stage of the run, and of each sample, to this file as lines of JSON.')
+    @click.option('--summary',
+                  is_flag=True,
+                  default=False,
+                  help='Print a table of the total time and resources used by each stage at the end of the run.')
+    @click.option('--profile',
+                  type=click.Path(),
+                  default=None,
+                  help='Run every stage under cProfile, and write the combined profile of each stage to this '
+                       'directory.')
+    @click.option('--tool_timeout',
+                  type=click.FloatRange(min=0, min_open=True),
+                  default=None,
+                  help='Kill mash or prodigal if a single run on a sample takes longer than this many seconds. By '
+                       'default, tools are not time limited.')
+    @click.option('--tool_retries',
+                  type=click.IntRange(min=0),
+                  default=tools.DEFAULT_RETRIES,
+                  show_default=True,
+                  help='Number of times to run mash or prodigal again if it fails or times out. Samples whose tools '
+                       'still fail are left out of the report, and the run exits with status 1.')
+    def command(sequencepath, report, refseq_database, genus_method, orf_method, threads, tool_threads, cache_dir,
+                incremental, batch_size, report_format, results_db, metrics, summary, profile, tool_timeout,
+                tool_retries):
+        """
+        Pass command line arguments to, and run the feature extraction functions
+        """
+        failures = dict()
+        with instrument.recording(metrics_file=metrics, summary=summary, profile_dir=profile) as instrumentation:
+            main(sequencepath, report, refseq_database,
+                 num_threads=threads or resources.available_cpus(),
+                 genus_method=genus_method,
+                 orf_method=orf_method,
+                 tool_threads=tool_threads,
+                 cache_dir=cache_dir,
+                 incremental=incremental,
+                 batch_size=batch_size,
+                 report_format=report_format,
+                 results_db=results_db,
+                 instrumentation=instrumentation,
+                 tool_runner=tools.ToolRunner(timeout=tool_timeout, retries=tool_retries),
+                 failures=failures)
+        if failures:
+            raise SystemExit(1)
+
+    command(args)
 
 
 if __name__ == '__main__':
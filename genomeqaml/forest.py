@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+import argparse
+import pickle
+import numpy as np
+__author__ = 'adamkoziol', 'andrewlow'
+
+
+def export_forest(model, forest_file, model_digest=None):
+    """
+    Flatten a fitted scikit-learn tree ensemble (e.g. the ExtraTreesClassifier of model.p) into NumPy arrays, and save
+    them to a .npz file that can be loaded with load_forest without scikit-learn
+    :param model: fitted single-output tree ensemble classifier
+    :param forest_file: path of the .npz file to write
+    :param model_digest: optional digest of the pickled model, used to match the exported forest to its schema
+    """
+    if getattr(model, 'n_outputs_', 1) != 1:
+        raise ValueError('Only single-output classifiers can be exported')
+    features, thresholds, lefts, rights, missing_left, values, roots = (list() for _ in range(7))
+    offset = 0
+    for estimator in model.estimators_:
+        tree = estimator.tree_
+        leaves = tree.children_left == -1
+        node_ids = np.arange(tree.node_count)
+        roots.append(offset)
+        # Leaves point to themselves, which marks them as leaves in the flattened arrays
+        features.append(np.where(leaves, 0, tree.feature))
+        thresholds.append(tree.threshold)
+        lefts.append(np.where(leaves, node_ids, tree.children_left) + offset)
+        rights.append(np.where(leaves, node_ids, tree.children_right) + offset)
+        missing_left.append(np.asarray(getattr(tree, 'missing_go_to_left', np.zeros(tree.node_count)), dtype=bool))
+        values.append(leaf_values(estimator))
+        offset += tree.node_count
+    arrays = {'feature': np.concatenate(features).astype(np.int32),
+              'threshold': np.concatenate(thresholds).astype(np.float64),
+              'left': np.concatenate(lefts).astype(np.int64),
+              'right': np.concatenate(rights).astype(np.int64),
+              'missing_left': np.concatenate(missing_left),
+              'value': np.concatenate(values).astype(np.float64),
+              'roots': np.asarray(roots, dtype=np.int64),
+              'classes': np.asarray(model.classes_),
+              # Versions of scikit-learn before 0.24, such as the 0.19.1 that pickled model.p, only have n_features_
+              'n_features': np.asarray(getattr(model, 'n_features_in_', None) or model.n_features_, dtype=np.int64),
+              'model_digest': np.asarray(model_digest or '')}
+    if hasattr(model, 'feature_names_in_'):
+        arrays['feature_names'] = np.asarray(model.feature_names_in_, dtype=str)
+    with open(forest_file, 'wb') as output:
+        np.savez(output, **arrays)
+
+
+def leaf_values(estimator):
+    """
+    Find the class probabilities predicted by each node of a fitted decision tree
+    :param estimator: fitted decision tree classifier
+    :return: array of shape (number of nodes, number of classes)
+    """
+    import sklearn
+    value = estimator.tree_.value[:, 0, :estimator.n_classes_]
+    if tuple(int(part) for part in sklearn.__version__.split('.')[:2]) < (1, 4):
+        # Older versions of scikit-learn store the class counts of each node, and normalise them at prediction time
+        normalizer = value.sum(axis=1)[:, np.newaxis]
+        normalizer[normalizer == 0.0] = 1.0
+        value = value / normalizer
+    return value
+
+
+def load_forest(forest_file):
+    """
+    :param forest_file: path of a .npz file written by export_forest
+    :return: ArrayForest
+    """
+    with np.load(forest_file, allow_pickle=False) as arrays:
+        return ArrayForest({name: arrays[name] for name in arrays.files})
+
+
+class ArrayForest(object):
+    """
+    Tree ensemble classifier backed by flat NumPy arrays. All the trees are walked for a whole batch of samples at
+    once, one level at a time, and the predictions are identical to those of the scikit-learn model it was exported from
+    """
+
+    def __init__(self, arrays):
+        """
+        :param arrays: dictionary of array name: array, as written by export_forest
+        """
+        self.feature = arrays['feature']
+        self.threshold = arrays['threshold']
+        self.left = arrays['left']
+        self.right = arrays['right']
+        self.missing_left = arrays['missing_left']
+        self.n_features_in_ = int(arrays['n_features'])
+        self.value = arrays['value']
+        self.roots = arrays['roots']
+        self.is_leaf = self.left == np.arange(self.left.size)
+        # The right and left children of each node, interleaved so that both are found with a single lookup
+        self.children = np.stack((self.right, self.left), axis=1).ravel()
+        self.has_missing = bool(self.missing_left.any())
+        self.classes_ = arrays['classes']
+        self.model_digest = str(arrays['model_digest']) or None
+        self.feature_names_in_ = arrays.get('feature_names')
+
+    def validate(self, x):
+        """
+        :param x: array-like or dataframe of features of shape (number of samples, number of features)
+        :return: array of the features as float32, as scikit-learn trees compare float32 features to their thresholds
+        """
+        columns = getattr(x, 'columns', None)
+        if columns is not None and self.feature_names_in_ is not None and \
+                list(columns) != self.feature_names_in_.tolist():
+            raise ValueError('The feature names should match those that were passed during fit')
+        x = np.asarray(x, dtype=np.float32)
+        if x.ndim != 2 or x.shape[1] != self.n_features_in_:
+            raise ValueError('Expected {} features, got array of shape {}'.format(self.n_features_in_, x.shape))
+        return x
+
+    def apply(self, x, chunk_size=4096):
+        """
+        Find the leaf of each tree that each sample ends up in
+        :param x: array-like or dataframe of features
+        :param chunk_size: number of samples to walk the trees with at once
+        :return: array of node indices of shape (number of samples, number of trees)
+        """
+        x = self.validate(x)
+        num_trees = self.roots.size
+        leaves = np.empty((x.shape[0], num_trees), dtype=np.int64)
+        for start in range(0, x.shape[0], chunk_size):
+            chunk = x[start:start + chunk_size]
+            # Flat array of the current node of every (sample, tree) pair, and the pairs that have not reached a leaf
+            nodes = np.tile(self.roots, chunk.shape[0])
+            active = np.flatnonzero(~self.is_leaf[nodes])
+            flat_chunk = chunk.ravel()
+            while active.size:
+                current = nodes[active]
+                values = flat_chunk[(active // num_trees) * self.n_features_in_ + self.feature[current]]
+                go_left = values <= self.threshold[current]
+                if self.has_missing:
+                    go_left |= np.isnan(values) & self.missing_left[current]
+                current = self.children[2 * current + go_left]
+                nodes[active] = current
+                active = active[~self.is_leaf[current]]
+            leaves[start:start + chunk_size] = nodes.reshape(chunk.shape[0], num_trees)
+        return leaves
+
+    def predict_proba(self, x):
+        """
+        :param x: array-like or dataframe of features
+        :return: array of class probabilities of shape (number of samples, number of classes)
+        """
+        leaves = self.apply(x)
+        probabilities = np.zeros((leaves.shape[0], self.value.shape[1]), dtype=np.float64)
+        # The trees are summed one at a time, in order, to match the floating point results of scikit-learn
+        for tree in range(leaves.shape[1]):
+            probabilities += self.value[leaves[:, tree]]
+        probabilities /= leaves.shape[1]
+        return probabilities
+
+    def predict(self, x):
+        """
+        :param x: array-like or dataframe of features
+        :return: array of the predicted class of each sample
+        """
+        return self.classes_.take(np.argmax(self.predict_proba(x), axis=1), axis=0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a pickled tree ensemble to NumPy arrays, so that samples can '
+                                                 'be classified without scikit-learn.')
+    parser.add_argument('model_file',
+                        help='Path of the pickled model e.g. model.p')
+    parser.add_argument('forest_file',
+                        help='Path of the .npz file to write e.g. model.npz')
+    args = parser.parse_args()
+    from genomeqaml import cache
+    with open(args.model_file, 'rb') as model_pickle:
+        export_forest(pickle.load(model_pickle), args.forest_file, model_digest=cache.file_digest(args.model_file))
+    print('Exported {} to {}'.format(args.model_file, args.forest_file))
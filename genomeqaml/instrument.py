@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+from contextlib import contextmanager
+import threading
+import resource
+import json
+import time
+import os
+__author__ = 'adamkoziol', 'andrewlow'
+
+# Columns of the summary table, after the stage name
+SUMMARY_COLUMNS = ['count', 'wall', 'cpu', 'child_cpu', 'bytes_read', 'peak_rss']
+# Record of the stage running in each thread, which child processes are charged to
+_current = threading.local()
+
+
+class Recorder(object):
+    """
+    Measure stages of a run, either of the whole run (e.g. writing the report), or of a single sample (e.g. running
+    prodigal on it). Each stage records its wall time, the CPU time of its thread, the CPU time of the child processes
+    it waited for, the bytes read by its thread, and the peak RSS of the process when it finished. Stages may run in
+    several threads at once
+    """
+
+    def __init__(self, jsonl_file=None, hook=None):
+        """
+        :param jsonl_file: optional path of a file to write each stage to as a line of JSON as soon as it finishes
+        :param hook: optional callable of stage name, strain name (None for stages of the whole run), that returns a
+        context manager to run each stage within e.g. ProfileHook
+        """
+        self.hook = hook
+        self.records = list()
+        self.lock = threading.Lock()
+        self.jsonl = open(jsonl_file, 'a') if jsonl_file else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.jsonl is not None:
+            self.jsonl.close()
+            self.jsonl = None
+
+    @contextmanager
+    def stage(self, name, sample=None):
+        """
+        Context manager that measures a stage
+        :param name: name of the stage e.g. stats, genus, orfs, report
+        :param sample: strain name, for the stages of a single sample
+        """
+        record = {'stage': name, 'sample': sample, 'start': time.time(), 'child_cpu': 0.0}
+        parent = getattr(_current, 'record', None)
+        _current.record = record
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        bytes_read = thread_bytes_read()
+        cpu = thread_cpu()
+        wall = time.perf_counter()
+        try:
+            with self.hook(name, sample) if self.hook is not None else null_context():
+                yield record
+        finally:
+            record['wall'] = time.perf_counter() - wall
+            record['cpu'] = thread_cpu() - cpu
+            end_bytes_read = thread_bytes_read()
+            record['bytes_read'] = end_bytes_read - bytes_read if bytes_read is not None and \
+                end_bytes_read is not None else None
+            if not record.pop('waited', False):
+                # Children that were not waited for with wait_child (e.g. mash screen run through a shell) are only
+                # counted across the whole process, which includes any other children that finished at the same time
+                end_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+                record['child_cpu'] = (end_children.ru_utime + end_children.ru_stime) - \
+                    (children.ru_utime + children.ru_stime)
+            record['peak_rss'] = peak_rss()
+            _current.record = parent
+            self.add(record)
+
+    def call(self, name, sample, function, *args):
+        """
+        Call a function as a stage, e.g. as the task of a worker
+        :param name: name of the stage
+        :param sample: strain name, or None
+        :param function: function to call
+        :param args: arguments of the function
+        :return: the return value of the function
+        """
+        with self.stage(name, sample):
+            return function(*args)
+
+    def add(self, record):
+        with self.lock:
+            self.records.append(record)
+            if self.jsonl is not None:
+                self.jsonl.write(json.dumps(record, sort_keys=True) + '\n')
+                self.jsonl.flush()
+
+    def summary(self):
+        """
+        :return: dictionary of stage name: dictionary of the number of times the stage ran, the total wall, CPU, and
+        child CPU time, the total bytes read, and the highest peak RSS, in the order the stages first finished
+        """
+        totals = dict()
+        with self.lock:
+            for record in self.records:
+                total = totals.setdefault(record['stage'], dict.fromkeys(SUMMARY_COLUMNS, 0))
+                total['count'] += 1
+                for column in ('wall', 'cpu', 'child_cpu', 'bytes_read'):
+                    total[column] += record[column] or 0
+                total['peak_rss'] = max(total['peak_rss'], record['peak_rss'])
+        return totals
+
+    def summary_table(self):
+        """
+        :return: the summary as a table of text. Times are in seconds, and sizes in MB
+        """
+        lines = ['{:<16}{:>8}{:>12}{:>12}{:>12}{:>14}{:>12}'.format('stage', *SUMMARY_COLUMNS)]
+        for name, total in self.summary().items():
+            lines.append('{:<16}{:>8}{:>12.3f}{:>12.3f}{:>12.3f}{:>14.1f}{:>12.1f}'.format(
+                name, total['count'], total['wall'], total['cpu'], total['child_cpu'], total['bytes_read'] / 1e6,
+                total['peak_rss'] / 1e6))
+        return '\n'.join(lines)
+
+
+class ProfileHook(object):
+    """
+    Hook for Recorder that runs each stage under cProfile, and combines the profiles of each stage, so that the
+    profile of e.g. every stats stage can be inspected with pstats or snakeviz
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: directory to write the profile of each stage to, as <stage>.prof
+        """
+        self.directory = directory
+        self.profiles = dict()
+        self.lock = threading.Lock()
+        # Profile of the stage running in each thread
+        self.local = threading.local()
+
+    @contextmanager
+    def __call__(self, name, sample=None):
+        # Only one profiler can run in a thread at a time, so the profile of an enclosing stage is paused while a stage
+        # within it runs, and each profile only covers the time spent outside of any nested stages
+        import cProfile
+        parent = getattr(self.local, 'profile', None)
+        if parent is not None:
+            parent.disable()
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Some versions of Python only allow one profiler across all threads - skip stages that overlap another
+            profile = None
+        self.local.profile = profile
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                with self.lock:
+                    self.profiles.setdefault(name, list()).append(profile)
+            self.local.profile = parent
+            if parent is not None:
+                parent.enable()
+
+    def save(self):
+        """
+        Write the combined profile of each stage
+        :return: list of the paths of the profiles
+        """
+        import pstats
+        os.makedirs(self.directory, exist_ok=True)
+        paths = list()
+        with self.lock:
+            for name, profiles in self.profiles.items():
+                path = os.path.join(self.directory, '{}.prof'.format(name))
+                pstats.Stats(*profiles).dump_stats(path)
+                paths.append(path)
+        return paths
+
+
+def stage(recorder, name, sample=None):
+    """
+    :param recorder: Recorder, or None if the run is not being measured
+    :param name: name of the stage
+    :param sample: strain name, for the stages of a single sample
+    :return: context manager that measures the stage with the recorder, if there is one
+    """
+    return recorder.stage(name, sample) if recorder is not None else null_context()
+
+
+def wait_child(process):
+    """
+    Wait for a child process, and charge its CPU time to the stage running in this thread
+    :param process: subprocess.Popen
+    :return: the return code of the process
+    """
+    record = getattr(_current, 'record', None)
+    if record is None or process.returncode is not None:
+        return process.wait()
+    try:
+        _, status, usage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        return process.wait()
+    process.returncode = exit_code(status)
+    record['child_cpu'] += usage.ru_utime + usage.ru_stime
+    record['waited'] = True
+    return process.returncode
+
+
+@contextmanager
+def null_context():
+    """
+    Context manager that does nothing, for stages that are not measured
+    """
+    yield
+
+
+def exit_code(status):
+    """
+    :param status: wait status of a child process, as returned by os.wait4
+    :return: return code of the process, as subprocess reports it: the negative of the signal that killed it, if any
+    """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def thread_cpu():
+    """
+    :return: CPU time used by the current thread, in seconds. Where per-thread usage is not available e.g. on platforms
+    other than Linux, this is the CPU time of the whole process
+    """
+    usage = resource.getrusage(getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF))
+    return usage.ru_utime + usage.ru_stime
+
+
+def thread_bytes_read():
+    """
+    :return: number of bytes read by the current thread (from files, pipes, and sockets), or None if this is not
+    available e.g. on platforms other than Linux. Pages of memory-mapped files are not read, and so are not counted
+    """
+    try:
+        with open('/proc/thread-self/io', 'rb') as io_file:
+            for line in io_file:
+                if line.startswith(b'rchar:'):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def peak_rss():
+    """
+    :return: peak resident set size of this process, in bytes
+    """
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@contextmanager
+def recording(metrics_file=None, summary=False, profile_dir=None):
+    """
+    Context manager for command line runs, which measures the run if any of the outputs are requested
+    :param metrics_file: optional path of a file to write each stage to as a line of JSON
+    :param summary: boolean to determine whether a summary table of the stages is printed at the end of the run
+    :param profile_dir: optional directory to write the cProfile profile of each stage to
+    :return: Recorder, or None if nothing is requested
+    """
+    if not (metrics_file or summary or profile_dir):
+        yield None
+        return
+    hook = ProfileHook(profile_dir) if profile_dir else None
+    recorder = Recorder(jsonl_file=metrics_file, hook=hook)
+    try:
+        yield recorder
+    finally:
+        recorder.close()
+        if summary:
+            print(recorder.summary_table())
+        if hook is not None:
+            hook.save()
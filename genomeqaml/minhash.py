@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+from collections import namedtuple
+from genomeqaml import compression
+import numpy as np
+import itertools
+import functools
+import struct
+__author__ = 'adamkoziol', 'andrewlow'
+
+# A single mash screen result - query_id is the name of the reference in the sketch, as in the mash screen output
+ScreenHit = namedtuple('ScreenHit', ['identity', 'shared_hashes', 'sketch_size', 'query_id'])
+
+# MurmurHash3_x64_128 constants
+C1 = np.uint64(0x87c37b91114253d5)
+C2 = np.uint64(0x4cf5ad432745937f)
+# Number of k-mers to hash at a time - bounds the memory used for the k-mer matrix
+KMER_CHUNK = 1048576
+
+# Encode nucleotides as two-bit integers (A < C < G < T, matching their ASCII order). Any other character is 4
+NUCLEOTIDE_CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _base in enumerate(b'ACGT'):
+    NUCLEOTIDE_CODES[_base] = _code
+COMPLEMENT = np.arange(256, dtype=np.uint8)
+for _base, _complement in zip(b'ACGT', b'TGCA'):
+    COMPLEMENT[_base] = _complement
+
+
+def load_index(sketch_file):
+    """
+    Load a mash sketch into a screening index. Indices are cached, so the sketch is only read once per process
+    :param sketch_file: path to a mash sketch e.g. refseq.msh
+    :return: ScreenIndex of the sketch
+    """
+    return _load_index(sketch_file)
+
+
+@functools.lru_cache(maxsize=4)
+def _load_index(sketch_file):
+    return ScreenIndex(read_sketch(sketch_file))
+
+
+class ScreenIndex(object):
+    """
+    In-memory equivalent of mash screen: the hashes of every reference in a sketch are held in a single sorted array,
+    and the k-mers of each query are hashed and looked up against it
+    """
+
+    def __init__(self, sketch):
+        """
+        :param sketch: dictionary of sketch parameters and references returned by read_sketch
+        """
+        self.kmer_size = sketch['kmer_size']
+        self.hash_seed = sketch['hash_seed']
+        self.noncanonical = sketch['noncanonical']
+        self.preserve_case = sketch['preserve_case']
+        self.names = [name for name, _ in sketch['references']]
+        self.sketch_sizes = np.array([hashes.size for _, hashes in sketch['references']], dtype=np.int64)
+        hashes = np.concatenate([hashes for _, hashes in sketch['references']] + [np.empty(0, dtype=np.uint64)])
+        reference_ids = np.repeat(np.arange(len(self.names)), self.sketch_sizes)
+        # Sort the hashes of all the references together, keeping track of the reference each came from
+        order = np.argsort(hashes, kind='stable')
+        self.hashes = hashes[order]
+        self.reference_ids = reference_ids[order]
+
+    def screen(self, fasta, min_identity=0.95):
+        """
+        Screen a FASTA file against the references in the sketch
+        :param fasta: /sequencepath/strain_name.extension
+        :param min_identity: minimum identity for a reference to be reported, as in mash screen -i
+        :return: list of ScreenHit for each reference passing the identity cutoff, sorted by descending identity
+        """
+        return self.screen_sequences(fasta_sequences(fasta), min_identity=min_identity)
+
+    def screen_sequences(self, sequences, min_identity=0.95):
+        """
+        Screen sequences against the references in the sketch
+        :param sequences: iterable of contig sequences (bytes)
+        :param min_identity: minimum identity for a reference to be reported, as in mash screen -i
+        :return: list of ScreenHit for each reference passing the identity cutoff, sorted by descending identity
+        """
+        matches = list()
+        for sequence in sequences:
+            if not self.preserve_case:
+                sequence = sequence.upper()
+            for query_hashes in kmer_hashes(sequence, self.kmer_size, self.hash_seed, self.noncanonical):
+                matches.append(query_hashes[self.contains(query_hashes)])
+        matched = np.unique(np.concatenate(matches + [np.empty(0, dtype=np.uint64)]))
+        # Count the hashes of each reference that are present in the query
+        shared = np.bincount(self.reference_ids[self.contains(self.hashes, matched)], minlength=len(self.names))
+        identities = estimate_identity(shared, self.sketch_sizes, self.kmer_size)
+        hits = [ScreenHit(float(identities[i]), int(shared[i]), int(self.sketch_sizes[i]), self.names[i])
+                for i in np.flatnonzero(identities >= min_identity)]
+        return sorted(hits, key=lambda hit: (-hit.identity, -hit.shared_hashes))
+
+    def contains(self, query_hashes, sorted_hashes=None):
+        """
+        Vectorised membership test of hashes against a sorted array of hashes
+        :param query_hashes: array of hashes to look up
+        :param sorted_hashes: sorted array to search. Defaults to the hashes of all the references
+        :return: boolean array of whether each query hash is present
+        """
+        if sorted_hashes is None:
+            sorted_hashes = self.hashes
+        if not sorted_hashes.size:
+            return np.zeros(query_hashes.size, dtype=bool)
+        positions = np.minimum(np.searchsorted(sorted_hashes, query_hashes), sorted_hashes.size - 1)
+        return sorted_hashes[positions] == query_hashes
+
+
+def estimate_identity(shared, sketch_sizes, kmer_size):
+    """
+    Estimate the identity of the query to each reference from the fraction of the reference sketch contained in the
+    query, in the same way as mash screen
+    :param shared: array of the number of sketch hashes found in the query for each reference
+    :param sketch_sizes: array of the number of hashes in the sketch of each reference
+    :param kmer_size: k-mer size of the sketch
+    :return: array of identities
+    """
+    containment = shared / np.maximum(sketch_sizes, 1)
+    identities = np.power(containment, 1.0 / kmer_size)
+    identities[shared == 0] = 0.0
+    identities[shared == sketch_sizes] = 1.0
+    return identities
+
+
+def fasta_sequences(fasta):
+    """
+    Yield the sequence of each contig in a FASTA file, one contig at a time. Compressed files are decompressed as they
+    are read
+    :param fasta: /sequencepath/strain_name.extension
+    :return: generator of contig sequences (bytes)
+    """
+    return chunk_sequences(compression.read_chunks(fasta))
+
+
+def chunk_sequences(chunks):
+    """
+    Yield the sequence of each contig in the contents of a FASTA file, one contig at a time
+    :param chunks: iterable of consecutive chunks of the file (bytes)
+    :return: generator of contig sequences (bytes)
+    """
+    sequence = list()
+    in_contig = False
+    # Lines can be split across chunks, so the last, incomplete, line of each chunk is carried over to the next
+    remainder = b''
+    for chunk in itertools.chain(chunks, [b'\n']):
+        lines = (remainder + chunk).split(b'\n')
+        remainder = lines.pop()
+        for line in lines:
+            if line.startswith(b'>'):
+                if in_contig:
+                    yield b''.join(sequence)
+                sequence = list()
+                in_contig = True
+            elif in_contig:
+                sequence.append(line.translate(None, b' \t\r'))
+    if in_contig:
+        yield b''.join(sequence)
+
+
+def kmer_hashes(sequence, kmer_size, seed=42, noncanonical=False):
+    """
+    Hash all the k-mers of a sequence in the same way as mash: k-mers containing characters other than ACGT are
+    skipped, the lexicographically smaller of each k-mer and its reverse complement is hashed (unless noncanonical),
+    and the hash is the first 64 bits of MurmurHash3_x64_128 (truncated to 32 bits for k-mer sizes of 16 or less)
+    :param sequence: contig sequence (bytes)
+    :param kmer_size: k-mer size
+    :param seed: hash seed
+    :param noncanonical: if True, hash the forward k-mers only
+    :return: generator of arrays of hashes, up to KMER_CHUNK hashes at a time
+    """
+    seq = np.frombuffer(sequence, dtype=np.uint8)
+    num_kmers = seq.size - kmer_size + 1
+    if num_kmers <= 0:
+        return
+    codes = NUCLEOTIDE_CODES[seq]
+    # Find the k-mers that do not contain any invalid characters
+    invalid = np.concatenate(([0], np.cumsum(codes == 4)))
+    valid = invalid[kmer_size:] == invalid[:num_kmers]
+    forward = windows(seq, kmer_size)
+    if not noncanonical:
+        # The reverse complement of the forward k-mer at position i starts at position length - k - i of the
+        # reverse complemented sequence
+        reverse = windows(COMPLEMENT[seq[::-1]], kmer_size)[::-1]
+    num_words = (kmer_size + 7) // 8
+    for start in range(0, num_kmers, KMER_CHUNK):
+        stop = min(start + KMER_CHUNK, num_kmers)
+        chunk_valid = valid[start:stop]
+        kmers = forward[start:stop][chunk_valid]
+        if not noncanonical:
+            use_forward = kmer_less_equal(codes[start:stop + kmer_size - 1], kmer_size, stop - start)
+            kmers = np.where(use_forward[chunk_valid, None], kmers, reverse[start:stop][chunk_valid])
+        # Pad each k-mer with zeros to a whole number of little-endian 64-bit words
+        padded = np.zeros((kmers.shape[0], num_words * 8), dtype=np.uint8)
+        padded[:, :kmer_size] = kmers
+        hashes = murmurhash3_x64_64(padded.view('<u8'), kmer_size, seed)
+        if kmer_size <= 16:
+            hashes &= np.uint64(0xffffffff)
+        yield hashes
+
+
+def windows(array, size):
+    """
+    Read-only view of every window of a one-dimensional array, as numpy.lib.stride_tricks.sliding_window_view gives in
+    NumPy 1.20 and later, which does not support Python 3.6
+    :param array: one-dimensional array
+    :param size: window size, no larger than the array
+    :return: array of shape (number of windows, size) that shares the memory of the array
+    """
+    return np.lib.stride_tricks.as_strided(array, shape=(array.size - size + 1, size),
+                                           strides=(array.strides[0], array.strides[0]), writeable=False)
+
+
+def kmer_less_equal(codes, kmer_size, num_kmers):
+    """
+    Determine whether each forward k-mer is lexicographically less than or equal to its reverse complement by packing
+    both into two-bit integers. Invalid k-mers give arbitrary results, and must be filtered separately
+    :param codes: array of two-bit nucleotide codes of the sequence
+    :param kmer_size: k-mer size (up to 32)
+    :param num_kmers: number of k-mers in the sequence
+    :return: boolean array
+    """
+    codes = (codes & 3).astype(np.uint64)
+    forward = np.zeros(num_kmers, dtype=np.uint64)
+    reverse = np.zeros(num_kmers, dtype=np.uint64)
+    for offset in range(kmer_size):
+        forward = (forward << np.uint64(2)) | codes[offset:offset + num_kmers]
+        # The reverse complement reads the k-mer backwards, with each base complemented (3 - code)
+        reverse = (reverse << np.uint64(2)) | (np.uint64(3) - codes[kmer_size - 1 - offset:
+                                                                   kmer_size - 1 - offset + num_kmers])
+    return forward <= reverse
+
+
+def rotl64(values, shift):
+    return (values << np.uint64(shift)) | (values >> np.uint64(64 - shift))
+
+
+def fmix64(values):
+    values ^= values >> np.uint64(33)
+    values *= np.uint64(0xff51afd7ed558ccd)
+    values ^= values >> np.uint64(33)
+    values *= np.uint64(0xc4ceb9fe1a85ec53)
+    values ^= values >> np.uint64(33)
+    return values
+
+
+def murmurhash3_x64_64(words, length, seed):
+    """
+    Vectorised MurmurHash3_x64_128, returning the first 64 bits of the hash of each key
+    :param words: 2D array of keys as zero-padded little-endian 64-bit words, one key per row
+    :param length: length of the keys in bytes
+    :param seed: hash seed
+    :return: array of 64-bit hashes
+    """
+    h1 = np.full(words.shape[0], seed, dtype=np.uint64)
+    h2 = h1.copy()
+    num_blocks = length // 16
+    for block in range(num_blocks):
+        k1 = words[:, 2 * block] * C1
+        k1 = rotl64(k1, 31) * C2
+        h1 ^= k1
+        h1 = rotl64(h1, 27) + h2
+        h1 = h1 * np.uint64(5) + np.uint64(0x52dce729)
+        k2 = words[:, 2 * block + 1] * C2
+        k2 = rotl64(k2, 33) * C1
+        h2 ^= k2
+        h2 = rotl64(h2, 31) + h1
+        h2 = h2 * np.uint64(5) + np.uint64(0x38495ab5)
+    # The remaining bytes of the key are zero-padded, so the tail can be read as whole words
+    tail = length & 15
+    if tail > 8:
+        k2 = words[:, 2 * num_blocks + 1] * C2
+        h2 ^= rotl64(k2, 33) * C1
+    if tail > 0:
+        k1 = words[:, 2 * num_blocks] * C1
+        h1 ^= rotl64(k1, 31) * C2
+    h1 ^= np.uint64(length)
+    h2 ^= np.uint64(length)
+    h1 += h2
+    h2 += h1
+    h1 = fmix64(h1)
+    h2 = fmix64(h2)
+    return h1 + h2
+
+
+def read_sketch(sketch_file):
+    """
+    Read the parameters and reference hashes of a mash sketch (a Cap'n Proto MinHash message)
+    :param sketch_file: path to a mash sketch e.g. refseq.msh
+    :return: dictionary of kmer_size, hash_seed, noncanonical, preserve_case, and references: list of tuples of
+    reference name, sorted array of hashes
+    """
+    with open(sketch_file, 'rb') as handle:
+        message = CapnpMessage(handle.read())
+    root = message.root()
+    reference_list = root.struct(0) or root.struct(1)
+    references = list()
+    if reference_list is not None:
+        for reference in reference_list.struct_list(0):
+            # The pointers of a reference are its sequence, quality, name, comment, hashes32, hashes64, and counts32
+            hashes = reference.list_array(5, '<u8')
+            if hashes is None:
+                hashes = reference.list_array(4, '<u4')
+            hashes = np.empty(0, dtype=np.uint64) if hashes is None else np.sort(hashes.astype(np.uint64))
+            references.append((reference.text(2), hashes))
+    return {'kmer_size': root.uint32(0),
+            # Sketches written before the seed was stored in the file use the mash default of 42
+            'hash_seed': root.uint32(5) or 42,
+            'noncanonical': root.bool(97),
+            'preserve_case': root.bool(98),
+            'references': references}
+
+
+class CapnpMessage(object):
+    """
+    Minimal reader for unpacked Cap'n Proto messages - supports the struct, list, text and far pointers needed to read
+    mash sketches
+    """
+
+    def __init__(self, data):
+        num_segments = struct.unpack_from('<I', data, 0)[0] + 1
+        sizes = struct.unpack_from('<{}I'.format(num_segments), data, 4)
+        # The segment table is padded to a whole number of words
+        offset = 4 + 4 * num_segments
+        offset += offset % 8
+        self.data = data
+        self.segments = list()
+        for size in sizes:
+            self.segments.append(offset)
+            offset += size * 8
+
+    def root(self):
+        return self.follow(0, 0)
+
+    def word(self, segment, position):
+        return struct.unpack_from('<Q', self.data, self.segments[segment] + position * 8)[0]
+
+    def follow(self, segment, position):
+        """
+        Follow the pointer stored at a word, returning the struct it points to (a CapnpStruct), or for list pointers,
+        a tuple of (segment, word position, element size, element count, tag)
+        """
+        pointer = self.word(segment, position)
+        if pointer == 0:
+            return None
+        tag = pointer
+        target_segment = segment
+        if pointer & 3 == 2:
+            # Far pointer - the landing pad is in another segment
+            target_segment = pointer >> 32
+            pad = (pointer & 0xffffffff) >> 3
+            if not pointer & 4:
+                return self.follow(target_segment, pad)
+            # Double-far pointer - the landing pad is a far pointer to the content, followed by a tag word
+            far = self.word(target_segment, pad)
+            tag = self.word(target_segment, pad + 1)
+            target_segment = far >> 32
+            target = (far & 0xffffffff) >> 3
+        else:
+            # Offsets are signed 30-bit word counts from the end of the pointer
+            offset = (pointer & 0xffffffff) >> 2
+            if offset & (1 << 29):
+                offset -= 1 << 30
+            target = position + 1 + offset
+        if tag & 3 == 0:
+            return CapnpStruct(self, target_segment, target, (tag >> 32) & 0xffff, tag >> 48)
+        return target_segment, target, (tag >> 32) & 7, tag >> 35
+
+
+class CapnpStruct(object):
+
+    def __init__(self, message, segment, position, data_words, pointer_words):
+        self.message = message
+        self.segment = segment
+        self.position = position
+        self.data_words = data_words
+        self.pointer_words = pointer_words
+
+    def uint32(self, index):
+        # Fields beyond the end of the data section take their default value
+        if index * 4 >= self.data_words * 8:
+            return 0
+        start = self.message.segments[self.segment] + self.position * 8 + index * 4
+        return struct.unpack_from('<I', self.message.data, start)[0]
+
+    def bool(self, bit):
+        if bit >= self.data_words * 64:
+            return False
+        start = self.message.segments[self.segment] + self.position * 8 + bit // 8
+        return bool(self.message.data[start] >> (bit % 8) & 1)
+
+    def pointer(self, index):
+        if index >= self.pointer_words:
+            return None
+        return self.message.follow(self.segment, self.position + self.data_words + index)
+
+    def struct(self, index):
+        return self.pointer(index)
+
+    def list_array(self, index, dtype):
+        target = self.pointer(index)
+        if target is None:
+            return None
+        segment, position, _, count = target
+        return np.frombuffer(self.message.data, dtype=dtype, count=count,
+                             offset=self.message.segments[segment] + position * 8)
+
+    def text(self, index):
+        array = self.list_array(index, np.uint8)
+        if array is None:
+            return str()
+        # Text is stored with a trailing NUL byte
+        return array[:-1].tobytes().decode()
+
+    def struct_list(self, index):
+        target = self.pointer(index)
+        if target is None:
+            return list()
+        segment, position, _, _ = target
+        # Lists of structs are composite lists - the first word is a tag holding the element count and struct size
+        tag = self.message.word(segment, position)
+        count = (tag & 0xffffffff) >> 2
+        data_words = (tag >> 32) & 0xffff
+        pointer_words = tag >> 48
+        size = data_words + pointer_words
+        return [CapnpStruct(self.message, segment, position + 1 + i * size, data_words, pointer_words)
+                for i in range(count)]
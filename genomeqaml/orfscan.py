@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+from genomeqaml import minhash
+import numpy as np
+__author__ = 'adamkoziol', 'andrewlow'
+
+# Fast, approximate alternative to prodigal for the ORF size range features. Every start-to-stop open reading frame in
+# the six frames of a sample is found with array operations, and ORFs that overlap a longer one (e.g. the shadows of a
+# gene in the other frames) are dropped. Unlike prodigal, no gene model is trained, and the most upstream start codon
+# of each ORF is used. benchmarks/orf_accuracy.py compares the two
+
+# Version of the scan - increment whenever the ORFs that are found change, so that cached rows are not reused
+SCAN_VERSION = 1
+# Start codons of bacterial genes, and stop codons, as in translation table 11
+START_CODONS = (b'ATG', b'GTG', b'TTG')
+STOP_CODONS = (b'TAA', b'TAG', b'TGA')
+# Shortest ORF that is counted, including its stop codon. prodigal calls genes from 90 bp, but without a gene model
+# most short ORFs are spurious. In the sweep of benchmarks/results/orf_accuracy.json, against Prodigal V2.6.3 on
+# synthetic genomes with planted genes, 150 bp is closest at a GC fraction of 0.35, and 180 bp at 0.5, while the two are
+# as close at 0.65
+MIN_LENGTH = 150
+# Largest number of bases by which two ORFs that are both counted may overlap, as prodigal allows for genes on the
+# same strand. Of two ORFs that overlap by more, the shorter is dropped
+MAX_OVERLAP = 60
+# Codons that contain anything other than A, C, G, or T, such as the Ns of scaffold gaps, are coded as INVALID. Contigs
+# are joined with enough Ns that every frame has an invalid codon between them
+INVALID = 64
+SEPARATOR = b'NNN'
+# Nucleotide codes of the complement of each base
+COMPLEMENT_CODES = np.array([3, 2, 1, 0, 4], dtype=np.uint8)
+
+
+def codon_table(codons):
+    """
+    :param codons: iterable of codons (bytes)
+    :return: boolean array of whether each codon code (and INVALID) is one of the codons
+    """
+    table = np.zeros(INVALID + 1, dtype=bool)
+    for codon in codons:
+        table[minhash.NUCLEOTIDE_CODES[np.frombuffer(codon, dtype=np.uint8)].dot([16, 4, 1])] = True
+    return table
+
+
+START_TABLE = codon_table(START_CODONS)
+STOP_TABLE = codon_table(STOP_CODONS)
+
+
+def encode(sequences):
+    """
+    Join the contigs of a sample into a single array of nucleotide codes, separated by Ns
+    :param sequences: iterable of contig sequences (bytes)
+    :return: array of the nucleotide codes of the sample, starting and ending with Ns
+    """
+    joined = SEPARATOR + SEPARATOR.join(sequences) + SEPARATOR
+    return minhash.NUCLEOTIDE_CODES[np.frombuffer(joined.upper(), dtype=np.uint8)]
+
+
+def codon_codes(codes):
+    """
+    :param codes: array of nucleotide codes
+    :return: array of the code (0-63, or INVALID) of the codon starting at each position
+    """
+    first, second, third = codes[:-2], codes[1:-1], codes[2:]
+    codons = first * 16 + second * 4 + third
+    # Codes 0-3 are the only ones without the 4 bit set
+    codons[((first | second | third) & 4) != 0] = INVALID
+    return codons
+
+
+def strand_orfs(codes, min_length=MIN_LENGTH, partial=True):
+    """
+    Find the ORFs on the forward strand of a sequence, in each of its three frames. Each ORF runs from the most upstream
+    start codon after a stop codon to the next stop codon in the same frame
+    :param codes: array of nucleotide codes, starting and ending with Ns
+    :param min_length: shortest ORF to find
+    :param partial: boolean to determine whether ORFs that run off the end of a contig, or into Ns, are found, as
+    prodigal does by default. These begin at the first codon of the contig, and end at the last
+    :return: begins, ends: arrays of the first position of each ORF, and the position after its last
+    """
+    codons = codon_codes(codes)
+    begins = list()
+    ends = list()
+    for frame in range(3):
+        frame_codons = codons[frame::3]
+        positions = np.arange(frame, len(codons), 3)
+        edges = frame_codons == INVALID
+        is_boundary = STOP_TABLE[frame_codons] | edges
+        boundaries = positions[is_boundary]
+        boundary_edges = edges[is_boundary]
+        # The last position is beyond every boundary, so every boundary has a following start
+        starts = np.append(positions[START_TABLE[frame_codons]], len(codons))
+        # Each pair of consecutive boundaries encloses an open reading frame
+        left, right = boundaries[:-1], boundaries[1:]
+        first_start = starts[np.searchsorted(starts, left)]
+        if partial:
+            begin = np.where(boundary_edges[:-1], left + 3, first_start)
+            end = np.where(boundary_edges[1:], right, right + 3)
+        else:
+            begin = np.where(boundary_edges[1:], right, first_start)
+            end = right + 3
+        found = (begin < right) & (end - begin >= min_length)
+        begins.append(begin[found])
+        ends.append(end[found])
+    return np.concatenate(begins), np.concatenate(ends)
+
+
+def overlapped(begins, ends, ranks, max_overlap=MAX_OVERLAP):
+    """
+    :param begins: array of the first position of each ORF
+    :param ends: array of the position after the last of each ORF
+    :param ranks: array of the rank of each ORF. Of two overlapping ORFs, the one with the higher rank is kept
+    :param max_overlap: number of bases by which ORFs may overlap
+    :return: boolean array of whether each ORF overlaps a higher ranked ORF that begins before it by more than
+    max_overlap bases. Only the earlier ORF that reaches furthest is checked, which is the one that overlaps it most
+    """
+    order = np.lexsort((-ends, begins))
+    if not len(order):
+        return np.zeros(0, dtype=bool)
+    ordered_ends = ends[order]
+    reach = np.maximum.accumulate(ordered_ends)
+    # Index (in order) of the latest ORF that reaches furthest
+    holder = np.maximum.accumulate(np.where(ordered_ends == reach, np.arange(len(order)), 0))
+    overlap = np.minimum(reach[:-1], ordered_ends[1:]) - begins[order][1:]
+    dropped = np.empty(len(order), dtype=bool)
+    ordered_ranks = ranks[order]
+    outranked = ordered_ranks[holder[:-1]] > ordered_ranks[1:]
+    dropped[order] = np.concatenate(([False], (overlap > max_overlap) & outranked))
+    return dropped
+
+
+def find_orfs(sequences, min_length=MIN_LENGTH, max_overlap=MAX_OVERLAP, partial=True):
+    """
+    Find the ORFs in the six frames of a sample. ORFs that overlap a longer ORF on either strand are dropped
+    :param sequences: iterable of contig sequences (bytes)
+    :param min_length: shortest ORF to find
+    :param max_overlap: number of bases by which ORFs may overlap
+    :param partial: boolean to determine whether ORFs that run off the end of a contig are found
+    :return: begins, ends: arrays of the first position of each ORF, and the position after its last, on the forward
+    strand of the joined contigs of the sample
+    """
+    codes = encode(sequences)
+    forward_begins, forward_ends = strand_orfs(codes, min_length, partial)
+    reverse_begins, reverse_ends = strand_orfs(COMPLEMENT_CODES[codes[::-1]], min_length, partial)
+    # Positions on the reverse strand are counted from the other end
+    begins = np.concatenate((forward_begins, len(codes) - reverse_ends))
+    ends = np.concatenate((forward_ends, len(codes) - reverse_begins))
+    # Longer ORFs are ranked higher, and of ORFs of the same length, the one that begins first. An ORF that overlaps a
+    # higher ranked one is found by checking the ORFs that begin before it, and, by reversing the positions, the ORFs
+    # that end after it
+    ranks = np.empty(len(begins), dtype=np.int64)
+    ranks[np.lexsort((-begins, ends - begins))] = np.arange(len(begins))
+    keep = ~(overlapped(begins, ends, ranks, max_overlap) | overlapped(-ends, -begins, ranks, max_overlap))
+    return begins[keep], ends[keep]
+
+
+def orf_distribution(sequences, min_length=MIN_LENGTH, max_overlap=MAX_OVERLAP, partial=True):
+    """
+    Determine the frequency of ORF size ranges of a sample, as extract_features.orf_distribution does for prodigal
+    :param sequences: iterable of contig sequences (bytes)
+    :param min_length: shortest ORF to count
+    :param max_overlap: number of bases by which ORFs may overlap
+    :param partial: boolean to determine whether ORFs that run off the end of a contig are counted
+    :return: tuple of the total number of ORFs, and the number of ORFs over 3000, 1000, and 500 bp, and all others
+    """
+    begins, ends = find_orfs(sequences, min_length, max_overlap, partial)
+    # prodigal reports the first and last base of each gene, so its sizes are one less than the length
+    sizes = ends - begins - 1
+    over_3000 = int(np.count_nonzero(sizes > 3000))
+    over_1000 = int(np.count_nonzero(sizes > 1000)) - over_3000
+    over_500 = int(np.count_nonzero(sizes > 500)) - over_3000 - over_1000
+    return len(sizes), over_3000, over_1000, over_500, len(sizes) - over_3000 - over_1000 - over_500
+
+
+def sample_orfs(fasta):
+    """
+    Scan a single sample for ORFs, and determine the frequency of ORF size ranges. Compressed files are decompressed as
+    they are read
+    :param fasta: /sequencepath/strain_name.extension
+    :return: tuple of ORF size range distribution frequencies
+    """
+    return orf_distribution(minhash.fasta_sequences(fasta))
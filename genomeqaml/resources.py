@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+from collections import namedtuple
+import math
+import os
+__author__ = 'adamkoziol', 'andrewlow'
+
+# Split of a CPU budget: the number of tasks to run at once, and the number of threads given to each external tool
+CpuBudget = namedtuple('CpuBudget', ['workers', 'tool_threads'])
+
+
+def available_cpus(cgroup_root='/sys/fs/cgroup'):
+    """
+    Determine the number of CPUs this process is allowed to use: the smaller of the CPUs in its affinity mask, and the
+    CPU quota of its cgroup (rounded up), if any
+    :param cgroup_root: mount point of the cgroup filesystem
+    :return: number of CPUs
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        # sched_getaffinity is not available on all platforms
+        import multiprocessing
+        cpus = multiprocessing.cpu_count()
+    quota = cgroup_cpu_quota(cgroup_root)
+    if quota is not None:
+        cpus = min(cpus, max(1, int(math.ceil(quota))))
+    return cpus
+
+
+def cgroup_cpu_quota(cgroup_root='/sys/fs/cgroup'):
+    """
+    Read the CPU quota of the cgroup of this process, as a (fractional) number of CPUs. Both cgroup v2 (cpu.max) and
+    cgroup v1 (cpu.cfs_quota_us and cpu.cfs_period_us) are supported
+    :param cgroup_root: mount point of the cgroup filesystem
+    :return: number of CPUs allowed by the quota, or None if there is no quota
+    """
+    quotas = list()
+    for directory in cgroup_directories(cgroup_root):
+        try:
+            with open(os.path.join(directory, 'cpu.max')) as cpu_max:
+                quota, period = cpu_max.read().split()
+        except (IOError, OSError, ValueError):
+            try:
+                with open(os.path.join(directory, 'cpu.cfs_quota_us')) as cfs_quota:
+                    quota = cfs_quota.read().strip()
+                with open(os.path.join(directory, 'cpu.cfs_period_us')) as cfs_period:
+                    period = cfs_period.read().strip()
+            except (IOError, OSError):
+                continue
+        # An unlimited quota is written as 'max' in cgroup v2, and -1 in cgroup v1
+        if quota != 'max' and int(quota) > 0 and int(period) > 0:
+            quotas.append(int(quota) / int(period))
+    return min(quotas) if quotas else None
+
+
+def cgroup_directories(cgroup_root='/sys/fs/cgroup'):
+    """
+    Find the directories that may hold the CPU controller files of this process. Within a container, the cgroup of the
+    process is usually mounted at the root, otherwise it is the path listed in /proc/self/cgroup
+    :param cgroup_root: mount point of the cgroup filesystem
+    :return: list of directories
+    """
+    directories = list()
+    for controller in ('', 'cpu', 'cpu,cpuacct', 'cpuacct,cpu'):
+        directories.append(os.path.join(cgroup_root, controller))
+    try:
+        with open('/proc/self/cgroup') as cgroups:
+            for line in cgroups:
+                # Lines are formatted as hierarchy-ID:controller-list:cgroup-path
+                _, controllers, path = line.rstrip('\n').split(':', 2)
+                if controllers == '':
+                    directories.append(os.path.join(cgroup_root, path.lstrip('/')))
+                elif 'cpu' in controllers.split(','):
+                    directories.append(os.path.join(cgroup_root, controllers, path.lstrip('/')))
+    except (IOError, OSError, ValueError):
+        pass
+    return [directory for directory in directories if os.path.isdir(directory)]
+
+
+def split_cpus(total, num_samples=None, tool_threads=None):
+    """
+    Split a CPU budget between concurrent tasks and the threads of each external tool, so that no more than the
+    budget is in use at once. By default, every task is single-threaded, unless there are fewer samples than CPUs, in
+    which case the spare CPUs are given to the external tools
+    :param total: number of CPUs in the budget
+    :param num_samples: number of samples to process
+    :param tool_threads: number of threads for each external tool (mash). Calculated if not provided
+    :return: CpuBudget of the number of workers, and the number of threads for each external tool
+    """
+    total = max(1, total)
+    if tool_threads is None:
+        tool_threads = total // max(1, min(total, num_samples or total))
+    tool_threads = max(1, min(tool_threads, total))
+    return CpuBudget(workers=max(1, total // tool_threads), tool_threads=tool_threads)
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib import request as urllib_request
+from genomeqaml import cache, classify, extract_features, resources, tools
+import pandas as pd
+import threading
+import argparse
+import queue
+import time
+import json
+import os
+__author__ = 'adamkoziol', 'andrewlow'
+
+
+class PredictionBatcher(object):
+    """
+    Classify the feature rows of concurrent requests together. Rows queued while the model is busy, or within a short
+    wait of each other, are passed to the model in a single predict_proba call
+    """
+
+    def __init__(self, model, features, max_batch=1024, max_wait=0.005):
+        """
+        :param model: classifier
+        :param features: ordered list of the features of the model, from the schema
+        :param max_batch: maximum number of rows to classify at once
+        :param max_wait: time in seconds to wait for further rows before classifying a batch
+        """
+        self.model = model
+        self.features = features
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='prediction-batcher', daemon=True)
+        self.thread.start()
+
+    def classify(self, rows):
+        """
+        :param rows: list of dictionaries of report column: value. Must not be empty
+        :return: list of tuples of strain name, predicted class, and percent probabilities of fail, pass, and reference
+        """
+        # Rows are checked here, so that a bad request does not fail the rest of its batch
+        test_df = classify.features_frame(rows)
+        future = Future()
+        self.queue.put((test_df, future))
+        return future.result()
+
+    def run(self):
+        while True:
+            pending = [self.queue.get()]
+            num_rows = len(pending[0][0])
+            deadline = time.monotonic() + self.max_wait
+            while num_rows < self.max_batch:
+                try:
+                    test_df, future = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                pending.append((test_df, future))
+                num_rows += len(test_df)
+            try:
+                results = classify.classify_features(self.model,
+                                                     pd.concat([test_df for test_df, _ in pending], ignore_index=True),
+                                                     self.features)
+            except Exception as exc:
+                for _, future in pending:
+                    future.set_exception(exc)
+                continue
+            start = 0
+            for test_df, future in pending:
+                future.set_result(results[start:start + len(test_df)])
+                start += len(test_df)
+
+
+class ClassificationService(object):
+    """
+    The model, feature schema, and extraction settings of a classification server, loaded once
+    """
+
+    def __init__(self, model, features, refseq_database, num_threads=4, genus_method='mash', tool_threads=None,
+                 cache_dir=None, orf_method='prodigal', tool_runner=None):
+        """
+        :param model: classifier
+        :param features: ordered list of the features of the model, from the schema
+        :param refseq_database: Path to reduced refseq database sketch
+        :param num_threads: number of CPUs to use to extract features, shared between all the requests
+        :param genus_method: 'mash' to screen samples with the mash executable, 'batch' to compare batches of samples
+        to the sketch with a single mash dist each, or 'minhash' to screen them in-process
+        :param tool_threads: Number of threads to give each external tool. Defaults to one
+        :param cache_dir: optional directory of a persistent cache of extracted features
+        :param orf_method: 'prodigal' to predict ORFs with the prodigal executable, or 'orfscan' to find them in-process
+        :param tool_runner: optional tools.ToolRunner with the time limit and retries of mash and prodigal
+        """
+        self.batcher = PredictionBatcher(model, features)
+        self.refseq_database = refseq_database
+        self.num_threads = num_threads
+        self.genus_method = genus_method
+        self.orf_method = orf_method
+        self.tool_runner = tool_runner
+        # Every request runs on one pool of workers, and each tool is given the same number of threads however many
+        # samples a request has, so that concurrent requests stay within num_threads between them
+        budget = resources.split_cpus(num_threads, tool_threads=tool_threads)
+        self.tool_threads = budget.tool_threads
+        self.executor = ThreadPoolExecutor(max_workers=budget.workers)
+        self.feature_cache = None
+        if cache_dir:
+            self.feature_cache = cache.FeatureCache(cache_dir,
+                                                    context=cache.cache_context(refseq_database, genus_method,
+                                                                                orf_method))
+
+    def classify_request(self, request):
+        """
+        Classify the samples of a request
+        :param request: dictionary with a list of FASTA paths under 'fasta', and/or a list of dictionaries of report
+        column: value under 'rows'
+        :return: dictionary of the response: a list of dictionaries of classification report column: value under
+        'results', and a list of dictionaries of the Sample and error of each sample whose features could not be
+        extracted under 'failures'
+        """
+        rows = list(request.get('rows', list()))
+        fastas = request.get('fasta', list())
+        failures = dict()
+        if fastas:
+            rows.extend(self.extract(fastas, failures))
+        results = list()
+        if rows:
+            results = [dict(zip(classify.REPORT_COLUMNS, result)) for result in self.batcher.classify(rows)]
+        return {'results': results,
+                'failures': [{'Sample': file_name, 'error': str(error)}
+                             for file_name, error in sorted(failures.items())]}
+
+    def close(self):
+        """
+        Wait for running extractions to finish, and stop the workers
+        """
+        self.executor.shutdown(wait=True)
+
+    def extract(self, fastas, failures=None):
+        """
+        :param fastas: list of paths of FASTA files. Samples are named after their files, so the names must be unique
+        :param failures: optional dictionary to record the samples whose tools failed in, as strain name: reason
+        :return: list of dictionaries of report column: value
+        """
+        missing = [fasta for fasta in fastas if not os.path.isfile(fasta)]
+        if missing:
+            raise ValueError('FASTA files not found: {}'.format(', '.join(missing)))
+        file_dict = extract_features.filer(fastas)
+        if len(file_dict) < len(fastas):
+            names = [name for fasta in fastas for name in extract_features.filer([fasta])]
+            raise ValueError('Sample names must be unique: {}'.format(', '.join(sorted(
+                set(name for name in names if names.count(name) > 1)))))
+        return [row for _, row in extract_features.extract_samples(file_dict,
+                                                                    refseq_database=self.refseq_database,
+                                                                    num_threads=self.num_threads,
+                                                                    genus_method=self.genus_method,
+                                                                    tool_threads=self.tool_threads,
+                                                                    feature_cache=self.feature_cache,
+                                                                    tool_runner=self.tool_runner,
+                                                                    failures=failures,
+                                                                    orf_method=self.orf_method,
+                                                                    executor=self.executor)]
+
+
+class ClassificationHandler(BaseHTTPRequestHandler):
+    """
+    POST /classify with a JSON body of {"fasta": [paths]} and/or {"rows": [feature rows]}. GET /health to check that
+    the server is up
+    """
+
+    def do_GET(self):
+        if self.path != '/health':
+            self.send_json(404, {'error': 'Not found'})
+            return
+        self.send_json(200, {'status': 'ok'})
+
+    def do_POST(self):
+        if self.path != '/classify':
+            self.send_json(404, {'error': 'Not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode())
+            if not isinstance(request, dict):
+                raise ValueError('Request must be a JSON object')
+            response = self.server.service.classify_request(request)
+        except (ValueError, KeyError, TypeError) as exc:
+            self.send_json(400, {'error': str(exc)})
+            return
+        except Exception as exc:
+            self.send_json(500, {'error': str(exc)})
+            return
+        self.send_json(200, response)
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class ClassificationServer(ThreadingMixIn, HTTPServer):
+    # Samples are often submitted in bursts as a run finishes assembling - the default backlog of five pending
+    # connections resets the rest
+    request_queue_size = 128
+
+
+def make_server(service, host='127.0.0.1', port=8080, verbose=False):
+    """
+    :param service: ClassificationService
+    :param host: address to listen on. Only the local machine can connect by default
+    :param port: port to listen on. 0 picks a free port
+    :param verbose: boolean to determine whether requests are logged
+    :return: server. Call serve_forever to start handling requests
+    """
+    server = ClassificationServer((host, port), ClassificationHandler)
+    server.daemon_threads = True
+    server.service = service
+    server.verbose = verbose
+    return server
+
+
+def request_classification(url='http://127.0.0.1:8080', fasta=None, rows=None, timeout=None, failures=None):
+    """
+    Classify samples with a running server
+    :param url: URL of the server
+    :param fasta: list of paths of FASTA files. These must be readable by the server, and have unique file names
+    :param rows: list of dictionaries of report column: value
+    :param timeout: time in seconds to wait for a response
+    :param failures: optional dictionary to record the samples whose features could not be extracted in, as strain
+    name: reason. These samples have no results
+    :return: list of dictionaries of classification report column: value
+    """
+    body = json.dumps({'fasta': fasta or list(), 'rows': rows or list()}).encode()
+    req = urllib_request.Request(url.rstrip('/') + '/classify', data=body, headers={'Content-Type': 'application/json'})
+    with urllib_request.urlopen(req, timeout=timeout) as response:
+        response = json.loads(response.read().decode())
+    if failures is not None:
+        failures.update((failure['Sample'], failure['error']) for failure in response.get('failures', list()))
+    return response['results']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Keep the GenomeQAML model loaded, and classify samples on request.')
+    parser.add_argument('-p', '--port',
+                        type=int,
+                        default=8080,
+                        help='Port to listen on. Default is 8080.')
+    parser.add_argument('--host',
+                        type=str,
+                        default='127.0.0.1',
+                        help='Address to listen on. Default is 127.0.0.1, which only accepts local connections.')
+    parser.add_argument('-n', '--num_threads',
+                        type=int,
+                        default=resources.available_cpus(),
+                        help='Number of threads to extract features with, shared between all the requests. Defaults '
+                             'to the number of CPUs available.')
+    parser.add_argument('--tool_threads',
+                        type=int,
+                        default=None,
+                        help='Number of threads to give each external tool.')
+    parser.add_argument('-g', '--genus_method',
+                        choices=['mash', 'batch', 'minhash'],
+                        default='mash',
+                        help='Determine genera with the mash executable (default), with a single mash dist for each'
+                             ' batch of samples (batch), or in-process with minhash.')
+    parser.add_argument('-o', '--orf_method',
+                        choices=['prodigal', 'orfscan'],
+                        default='prodigal',
+                        help='Predict ORFs with the prodigal executable (default), or in-process with a fast,'
+                             ' approximate scan. orfscan needs a --model_file and --schema_file trained on orfscan'
+                             ' features, as the bundled model was trained on prodigal ORFs.')
+    parser.add_argument('-c', '--cache_dir',
+                        type=str,
+                        default=None,
+                        help='Directory of a persistent cache of extracted features.')
+    parser.add_argument('-m', '--model_file',
+                        type=str,
+                        default=None,
+                        help='Pickled model, or model exported to NumPy arrays (.npz). Defaults to the bundled model.')
+    parser.add_argument('--schema_file',
+                        type=str,
+                        default=None,
+                        help='Feature schema of the model, written alongside it by scikit_learn_test.py. Defaults to'
+                             ' the bundled schema.json.')
+    parser.add_argument('--tool_timeout',
+                        type=float,
+                        default=None,
+                        help='Kill mash or prodigal if a single run on a sample takes longer than this many seconds. By'
+                             ' default, tools are not time limited.')
+    parser.add_argument('--tool_retries',
+                        type=int,
+                        default=tools.DEFAULT_RETRIES,
+                        help='Number of times to run mash or prodigal again if it fails or times out. Samples whose'
+                             ' tools still fail are listed under failures in the response. Default is {}.'
+                             .format(tools.DEFAULT_RETRIES))
+    parser.add_argument('-v', '--verbose',
+                        action='store_true',
+                        help='Log every request.')
+    args = parser.parse_args()
+    if args.tool_timeout is not None and args.tool_timeout <= 0 or args.tool_retries < 0:
+        parser.error('--tool_timeout must be positive, and --tool_retries must not be negative')
+    model_path = args.model_file or classify.default_model_file()
+    feature_schema = classify.load_schema(args.schema_file)
+    try:
+        classify.check_schema(feature_schema, model_path, args.orf_method)
+    except ValueError as error:
+        parser.error(str(error))
+    service = ClassificationService(model=classify.load_model(model_path),
+                                    features=feature_schema['features'],
+                                    refseq_database=classify.data_file('refseq.msh'),
+                                    num_threads=args.num_threads,
+                                    genus_method=args.genus_method,
+                                    orf_method=args.orf_method,
+                                    tool_threads=args.tool_threads,
+                                    cache_dir=args.cache_dir,
+                                    tool_runner=tools.ToolRunner(timeout=args.tool_timeout,
+                                                                 retries=args.tool_retries))
+    server = make_server(service,
+                         host=args.host,
+                         port=args.port,
+                         verbose=args.verbose)
+    print('Listening on http://{}:{}'.format(*server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+from genomeqaml import cache, extract_features, resources, tools
+from multiprocessing.pool import ThreadPool
+from collections import Counter
+import re
+import argparse
+import heapq
+import json
+import os
+__author__ = 'adamkoziol', 'andrewlow'
+
+MANIFEST_VERSION = 1
+# Each shard writes its report to its own folder in the output directory, along with a record of the samples it
+# extracted, which is only written once the report is complete
+SHARD_FOLDER = 'shard_{:05d}_of_{:05d}'
+SHARD_RECORD = 'shard.json'
+
+
+def build_manifest(sequencepath, num_threads=None):
+    """
+    Record every sample in a folder, along with the size and digest of its FASTA file
+    :param sequencepath: path of folder containing FASTA genomes
+    :param num_threads: number of files to calculate the digest of at once. Defaults to the number of CPUs available
+    :return: dictionary of the manifest
+    """
+    sequencepath = os.path.abspath(sequencepath)
+    files = extract_features.find_files(sequencepath)
+    file_dict = extract_features.filer(files)
+    if len(file_dict) != len(files):
+        # e.g. strain.fasta and strain.fasta.gz - the report can only hold one row per strain name
+        name_counts = Counter(name for fasta in files for name in extract_features.filer([fasta]))
+        raise ValueError('Several FASTA files share the strain names {}'.format(
+            ', '.join(sorted(name for name, count in name_counts.items() if count > 1))))
+    names = sorted(file_dict)
+    # Reading the files is I/O bound, and hashlib releases the GIL, so threads are sufficient
+    pool = ThreadPool(processes=max(1, num_threads or resources.available_cpus()))
+    try:
+        digests = pool.map(cache.file_digest, [file_dict[name] for name in names])
+    finally:
+        pool.close()
+        pool.join()
+    return {'version': MANIFEST_VERSION,
+            'sequencepath': sequencepath,
+            'samples': [{'name': name,
+                         'file': os.path.basename(file_dict[name]),
+                         'size': os.path.getsize(file_dict[name]),
+                         'digest': digest} for name, digest in zip(names, digests)]}
+
+
+def write_json(data, json_file):
+    """
+    Atomically write a manifest or the record of a shard
+    :param data: dictionary to write
+    :param json_file: path of the file
+    """
+    tmp_file = '{}.{}.tmp'.format(json_file, os.getpid())
+    with open(tmp_file, 'w') as json_handle:
+        json.dump(data, json_handle, indent=1)
+    os.replace(tmp_file, json_file)
+
+
+def read_manifest(manifest_file):
+    """
+    :param manifest_file: path of the manifest
+    :return: dictionary of the manifest
+    """
+    with open(manifest_file) as manifest_json:
+        manifest = json.load(manifest_json)
+    if manifest.get('version', 0) > MANIFEST_VERSION:
+        raise ValueError('{} was written by a newer version of GenomeQAML'.format(manifest_file))
+    return manifest
+
+
+def assign_shards(samples, num_shards):
+    """
+    Split samples between shards so that each shard has about the same total genome size. Samples are assigned
+    largest first, each to the shard with the least data so far. The assignment only depends on the manifest, so every
+    worker calculates the same split without communicating
+    :param samples: list of dictionaries of sample name, file, size, and digest from the manifest
+    :param num_shards: number of shards
+    :return: list of the list of samples in each shard, sorted by name
+    """
+    if num_shards < 1:
+        raise ValueError('There must be at least one shard')
+    shards = [list() for _ in range(num_shards)]
+    # Heap of the total size and index of each shard. Ties go to the shard with the lowest index
+    totals = [(0, shard) for shard in range(num_shards)]
+    for sample in sorted(samples, key=lambda sample: (-sample['size'], sample['name'])):
+        total, shard = heapq.heappop(totals)
+        shards[shard].append(sample)
+        heapq.heappush(totals, (total + sample['size'], shard))
+    return [sorted(shard_samples, key=lambda sample: sample['name']) for shard_samples in shards]
+
+
+def array_task(shard=None, num_shards=None, environ=None):
+    """
+    Determine the shard of this worker. Shards that are not given are taken from the Slurm array task, so that each task
+    of e.g. sbatch --array=0-99 claims its own shard
+    :param shard: index of the shard, starting at 0
+    :param num_shards: number of shards
+    :param environ: environment variables. Defaults to os.environ
+    :return: shard, num_shards
+    """
+    environ = os.environ if environ is None else environ
+    if shard is None:
+        if 'SLURM_ARRAY_TASK_ID' not in environ:
+            raise ValueError('No shard was given, and this is not a Slurm array task')
+        # Arrays such as --array=1-100 are counted from their first task
+        shard = int(environ['SLURM_ARRAY_TASK_ID']) - int(environ.get('SLURM_ARRAY_TASK_MIN', 0))
+    if num_shards is None:
+        if 'SLURM_ARRAY_TASK_COUNT' not in environ:
+            raise ValueError('No number of shards was given, and this is not a Slurm array task')
+        num_shards = int(environ['SLURM_ARRAY_TASK_COUNT'])
+    if not 0 <= shard < num_shards:
+        raise ValueError('Shard {} is outside of the {} shards'.format(shard, num_shards))
+    return shard, num_shards
+
+
+def shard_folder(output_dir, shard, num_shards):
+    return os.path.join(output_dir, SHARD_FOLDER.format(shard, num_shards))
+
+
+def find_num_shards(output_dir):
+    """
+    Find the number of shards from the names of the shard folders in the output directory
+    :param output_dir: directory shared by all the shards
+    :return: number of shards
+    """
+    counts = set(int(match.group(1)) for match in (re.match(r'shard_\d+_of_(\d+)$', name)
+                                                   for name in os.listdir(output_dir)) if match)
+    if len(counts) != 1:
+        raise ValueError('Could not determine the number of shards in {} - set it explicitly'.format(output_dir))
+    return counts.pop()
+
+
+def extract_shard(manifest_file, shard, num_shards, output_dir, refseq_database, num_threads=12, genus_method='mash',
+                  tool_threads=None, cache_dir=None, batch_size=None, report_format='csv', tool_runner=None,
+                  orf_method='prodigal'):
+    """
+    Extract the features of the samples in one shard of a manifest, and write them to the folder of the shard in the
+    output directory. A ValueError is raised for any sample whose size or contents no longer match the manifest
+    :param manifest_file: path of the manifest
+    :param shard: index of the shard, starting at 0
+    :param num_shards: number of shards
+    :param output_dir: directory shared by all the shards
+    :param refseq_database: Path to reduced refseq database sketch
+    :param num_threads: Total number of CPUs to use
+    :param genus_method: 'mash' to screen samples with the mash executable, 'batch' to compare batches of samples to the
+    sketch with a single mash dist each, or 'minhash' to screen them in-process
+    :param tool_threads: Number of threads to give each external tool
+    :param cache_dir: optional directory in which to cache the rows of samples between runs
+    :param batch_size: optional number of rows to write to the report at a time
+    :param report_format: 'csv', 'columns' (columnar feature store), or 'both'
+    :param tool_runner: optional tools.ToolRunner with the time limit and retries of mash and prodigal. If the tools of
+    any sample still fail, the report of the other samples is written, but the shard is not recorded as complete, so
+    that it is extracted again rather than merged
+    :param orf_method: 'prodigal' to predict ORFs with the prodigal executable, or 'orfscan' to find them in-process
+    :return: path of the folder of the shard
+    """
+    manifest = read_manifest(manifest_file)
+    samples = assign_shards(manifest['samples'], num_shards)[shard]
+    file_dict = dict()
+    for sample in samples:
+        fasta = os.path.join(manifest['sequencepath'], sample['file'])
+        if os.path.getsize(fasta) != sample['size']:
+            raise ValueError('{} has changed since the manifest was written'.format(fasta))
+        file_dict[sample['name']] = fasta
+    folder = shard_folder(output_dir, shard, num_shards)
+    os.makedirs(folder, exist_ok=True)
+    # Remove the record of any earlier attempt, so that the shard is only complete once its report has been replaced
+    record_file = os.path.join(folder, SHARD_RECORD)
+    if os.path.isfile(record_file):
+        os.remove(record_file)
+    print('Extracting features from {} samples in shard {} of {}'.format(len(file_dict), shard, num_shards))
+    failures = dict()
+    digests = dict()
+    rows = extract_features.extract_samples(file_dict,
+                                            refseq_database=refseq_database,
+                                            num_threads=num_threads,
+                                            genus_method=genus_method,
+                                            tool_threads=tool_threads,
+                                            feature_cache=extract_features.open_feature_cache(cache_dir,
+                                                                                              refseq_database,
+                                                                                              genus_method,
+                                                                                              orf_method=orf_method),
+                                            tool_runner=tool_runner,
+                                            failures=failures,
+                                            orf_method=orf_method,
+                                            digests=digests)
+    extract_features.write_report(checked_rows(rows, digests, samples, manifest['sequencepath']), folder,
+                                  batch_size=batch_size, report_format=report_format)
+    if failures:
+        raise RuntimeError('Features could not be extracted from {} samples in shard {}: {}'.format(
+            len(failures), shard, ', '.join(sorted(failures))))
+    write_json({'manifest_digest': cache.file_digest(manifest_file),
+                'shard': shard,
+                'num_shards': num_shards,
+                'samples': [sample['name'] for sample in samples]}, record_file)
+    return folder
+
+
+def checked_rows(rows, digests, samples, sequencepath):
+    """
+    Check the contents of each extracted sample against the digest in the manifest. The digest calculated as the sample
+    was extracted is used, so the files are not read again
+    :param rows: generator of strain name, dictionary of report column: value, as returned by
+    extract_features.extract_samples
+    :param digests: dictionary of strain name: digest of the FASTA contents, filled in by extract_samples
+    :param samples: list of dictionaries of sample name, file, size, and digest from the manifest
+    :param sequencepath: path of folder containing FASTA genomes
+    :return: generator of dictionaries of report column: value
+    """
+    samples = {sample['name']: sample for sample in samples}
+    for name, row in rows:
+        if digests[name] != samples[name]['digest']:
+            raise ValueError('{} has changed since the manifest was written'.format(
+                os.path.join(sequencepath, samples[name]['file'])))
+        yield row
+
+
+def merge_shards(manifest_file, output_dir, num_shards=None, report_dir=None, report_format='csv'):
+    """
+    Combine the reports of every shard into a single report, sorted by strain name. Every shard must be complete and
+    extracted from the same manifest, and every sample in the manifest must be reported exactly once
+    :param manifest_file: path of the manifest
+    :param output_dir: directory shared by all the shards
+    :param num_shards: number of shards. Found from the shard folders if not provided
+    :param report_dir: folder to write the combined report to. Defaults to the sequence path of the manifest
+    :param report_format: 'csv', 'columns' (columnar feature store), or 'both'
+    :return: list of dictionaries of report column: value, sorted by strain name
+    """
+    manifest = read_manifest(manifest_file)
+    manifest_digest = cache.file_digest(manifest_file)
+    if num_shards is None:
+        num_shards = find_num_shards(output_dir)
+    rows = dict()
+    duplicates = set()
+    problems = list()
+    for shard in range(num_shards):
+        folder = shard_folder(output_dir, shard, num_shards)
+        try:
+            with open(os.path.join(folder, SHARD_RECORD)) as record_json:
+                record = json.load(record_json)
+        except (IOError, OSError, ValueError):
+            problems.append('shard {} is incomplete'.format(shard))
+            continue
+        if record['manifest_digest'] != manifest_digest:
+            problems.append('shard {} was extracted from a different manifest'.format(shard))
+            continue
+        shard_rows = extract_features.read_report(folder)
+        if sorted(shard_rows) != sorted(record['samples']):
+            problems.append('the report of shard {} does not match its samples'.format(shard))
+        for name, row in shard_rows.items():
+            if name in rows:
+                duplicates.add(name)
+            rows[name] = row
+    expected = set(sample['name'] for sample in manifest['samples'])
+    missing = expected.difference(rows)
+    unexpected = set(rows).difference(expected)
+    for names, description in ((duplicates, 'reported by more than one shard'), (missing, 'missing'),
+                               (unexpected, 'not in the manifest')):
+        if names:
+            problems.append('{} samples are {}: {}'.format(len(names), description, ', '.join(sorted(names)[:10])))
+    if problems:
+        raise ValueError('Could not merge the shards: {}'.format('; '.join(problems)))
+    merged = [rows[name] for name in sorted(rows)]
+    extract_features.write_report(merged, report_dir or manifest['sequencepath'], report_format=report_format)
+    return merged
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract features from a large folder of samples with many '
+                                                 'independent workers, such as the tasks of a Slurm array job on a '
+                                                 'shared filesystem. Write a manifest of the folder, extract each '
+                                                 'shard of it, and merge the shard reports.')
+    subparsers = parser.add_subparsers(dest='command')
+    manifest_parser = subparsers.add_parser('manifest',
+                                            help='Write a manifest of the samples in a folder.')
+    manifest_parser.add_argument('-s', '--sequencepath',
+                                 required=True,
+                                 help='Path of folder containing multi-FASTA files.')
+    manifest_parser.add_argument('-m', '--manifest',
+                                 required=True,
+                                 help='Path of the manifest to write.')
+    manifest_parser.add_argument('-t', '--threads',
+                                 type=int,
+                                 default=None,
+                                 help='Number of files to read at once. Defaults to the number of CPUs available.')
+    extract_parser = subparsers.add_parser('extract',
+                                           help='Extract the features of one shard of a manifest.')
+    merge_parser = subparsers.add_parser('merge',
+                                         help='Combine the reports of every shard into extracted_features.csv.')
+    for subparser in (extract_parser, merge_parser):
+        subparser.add_argument('-m', '--manifest',
+                               required=True,
+                               help='Path of the manifest.')
+        subparser.add_argument('-o', '--output_dir',
+                               required=True,
+                               help='Directory shared by all the shards.')
+        subparser.add_argument('-N', '--num_shards',
+                               type=int,
+                               default=None,
+                               help='Number of shards. Defaults to the number of tasks in the Slurm array when '
+                                    'extracting, and to the number of shards in the output directory when merging.')
+        subparser.add_argument('-f', '--report_format',
+                               choices=['csv', 'columns', 'both'],
+                               default='csv',
+                               help='Format of the reports. Default is csv.')
+    extract_parser.add_argument('-k', '--shard',
+                                type=int,
+                                default=None,
+                                help='Index of the shard to extract, starting at 0. Defaults to the Slurm array task.')
+    extract_parser.add_argument('-d', '--refseq_database',
+                                required=True,
+                                help='Path to reduced mash sketch of RefSeq.')
+    extract_parser.add_argument('-g', '--genus_method',
+                                choices=['mash', 'batch', 'minhash'],
+                                default='mash',
+                                help='Determine genera with the mash executable (default), with a single mash dist '
+                                     'for each batch of samples (batch), or in-process with minhash.')
+    extract_parser.add_argument('--orf_method',
+                                choices=['prodigal', 'orfscan'],
+                                default='prodigal',
+                                help='Predict ORFs with the prodigal executable (default), or in-process with a '
+                                     'fast, approximate scan.')
+    extract_parser.add_argument('-t', '--threads',
+                                type=int,
+                                default=None,
+                                help='Total number of CPUs to use. Defaults to the number of CPUs available.')
+    extract_parser.add_argument('--tool_threads',
+                                type=int,
+                                default=None,
+                                help='Number of threads to give each external tool.')
+    extract_parser.add_argument('-c', '--cache_dir',
+                                default=None,
+                                help='Directory of a persistent cache of extracted features.')
+    extract_parser.add_argument('-b', '--batch_size',
+                                type=int,
+                                default=None,
+                                help='Write the report this many samples at a time.')
+    extract_parser.add_argument('--tool_timeout',
+                                type=float,
+                                default=None,
+                                help='Kill mash or prodigal if a single run on a sample takes longer than this many '
+                                     'seconds.')
+    extract_parser.add_argument('--tool_retries',
+                                type=int,
+                                default=tools.DEFAULT_RETRIES,
+                                help='Number of times to run mash or prodigal again if it fails. If any sample still '
+                                     'fails, the shard is not recorded as complete. Default is {}.'
+                                     .format(tools.DEFAULT_RETRIES))
+    merge_parser.add_argument('-r', '--report_dir',
+                              default=None,
+                              help='Folder to write the combined report to. Defaults to the folder of the samples.')
+    args = parser.parse_args()
+    if args.command == 'manifest':
+        write_json(build_manifest(args.sequencepath, num_threads=args.threads), args.manifest)
+    elif args.command == 'extract':
+        task_shard, task_num_shards = array_task(args.shard, args.num_shards)
+        extract_shard(args.manifest, task_shard, task_num_shards, args.output_dir,
+                      refseq_database=args.refseq_database,
+                      num_threads=args.threads or resources.available_cpus(),
+                      genus_method=args.genus_method,
+                      orf_method=args.orf_method,
+                      tool_threads=args.tool_threads,
+                      cache_dir=args.cache_dir,
+                      batch_size=args.batch_size,
+                      report_format=args.report_format,
+                      tool_runner=tools.ToolRunner(timeout=args.tool_timeout, retries=args.tool_retries))
+    elif args.command == 'merge':
+        merge_shards(args.manifest, args.output_dir, num_shards=args.num_shards, report_dir=args.report_dir,
+                     report_format=args.report_format)
+    else:
+        parser.print_help()
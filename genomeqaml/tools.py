@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+from genomeqaml import instrument
+import subprocess
+import threading
+import tempfile
+import time
+import os
+__author__ = 'adamkoziol', 'andrewlow'
+
+# Default number of times a failed tool is run again, and the delay before the first retry, which doubles with each
+# further retry
+DEFAULT_RETRIES = 1
+DEFAULT_BACKOFF = 1.0
+# Number of bytes at the end of the stderr of a failed tool that are kept to report the failure with
+STDERR_TAIL = 2000
+
+
+class ToolError(RuntimeError):
+    """
+    An external tool could not be started, exited with an error, timed out, or produced output that could not be parsed
+    """
+
+    def __init__(self, command, reason, returncode=None, stderr='', retry=True):
+        """
+        :param command: list of the arguments of the tool
+        :param reason: description of the failure
+        :param returncode: exit status of the tool, if it exited
+        :param stderr: the end of the stderr of the tool
+        :param retry: boolean of whether running the tool again may succeed e.g. False if it is not installed
+        """
+        self.command = command
+        self.reason = reason
+        self.returncode = returncode
+        self.stderr = stderr
+        self.retry = retry
+        message = '{} {}'.format(' '.join(command[:2]), reason)
+        if stderr.strip():
+            message += ': {}'.format(stderr.strip().splitlines()[-1])
+        super(ToolError, self).__init__(message)
+
+
+class ToolRunner(object):
+    """
+    Run the external tools of the feature extraction (mash, prodigal), so that a tool that hangs is killed after a time
+    limit, a tool that fails is run again after a delay, and a tool that keeps failing raises a ToolError with its exit
+    status and the end of its stderr, rather than leaving a sample with missing or partial output. The runner holds no
+    processes, and is shared by all the workers of a run
+    """
+
+    def __init__(self, timeout=None, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
+        """
+        :param timeout: seconds that a single run of a tool may take before it is killed. No limit if None
+        :param retries: number of times a failed tool is run again
+        :param backoff: seconds to wait before the first retry. The wait doubles with each further retry
+        """
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+    def call(self, function, *args):
+        """
+        Call a function that runs tools, and call it again if it raises a ToolError that may succeed on another try
+        :param function: function to call
+        :param args: arguments of the function
+        :return: the return value of the function
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                return function(*args)
+            except ToolError as error:
+                if not error.retry or attempt == self.retries:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def run(self, command, parse):
+        """
+        Run a tool, and parse its output as it is produced
+        :param command: list of the arguments of the tool
+        :param parse: function of an iterable of the lines of the stdout of the tool, that returns the result
+        :return: the return value of parse
+        """
+        return self.call(self.run_once, command, parse)
+
+    def run_once(self, command, parse):
+        """
+        Run a tool once, without retrying
+        :param command: list of the arguments of the tool
+        :param parse: function of an iterable of the lines of the stdout of the tool, that returns the result
+        :return: the return value of parse
+        """
+        # stderr goes to a file, so the tool cannot block on a full pipe that nothing reads
+        with tempfile.TemporaryFile() as stderr:
+            try:
+                process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr, universal_newlines=True)
+            except OSError as error:
+                raise ToolError(command, 'could not be started ({})'.format(error.strerror), retry=False)
+            with self.watchdog([process]) as timer:
+                try:
+                    with process.stdout:
+                        result = parse(process.stdout)
+                except Exception as error:
+                    process.kill()
+                    instrument.wait_child(process)
+                    if timer.expired:
+                        raise ToolError(command, 'timed out after {} s'.format(self.timeout))
+                    raise ToolError(command, 'output could not be parsed ({})'.format(error),
+                                    returncode=process.returncode, stderr=read_tail(stderr))
+                returncode = instrument.wait_child(process)
+            if timer.expired:
+                raise ToolError(command, 'timed out after {} s'.format(self.timeout), stderr=read_tail(stderr))
+            if returncode:
+                raise ToolError(command, 'exited with status {}'.format(returncode), returncode=returncode,
+                                stderr=read_tail(stderr))
+        return result
+
+    def watchdog(self, processes):
+        """
+        :param processes: list of subprocess.Popen to kill once the time limit is reached
+        :return: Watchdog context manager. Its expired attribute records whether the processes were killed
+        """
+        return Watchdog(processes, self.timeout)
+
+
+class Watchdog(object):
+    """
+    Context manager that kills processes that are still running after a time limit, which closes their output so that
+    anything reading it finishes
+    """
+
+    def __init__(self, processes, timeout=None):
+        """
+        :param processes: list of subprocess.Popen
+        :param timeout: seconds before the processes are killed. Never killed if None
+        """
+        self.processes = processes
+        self.timeout = timeout
+        self.expired = False
+        self.timer = None
+
+    def __enter__(self):
+        if self.timeout is not None:
+            self.timer = threading.Timer(self.timeout, self.expire)
+            self.timer.daemon = True
+            self.timer.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.timer is not None:
+            self.timer.cancel()
+
+    def expire(self):
+        self.expired = True
+        for process in self.processes:
+            if process.poll() is None:
+                process.kill()
+
+
+def read_tail(handle, size=STDERR_TAIL):
+    """
+    :param handle: binary file that a tool wrote to
+    :param size: maximum number of bytes to read
+    :return: the last size bytes of the file, as text
+    """
+    handle.seek(0, os.SEEK_END)
+    handle.seek(max(0, handle.tell() - size))
+    return handle.read().decode('utf-8', 'replace')
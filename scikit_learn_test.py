@@ -1,17 +1,28 @@
 import os
+import json
+import math
+import time
 import click
 import pickle
+import hashlib
 import numpy as np
 import pandas as pd
-from genomeqaml import extract_features
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from genomeqaml import cache, classify, extract_features, forest, resources
 from sklearn.ensemble import ExtraTreesClassifier
-from sklearn.model_selection import cross_val_score, GridSearchCV
+from sklearn.model_selection import cross_val_score, ParameterGrid, ParameterSampler, StratifiedKFold, train_test_split
+
+# Hyperparameters searched by fit_model
+PARAM_DICT = {'n_estimators': [10, 20, 50, 100],
+              'max_depth': [5, 10, 20, 50, 100, 200],
+              'max_leaf_nodes': [10, 20, 40, 50, 100, 200],
+              'criterion': ['gini', 'entropy']}
 
 
 def combine_csv_files(pass_folder, fail_folder, ref_folder):
-    df_fail = pd.read_csv(os.path.join(fail_folder, 'extracted_features.csv'))
-    df_pass = pd.read_csv(os.path.join(pass_folder, 'extracted_features.csv'))
-    df_ref = pd.read_csv(os.path.join(ref_folder, 'extracted_features.csv'))
+    df_fail = classify.read_features(fail_folder)
+    df_pass = classify.read_features(pass_folder)
+    df_ref = classify.read_features(ref_folder)
     # Add a column of 0s to fail, 1s to pass.
     fail = [0] * len(df_fail)
     not_fail = [1] * len(df_pass)
@@ -24,48 +35,197 @@ def combine_csv_files(pass_folder, fail_folder, ref_folder):
     return result
 
 
-def fit_model(dataframe):
+def extract_training_data(labelled_folders, refseq_database, cache_dir=None, num_threads=None, reuse_reports=False,
+                          orf_method='prodigal'):
+    # Extract the features of every folder in a single pass, with one pool of workers shared by all the samples, and
+    # label the rows of each folder with its PassFail class. labelled_folders is a list of (folder, label) pairs, and
+    # each folder may only be given once, as its samples can only have one label. Folders labelled None (e.g. the test
+    # set) are extracted, but left out of the table. With reuse_reports, folders that already have a report are read
+    # from it instead. Reports do not record how their ORFs were found, so they are only reused for prodigal features.
+    # Returns the same table as combine_csv_files, and writes the same reports.
+    labelled_folders = list(labelled_folders)
+    seen = set()
+    for folder, _ in labelled_folders:
+        if os.path.realpath(folder) in seen:
+            raise ValueError('The folder {} is given more than once'.format(folder))
+        seen.add(os.path.realpath(folder))
+    reuse_reports = reuse_reports and orf_method == 'prodigal'
+    stale = [folder for folder, _ in labelled_folders
+             if not (reuse_reports and extract_features.report_exists(folder))]
+    folder_rows = dict()
+    if stale:
+        folder_rows = extract_features.extract_folders(stale,
+                                                       refseq_database=refseq_database,
+                                                       report=True,
+                                                       num_threads=num_threads or resources.available_cpus(),
+                                                       cache_dir=cache_dir,
+                                                       orf_method=orf_method)
+    frames = list()
+    for folder, label in labelled_folders:
+        if label is None:
+            continue
+        if folder in folder_rows:
+            frame = classify.features_frame(folder_rows[folder])
+        else:
+            frame = classify.read_features(folder)
+        frame['PassFail'] = [label] * len(frame)
+        frames.append(frame)
+    return pd.concat(frames)
+
+
+def fit_model(dataframe, search='grid', n_jobs=None, n_iter=20, search_cache=None, param_dict=None, cv=5,
+              factor=3):
     # Use pandas to get one-hot-encoding of categorical featues (Genus).
     dataframe = pd.get_dummies(dataframe, columns=['Genus'], dummy_na=True)
     features = list(dataframe.columns[1:len(dataframe.columns)])
     features.remove('PassFail')  # Make sure PassFail isn't a feature.
     X = dataframe[features]
     y = dataframe['PassFail']
+    n_jobs = n_jobs or resources.available_cpus()
+    param_dict = param_dict or PARAM_DICT
     # dt = RandomForestClassifier(n_estimators=100, max_depth=10, max_leaf_nodes=20)
-    param_dict = {'n_estimators': [10, 20, 50, 100],
-                  'max_depth': [5, 10, 20, 50, 100, 200],
-                  'max_leaf_nodes': [10, 20, 40, 50, 100, 200],
-                  'criterion': ['gini', 'entropy']}
-    dt = ExtraTreesClassifier()
-    grid_search = GridSearchCV(dt, param_dict)
-    grid_search.fit(X, y)
-    print(grid_search.best_params_)
-    dt = ExtraTreesClassifier(n_estimators=grid_search.best_params_['n_estimators'],
-                              max_depth=grid_search.best_params_['max_depth'],
-                              max_leaf_nodes=grid_search.best_params_['max_leaf_nodes'],
-                              criterion=grid_search.best_params_['criterion'])
-    scores = cross_val_score(dt, X, y, cv=10)
+    if search == 'random':
+        candidates = list(ParameterSampler(param_dict, n_iter=n_iter, random_state=0))
+    else:
+        candidates = list(ParameterGrid(param_dict))
+    search_state = SearchState(X, y, cv=cv, search_cache=search_cache)
+    if search == 'halving':
+        scores = halving_search(search_state, candidates, n_jobs=n_jobs, factor=factor)
+    else:
+        scores = search_state.evaluate(candidates, n_jobs=n_jobs)
+    print_search(scores)
+    best_params = max(scores, key=lambda score: score['score'])['params']
+    print(best_params)
+    dt = ExtraTreesClassifier(n_estimators=best_params['n_estimators'],
+                              max_depth=best_params['max_depth'],
+                              max_leaf_nodes=best_params['max_leaf_nodes'],
+                              criterion=best_params['criterion'])
+    scores = cross_val_score(dt, X, y, cv=10, n_jobs=n_jobs)
     print(np.mean(scores))
     dt = dt.fit(X, y)
     return dt
 
 
+class SearchState(object):
+    # Cross-validation folds of a training set, and the scores of the candidates evaluated on them. With a search
+    # cache, both are kept on disk, so that an interrupted or repeated search only evaluates new candidates.
+
+    def __init__(self, X, y, cv=5, search_cache=None):
+        self.X = X
+        self.y = y
+        self.scores = dict()
+        self.score_file = None
+        digest = hashlib.sha256(json.dumps(list(X.columns)).encode())
+        digest.update(pd.util.hash_pandas_object(pd.concat([X, y], axis=1), index=False).values.tobytes())
+        digest.update(str(cv).encode())
+        fold_file = None
+        if search_cache:
+            # Scores are only reused for exactly the same training data and number of folds
+            directory = os.path.join(search_cache, digest.hexdigest()[:16])
+            os.makedirs(directory, exist_ok=True)
+            fold_file = os.path.join(directory, 'folds.npz')
+            self.score_file = os.path.join(directory, 'scores.jsonl')
+        if fold_file and os.path.isfile(fold_file):
+            with np.load(fold_file) as folds:
+                self.folds = [(folds['train{}'.format(i)], folds['test{}'.format(i)]) for i in range(cv)]
+        else:
+            self.folds = list(StratifiedKFold(n_splits=cv, shuffle=True, random_state=0).split(X, y))
+            if fold_file:
+                arrays = dict()
+                for i, (train, test) in enumerate(self.folds):
+                    arrays['train{}'.format(i)] = train
+                    arrays['test{}'.format(i)] = test
+                np.savez(fold_file, **arrays)
+        if self.score_file and os.path.isfile(self.score_file):
+            with open(self.score_file) as scores:
+                for line in scores:
+                    try:
+                        result = json.loads(line)
+                    except ValueError:
+                        # The last line may be partial if the search was interrupted
+                        continue
+                    self.scores[self.key(result['params'], result['fold'], result['resource'])] = result
+
+    @staticmethod
+    def key(params, fold, resource):
+        return json.dumps(params, sort_keys=True), fold, resource
+
+    def subset(self, fold, resource):
+        # The indices of resource samples of the training set of a fold, with the same proportion of each class. The
+        # training data is ordered by class, so the first samples would all be of one class
+        train, _ = self.folds[fold]
+        if resource is None:
+            return train
+        try:
+            train, _ = train_test_split(train, train_size=resource, stratify=self.y.iloc[train], random_state=fold)
+        except ValueError:
+            # Too few samples of a class to split them in proportion
+            train = np.random.RandomState(fold).permutation(train)[:resource]
+        return np.sort(train)
+
+    def fit_fold(self, params, fold, resource):
+        # Fit a candidate on (resource samples of) the training set of a fold, and score it on the test set
+        _, test = self.folds[fold]
+        train = self.subset(fold, resource)
+        start = time.time()
+        model = ExtraTreesClassifier(**params).fit(self.X.iloc[train], self.y.iloc[train])
+        score = model.score(self.X.iloc[test], self.y.iloc[test])
+        return {'params': params, 'fold': fold, 'resource': resource, 'score': score, 'seconds': time.time() - start}
+
+    def evaluate(self, candidates, n_jobs=1, resource=None):
+        # Score each candidate on every fold, running the fits that have not been cached in parallel. Tree fitting
+        # releases the GIL, so threads keep every core busy. Returns a list of dictionaries of the params, mean
+        # score, and wall time of each candidate.
+        tasks = [(params, fold) for params in candidates for fold in range(len(self.folds))
+                 if self.key(params, fold, resource) not in self.scores]
+        if tasks:
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                futures = [executor.submit(self.fit_fold, params, fold, resource) for params, fold in tasks]
+                for future in as_completed(futures):
+                    result = future.result()
+                    self.scores[self.key(result['params'], result['fold'], result['resource'])] = result
+                    if self.score_file:
+                        with open(self.score_file, 'a') as scores:
+                            scores.write(json.dumps(result) + '\n')
+        summary = list()
+        for params in candidates:
+            results = [self.scores[self.key(params, fold, resource)] for fold in range(len(self.folds))]
+            summary.append({'params': params,
+                            'resource': resource,
+                            'score': float(np.mean([result['score'] for result in results])),
+                            'seconds': sum(result['seconds'] for result in results)})
+        return summary
+
+
+def halving_search(search_state, candidates, n_jobs=1, factor=3):
+    # Successive halving: every candidate is first scored on a small part of each training fold, and only the best
+    # 1/factor of the candidates are scored again with factor times as many samples, until the full folds are used
+    num_rounds = max(1, int(math.ceil(math.log(len(candidates), factor))))
+    num_train = min(len(train) for train, _ in search_state.folds)
+    scores = list()
+    for round_num in range(num_rounds):
+        resource = max(num_train // factor ** (num_rounds - round_num - 1), min(num_train, 20))
+        scores = search_state.evaluate(candidates, n_jobs=n_jobs, resource=resource if resource < num_train else None)
+        print('Round {}: {} candidates, {} training samples, {:.1f}s'
+              .format(round_num + 1, len(candidates), resource, sum(score['seconds'] for score in scores)))
+        keep = max(1, int(math.ceil(len(candidates) / factor)))
+        scores = sorted(scores, key=lambda score: score['score'], reverse=True)
+        candidates = [score['params'] for score in scores[:keep]]
+    return scores
+
+
+def print_search(scores, num_best=10):
+    # Print the best candidates, and the time spent fitting each of them
+    print('Searched {} candidates in {:.1f}s of fitting'.format(len(scores), sum(score['seconds'] for score in scores)))
+    for score in sorted(scores, key=lambda score: score['score'], reverse=True)[:num_best]:
+        print('{:.4f}\t{:.2f}s\t{}'.format(score['score'], score['seconds'], json.dumps(score['params'],
+                                                                                          sort_keys=True)))
+
+
 def predict_results(fasta_dir, tree, training_dataframe):
-    test_df = pd.read_csv(os.path.join(fasta_dir, 'extracted_features.csv'))
-    dataframe = pd.get_dummies(test_df, columns=['Genus'], dummy_na=True)
-    # Remove any genera from the test dataframe that weren't part of our training set.
-    training_dataframe = pd.get_dummies(training_dataframe, columns=['Genus'], dummy_na=True)
-    for column in dataframe:
-        if column not in training_dataframe:
-            dataframe.drop(column, axis=1, inplace=True)
-    # Add any genera that weren't in our test set but were in the training set.
-    for column in training_dataframe:
-        if 'Genus' in column and column not in dataframe:
-            not_present = [0] * len(dataframe)
-            dataframe[column] = not_present
-    # Then, add any features that were part of training data but not part of test data
-    features = list(dataframe.columns[1:len(dataframe.columns)])
-    x = dataframe[features]
+    test_df = classify.read_features(fasta_dir)
+    # Match the genera of the test set to those of the training set
+    x = classify.align_features(test_df, classify.build_schema(training_dataframe)['features'])
     result = tree.predict(x)
     # result = tree.predict_proba(x)
     for i in range(len(result)):
@@ -99,33 +259,55 @@ def predict_results(fasta_dir, tree, training_dataframe):
               type=click.Path(exists=True),
               required=True,
               help='Path to reduced refseq database sketch.')
-def cli(pass_folder, fail_folder, test_folder, refseq_database, ref_folder):
-    # Extract features for pass data, fail data, and reference data if it hasn't already been done.
-    if not os.path.isfile(os.path.join(fail_folder, 'extracted_features.csv')):
-        extract_features.main(sequencepath=fail_folder,
-                              refseq_database=refseq_database,
-                              report=True)
-    if not os.path.isfile(os.path.join(pass_folder, 'extracted_features.csv')):
-        extract_features.main(sequencepath=pass_folder,
-                              refseq_database=refseq_database,
-                              report=True)
-    if not os.path.isfile(os.path.join(ref_folder, 'extracted_features.csv')):
-        extract_features.main(sequencepath=ref_folder,
-                              refseq_database=refseq_database,
-                              report=True)
-
-    # Combine the dataframes for training data so that we can fit our decision tree.
-    df = combine_csv_files(fail_folder=fail_folder, pass_folder=pass_folder, ref_folder=ref_folder)
-    dt = fit_model(df)
-
-    # Extract features for our test set if it hasn't already been done and attempt to predict results.
-    if not os.path.isfile(os.path.join(test_folder, 'extracted_features.csv')):
-        extract_features.main(sequencepath=test_folder,
-                              refseq_database=refseq_database,
-                              report=True)
+@click.option('-c', '--cache_dir',
+              type=click.Path(),
+              default=None,
+              help='Directory of a persistent cache of extracted features, shared with classify.py.')
+@click.option('-o', '--orf_method',
+              type=click.Choice(['prodigal', 'orfscan']),
+              default='prodigal',
+              help='Predict ORFs with the prodigal executable (default), or find them with the fast, approximate '
+                   'in-process scan. The model can only classify samples whose ORFs are found the same way.')
+@click.option('-s', '--search',
+              type=click.Choice(['grid', 'random', 'halving']),
+              default='grid',
+              help='Hyperparameter search: every combination (grid, the default), a random sample of --n_iter '
+                   'combinations (random), or successive halving, which discards poor combinations after fitting '
+                   'them on part of the training data (halving).')
+@click.option('-n', '--n_iter',
+              type=int,
+              default=20,
+              help='Number of combinations to try with a random search. Default is 20.')
+@click.option('-j', '--jobs',
+              type=int,
+              default=None,
+              help='Number of models to fit at once during the search. Defaults to the number of CPUs available.')
+@click.option('--search_cache',
+              type=click.Path(),
+              default=None,
+              help='Directory in which to keep the cross-validation folds and the score of every combination tried, '
+                   'so that an interrupted or repeated search resumes where it stopped.')
+def cli(pass_folder, fail_folder, test_folder, refseq_database, ref_folder, cache_dir, orf_method, search, n_iter,
+        jobs, search_cache):
+    # Extract features for fail, pass, reference, and test data if it hasn't already been done, and combine the
+    # training data so that we can fit our decision tree. The folders are extracted at once, so that their samples
+    # share one pool of workers. With a feature cache, the reports are always brought up to date, as only new samples
+    # are extracted.
+    labelled_folders = [(fail_folder, 0), (pass_folder, 1), (ref_folder, 2), (test_folder, None)]
+    df = extract_training_data(labelled_folders,
+                               refseq_database=refseq_database,
+                               cache_dir=cache_dir,
+                               reuse_reports=not cache_dir,
+                               orf_method=orf_method)
+    dt = fit_model(df, search=search, n_jobs=jobs, n_iter=n_iter, search_cache=search_cache)
+    # Attempt to predict the results of the test set.
     predict_results(test_folder, dt, df)  # TODO: Add check that FASTA folder actually has stuff in it.
     pickle.dump(dt, open('model.p', 'wb'))
     pickle.dump(df, open('dataframe.p', 'wb'))
+    # The schema is all that classification needs to know about the training data
+    classify.write_schema(classify.build_schema(df, model_file='model.p', orf_method=orf_method), 'schema.json')
+    # Classification does not need scikit-learn with the model exported to arrays
+    forest.export_forest(dt, 'model.npz', model_digest=cache.file_digest('model.p'))
 
 
 if __name__ == '__main__':
@@ -6,7 +6,8 @@ setup(
     version="0.0.14",
     packages=['genomeqaml'],
     # package_data={'genomeqaml': ['*.msh', '*.p']},
-    data_files=[('', ['genomeqaml/refseq.msh', 'genomeqaml/model.p', 'genomeqaml/dataframe.p'])],
+    data_files=[('', ['genomeqaml/refseq.msh', 'genomeqaml/model.p', 'genomeqaml/model.npz', 'genomeqaml/dataframe.p',
+                      'genomeqaml/schema.json'])],
     # include_package_data=True,
     license='MIT',
     scripts=['genomeqaml/classify.py'],
@@ -16,10 +17,13 @@ setup(
     url='https://github.com/OLC-LOC-Bioinformatics/GenomeQAML',
     install_requires=[
         'click',
-        'biopython',
+        'numpy',
         'scipy',
         'pandas',
         'sklearn',
         'genewrappers'
-    ]
+    ],
+    extras_require={
+        'zstd': ['zstandard']
+    }
 )
@@ -0,0 +1,44 @@
+# Tests for the synthetic genomes and stand-in tools of the GenomeQAML benchmarks
+import os
+from genomeqaml import extract_features
+from benchmarks import run_benchmarks, synthetic
+
+
+def test_generate_folder(tmpdir):
+    genomes = synthetic.generate_folder(str(tmpdir.join('a')), 5, genome_size=3000, num_contigs=4, gc=0.6)
+    # The first genomes of a larger collection are the same
+    larger = synthetic.generate_folder(str(tmpdir.join('b')), 8, genome_size=3000, num_contigs=4, gc=0.6)
+    for name, (fasta, contig_lengths, gc) in genomes.items():
+        with open(fasta) as first, open(larger[name][0]) as second:
+            assert first.read() == second.read()
+        scan = extract_features.fasta_map_scan(fasta)
+        assert sorted(scan.contig_lengths) == sorted(contig_lengths)
+        assert 2400 <= scan.total_length <= 3600
+        assert abs(scan.gc_count / scan.total_length - gc) < 0.05
+    # An existing folder is reused rather than generated again
+    modified = os.stat(genomes['synthetic_00000'][0]).st_mtime_ns
+    assert synthetic.generate_folder(str(tmpdir.join('a')), 5, genome_size=3000, num_contigs=4, gc=0.6) == genomes
+    assert os.stat(genomes['synthetic_00000'][0]).st_mtime_ns == modified
+
+
+def test_stub_tools(tmpdir):
+    folder = str(tmpdir.join('genomes'))
+    synthetic.generate_folder(folder, 3)
+    with run_benchmarks.stub_tools():
+        rows = extract_features.main(folder, report=False, refseq_database=str(tmpdir.join('refseq.msh')),
+                                     num_threads=2)
+    corpus = run_benchmarks.Corpus(folder, synthetic.generate_folder(folder, 3))
+    expected = extract_features.rows_to_dicts(corpus.rows())
+    # The ORFs called by the stand-in prodigal match those of the corpus. The GC% of the corpus is the GC fraction the
+    # genomes were generated with, rather than that of their random sequence
+    assert rows[1:] == expected[1:]
+    assert all(abs(rows[0][name] - gc) < 2 for name, gc in expected[0].items())
+
+
+def test_compare():
+    baseline = [{'stage': 'nx_lx', 'genomes': 10, 'best': 1.0}, {'stage': 'reporter', 'genomes': 10, 'best': 1.0}]
+    results = [{'stage': 'nx_lx', 'genomes': 10, 'best': 1.1}, {'stage': 'reporter', 'genomes': 10, 'best': 1.5},
+               {'stage': 'reporter', 'genomes': 100, 'best': 9.0}]
+    lines, regressions = run_benchmarks.compare(results, baseline, tolerance=0.25)
+    assert regressions == [('reporter', 10)]
+    assert len(lines) == 3
@@ -0,0 +1,47 @@
+# Tests for the feature cache of OLC Quality Assessment Tool
+from genomeqaml import cache, extract_features
+
+CONTEXT = {'feature_version': cache.FEATURE_VERSION, 'refseq_sketch': 'abc', 'prodigal': 'V2.6.3'}
+
+
+def sample_row(file_name='normal'):
+    return extract_features.feature_row(file_name, [40, 15, 8], 49.21, (5, 0, 1, 2, 2), 'Escherichia')
+
+
+def test_cache_round_trip(tmpdir):
+    feature_cache = cache.FeatureCache(str(tmpdir), CONTEXT)
+    feature_cache.put('digest', sample_row())
+    # Rows are keyed on content, so the same genome can be reported under a different name
+    assert feature_cache.get('digest', 'renamed') == sample_row('renamed')
+
+
+def test_cache_context_change(tmpdir):
+    cache.FeatureCache(str(tmpdir), CONTEXT).put('digest', sample_row())
+    updated = cache.FeatureCache(str(tmpdir), dict(CONTEXT, prodigal='V2.6.4'))
+    assert updated.get('digest', 'normal') is None
+    assert updated.prune() == 1
+
+
+def test_cache_eviction(tmpdir):
+    feature_cache = cache.FeatureCache(str(tmpdir), CONTEXT, max_size=2000)
+    for i in range(20):
+        feature_cache.put(str(i), sample_row())
+    assert feature_cache.size <= 2000
+    assert feature_cache.get('19', 'normal') is not None
+
+
+def test_file_digest():
+    assert cache.file_digest('tests/test_fastas/normal.fasta', chunk_size=7) == \
+        cache.file_digest('tests/test_fastas/normal.fasta')
+
+
+def test_extract_samples_from_cache(tmpdir):
+    feature_cache = cache.FeatureCache(str(tmpdir), CONTEXT)
+    file_dict = extract_features.filer(extract_features.find_files('tests/test_fastas'))
+    for file_name, fasta in file_dict.items():
+        feature_cache.put(cache.file_digest(fasta), sample_row())
+    # Every sample is cached, so neither mash nor prodigal are needed
+    rows = dict(extract_features.extract_samples(file_dict, refseq_database='refseq.msh', num_threads=2,
+                                                 feature_cache=feature_cache))
+    assert sorted(rows) == sorted(file_dict)
+    assert rows['one_contig'] == sample_row('one_contig')
@@ -0,0 +1,205 @@
+# Tests for the classification helpers and server of OLC Quality Assessment Tool
+import os
+import sys
+import json
+import shutil
+import threading
+import subprocess
+import pytest
+from urllib import error as urllib_error
+import pandas as pd
+from genomeqaml import classify, extract_features, server, tools
+from benchmarks import run_benchmarks, synthetic
+
+ensemble = pytest.importorskip('sklearn.ensemble')
+
+# Wraps the stand-in prodigal to fail on the sample named broken
+FAILING_PRODIGAL = """#!{python}
+import os
+import sys
+if 'broken' in os.path.basename(sys.argv[sys.argv.index('-i') + 1]):
+    sys.exit('Error: bad sequence')
+os.execv({prodigal!r}, sys.argv)
+"""
+
+
+def make_rows():
+    rows = list()
+    for i, genus in enumerate(['Listeria', 'Escherichia', 'NA', 'Salmonella'] * 5):
+        contigs = [1000 * (i + 1), 500 * (i % 3 + 1), 100]
+        rows.append(extract_features.feature_row('sample{:02d}'.format(i), contigs, 40.0 + i, (i, i % 2, 0, 1, i),
+                                                 genus))
+    return rows
+
+
+def train(tmpdir):
+    rows = make_rows()
+    extract_features.write_report(rows, str(tmpdir))
+    df = pd.read_csv(str(tmpdir.join('extracted_features.csv')))
+    training_df = df.assign(PassFail=[i % 3 for i in range(len(df))])
+    dataframe = pd.get_dummies(training_df, columns=['Genus'], dummy_na=True)
+    features = classify.build_schema(training_df)['features']
+    model = ensemble.ExtraTreesClassifier(n_estimators=10, random_state=0).fit(dataframe[features],
+                                                                               dataframe['PassFail'])
+    return model, features, rows, df
+
+
+def test_rows_match_report(tmpdir):
+    model, features, rows, df = train(tmpdir)
+    from_report = classify.classify_features(model, df, features)
+    assert classify.classify_features(model, classify.features_frame(rows), features) == from_report
+    assert from_report[0][1] in ('Fail', 'Pass', 'Reference')
+    assert classify.report_line(('a', 'Pass', 1.0, 98.5, 0.5)) == 'a,Pass,1.00,98.50,0.50\n'
+
+
+def test_columns_match_dataframe(tmpdir):
+    model, features, rows, df = train(tmpdir)
+    rows[1]['Genus'] = 'Bacillus'
+    extract_features.write_report(rows, str(tmpdir), report_format='both')
+    expected = classify.classify_features(model, classify.features_frame(rows), features)
+    columns = classify.read_feature_columns(str(tmpdir))
+    assert classify.feature_matrix(columns, features).tolist() == \
+        classify.align_features(classify.features_frame(rows), features).astype(float).values.tolist()
+    assert classify.classify_columns(model, columns, features) == expected
+    # Without the columnar store, the CSV report is read
+    extract_features.write_report(rows, str(tmpdir))
+    assert classify.classify_columns(model, classify.read_feature_columns(str(tmpdir)), features) == expected
+
+
+def test_server_options():
+    # A retrained model is served with its own feature schema, as with classify.py
+    usage = subprocess.check_output([sys.executable, '-m', 'genomeqaml.server', '--help'], universal_newlines=True)
+    assert '--model_file' in usage and '--schema_file' in usage
+
+
+def test_bundled_model_orfscan(tmpdir):
+    # The bundled model was trained on prodigal ORFs, so neither entry point uses it with orfscan
+    for command in (['genomeqaml.classify', '-t', 'tests/test_fastas', '-r', str(tmpdir.join('report.csv'))],
+                    ['genomeqaml.server', '-p', '0']):
+        process = subprocess.run([sys.executable, '-m'] + command + ['-o', 'orfscan'], stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE, universal_newlines=True, timeout=60)
+        assert process.returncode == 2
+        assert 'trained on ORFs found with prodigal' in process.stderr
+    assert not tmpdir.join('report.csv').check()
+
+
+def test_light_imports():
+    # Classifying a folder that has a feature report, or printing the help, does not need these to be loaded
+    modules = subprocess.check_output([sys.executable, '-c', 'import sys; from genomeqaml import classify, '
+                                       'extract_features; print(" ".join(sys.modules))'], universal_newlines=True)
+    heavy_modules = ['numpy', 'pandas', 'sklearn', 'click', 'genewrappers']
+    if sys.version_info >= (3, 7):
+        # Before Python 3.7, concurrent.futures loads multiprocessing itself
+        heavy_modules.append('multiprocessing')
+    for heavy in heavy_modules:
+        assert heavy not in modules.split()
+
+
+def test_extract_cli(capsys):
+    # The command line of extract_features is public, and only loads click when it is run
+    with pytest.raises(SystemExit) as exit_status:
+        extract_features.cli(['--help'])
+    assert exit_status.value.code == 0
+    assert '--sequencepath' in capsys.readouterr().out
+
+
+def test_genera_in_training_order(tmpdir):
+    model, features, rows, _ = train(tmpdir)
+    rows[1]['Genus'] = 'Bacillus'
+    x = classify.align_features(classify.features_frame(rows[1:2]), features)
+    assert list(x.columns) == features
+    assert x.filter(like='Genus').sum(axis=1).tolist() == [0]
+
+
+def test_schema_round_trip(tmpdir):
+    model_file = tmpdir.join('model.p')
+    model_file.write('model')
+    training_df = pd.DataFrame({'SampleName': ['a', 'b'], 'TotalLength': [1, 2], 'Genus': ['Listeria', None],
+                                'PassFail': [0, 1]})
+    schema = classify.build_schema(training_df, model_file=str(model_file))
+    assert schema['features'] == ['TotalLength', 'Genus_Listeria', 'Genus_nan']
+    assert schema['genera'] == ['Listeria']
+    classify.write_schema(schema, str(tmpdir.join('schema.json')))
+    assert classify.load_schema(str(tmpdir.join('schema.json'))) == schema
+    classify.check_schema(schema, str(model_file))
+    # The model was trained on prodigal ORFs, so it does not classify scanned ORFs
+    with pytest.raises(ValueError):
+        classify.check_schema(schema, str(model_file), orf_method='orfscan')
+    classify.check_schema(dict(schema, orf_method='orfscan'), str(model_file), orf_method='orfscan')
+    model_file.write('retrained')
+    with pytest.raises(ValueError):
+        classify.check_schema(schema, str(model_file))
+
+
+def test_bundled_schema():
+    schema = classify.load_schema(classify.data_file('schema.json'))
+    assert schema['features'] == classify.load_schema('missing.json', classify.data_file('dataframe.p'))['features']
+
+
+def test_missing_features():
+    with pytest.raises(ValueError):
+        classify.features_frame([{'SampleName': 'a'}])
+
+
+def test_server(tmpdir):
+    model, features, rows, df = train(tmpdir)
+    expected = [dict(zip(classify.REPORT_COLUMNS, result))
+                for result in classify.classify_features(model, df, features)]
+    service = server.ClassificationService(model, features, refseq_database=None)
+    httpd = server.make_server(service, port=0)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}'.format(httpd.server_address[1])
+    try:
+        results = [None] * len(rows)
+
+        def request(i):
+            results[i] = server.request_classification(url, rows=[rows[i]])[0]
+        threads = [threading.Thread(target=request, args=(i,)) for i in range(len(rows))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == expected
+        with pytest.raises(Exception):
+            server.request_classification(url, rows=[{'SampleName': 'a'}])
+        # Samples are named after their files, so files with the same name are rejected rather than overwritten
+        for folder in ('first', 'second'):
+            os.mkdir(str(tmpdir.join(folder)))
+            shutil.copy('tests/test_fastas/normal.fasta', str(tmpdir.join(folder)))
+        with pytest.raises(urllib_error.HTTPError) as error:
+            server.request_classification(url, fasta=[str(tmpdir.join(folder, 'normal.fasta'))
+                                                      for folder in ('first', 'second')])
+        assert error.value.code == 400 and 'normal' in json.loads(error.value.read().decode())['error']
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        service.close()
+
+
+def test_server_failures(tmpdir, monkeypatch):
+    model, features, _, _ = train(tmpdir)
+    genomes = synthetic.generate_folder(str(tmpdir.join('genomes')), 2, genome_size=25000)
+    good = genomes['synthetic_00000'][0]
+    broken = str(tmpdir.join('genomes', 'broken.fasta'))
+    os.rename(genomes['synthetic_00001'][0], broken)
+    bin_dir = tmpdir.mkdir('bin')
+    bin_dir.join('prodigal').write(FAILING_PRODIGAL.format(python=sys.executable, prodigal=os.path.join(
+        run_benchmarks.STUB_DIR, 'prodigal')))
+    bin_dir.join('prodigal').chmod(0o755)
+    service = server.ClassificationService(model, features, refseq_database=str(tmpdir.join('refseq.msh')),
+                                           num_threads=2, tool_runner=tools.ToolRunner(retries=0))
+    httpd = server.make_server(service, port=0)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}'.format(httpd.server_address[1])
+    try:
+        with run_benchmarks.stub_tools():
+            monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ['PATH'])
+            failures = dict()
+            results = server.request_classification(url, fasta=[good, broken], failures=failures)
+        # The sample whose tool failed is named in the response, and the other sample is still classified
+        assert [result['Sample'] for result in results] == ['synthetic_00000']
+        assert list(failures) == ['broken'] and 'bad sequence' in failures['broken']
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        service.close()
@@ -0,0 +1,64 @@
+# Tests for the columnar feature store of OLC Quality Assessment Tool
+import os
+import numpy as np
+import pandas as pd
+from genomeqaml import classify, columnar, extract_features
+
+
+def make_rows(names):
+    return [extract_features.feature_row(name, [40, 15, 8], 49.21, (5, 0, 1, 2, 2), genus)
+            for name, genus in zip(names, ['Escherichia', 'NA', 'Listeria'] * len(names))]
+
+
+def test_row_groups(tmpdir):
+    store = columnar.ColumnStore.create(str(tmpdir.join('store')), [('name', columnar.STRING), ('count', '<i8'),
+                                                                   ('gc', '<f8')])
+    assert len(store) == 0
+    assert store.column('name') == list()
+    store.append([{'name': 'a', 'count': 1, 'gc': 0.5}, {'name': '', 'count': 2, 'gc': 0.25}])
+    store.append([{'name': 'Åland', 'count': 3, 'gc': 1.0}])
+    reopened = columnar.ColumnStore(str(tmpdir.join('store')))
+    assert reopened.schema['row_groups'] == [2, 1]
+    assert reopened.column('name') == ['a', '', 'Åland']
+    assert isinstance(reopened.column('count'), np.memmap)
+    assert reopened.column('count').tolist() == [1, 2, 3]
+    assert list(reopened.rows())[2] == {'name': 'Åland', 'count': 3, 'gc': 1.0}
+
+
+def test_interrupted_append(tmpdir):
+    store = columnar.ColumnStore.create(str(tmpdir.join('store')), [('name', columnar.STRING), ('count', '<i8')])
+    store.append([{'name': 'a', 'count': 1}])
+    # Simulate a row group that was written, but never recorded in the schema
+    with open(os.path.join(store.directory, 'column00.bin'), 'ab') as data:
+        data.write(b'partial')
+    with open(os.path.join(store.directory, 'column01.bin'), 'ab') as data:
+        data.write(b'\0' * 5)
+    store = columnar.ColumnStore(store.directory)
+    assert store.column('name') == ['a']
+    store.append([{'name': 'b', 'count': 2}])
+    assert store.column('name') == ['a', 'b']
+    assert store.column('count').tolist() == [1, 2]
+
+
+def test_feature_store_matches_csv(tmpdir):
+    rows = make_rows(['c', 'a', 'b'])
+    extract_features.write_report(rows, str(tmpdir), report_format='both')
+    from_csv = pd.read_csv(str(tmpdir.join(extract_features.REPORT_FILE)))
+    from_store = classify.read_features(str(tmpdir))
+    pd.testing.assert_frame_equal(from_store, from_csv)
+    assert extract_features.read_report(str(tmpdir)) == {row['SampleName']: row for row in rows}
+
+
+def test_stale_store_ignored(tmpdir):
+    extract_features.write_report(make_rows(['a', 'b']), str(tmpdir), batch_size=1, report_format='columns')
+    assert extract_features.report_exists(str(tmpdir))
+    assert not os.path.isfile(str(tmpdir.join(extract_features.REPORT_FILE)))
+    assert len(classify.read_features(str(tmpdir))) == 2
+    # A CSV report written afterwards is newer than the store, so the store is no longer used
+    extract_features.write_report(make_rows(['a']), str(tmpdir))
+    assert extract_features.open_store(str(tmpdir)) is None
+    assert len(classify.read_features(str(tmpdir))) == 1
+    # Rewriting the store replaces it
+    extract_features.write_report(make_rows(['a', 'b', 'c']), str(tmpdir), report_format='columns')
+    assert len(extract_features.open_store(str(tmpdir))) == 3
+    assert sorted(os.listdir(str(tmpdir))) == sorted([extract_features.REPORT_FILE, extract_features.REPORT_STORE])
@@ -0,0 +1,136 @@
+# Tests for compressed FASTA input of OLC Quality Assessment Tool
+import os
+import sys
+import gzip
+import zlib
+import shutil
+import struct
+import subprocess
+import pytest
+from genomeqaml import compression, extract_features, minhash
+
+# Stand-ins for prodigal and mash, which read the sample from a file argument, or from stdin
+PRODIGAL = """#!{python}
+import sys
+sequence = open(sys.argv[sys.argv.index('-i') + 1]) if '-i' in sys.argv else sys.stdin
+for i, line in enumerate(line for line in sequence if line.startswith('>')):
+    print('>{{}}_1_{{}}_+'.format(i + 1, 400 * (i + 1)))
+"""
+MASH = """#!{python}
+import sys
+pool = None if '-' in sys.argv else sys.argv[3]
+if (open(pool) if pool else sys.stdin).read().strip():
+    print('0.99\\t900/1000\\t1\\t0\\t/refs/Shigella/sp/GCF.fna\\tdesc')
+"""
+
+
+def bgzip(data, block_size=1000):
+    # Write each block as a gzip member with a BC extra field, as bgzip does, followed by the empty EOF block
+    blocks = list()
+    for start in list(range(0, len(data), block_size)) + [len(data)]:
+        block = data[start:start + block_size]
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        deflated = compressor.compress(block) + compressor.flush()
+        header = b'\x1f\x8b\x08\x04' + b'\0' * 6 + struct.pack('<H', 6) + b'BC' + struct.pack('<HH', 2,
+                                                                                              len(deflated) + 25)
+        blocks.append(header + deflated + struct.pack('<II', zlib.crc32(block), len(block)))
+    return b''.join(blocks)
+
+
+def compressed_copies(tmpdir, fasta):
+    with open(fasta, 'rb') as handle:
+        data = handle.read()
+    name = os.path.basename(fasta)
+    copies = {'gzip': str(tmpdir.join(name + '.gz')), 'bgzf': str(tmpdir.join(name + '.bgz'))}
+    with open(copies['gzip'], 'wb') as handle:
+        handle.write(gzip.compress(data))
+    with open(copies['bgzf'], 'wb') as handle:
+        handle.write(bgzip(data))
+    return data, copies
+
+
+@pytest.fixture
+def tools(tmpdir, monkeypatch):
+    bin_dir = tmpdir.mkdir('bin')
+    for name, script in (('prodigal', PRODIGAL), ('mash', MASH)):
+        path = bin_dir.join(name)
+        path.write(script.format(python=sys.executable))
+        path.chmod(0o755)
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ['PATH'])
+
+
+def test_read_chunks(tmpdir):
+    data, copies = compressed_copies(tmpdir, 'tests/test_fastas/normal.fasta')
+    for method, path in copies.items():
+        assert compression.compression(path) == method
+        assert b''.join(compression.read_chunks(path, chunk_size=7)) == data
+        assert b''.join(compression.read_chunks(path, chunk_size=2000, threads=4)) == data
+    assert compression.compression('tests/test_fastas/normal.fasta') is None
+    # Corrupt blocks are detected
+    with open(copies['bgzf'], 'rb') as handle:
+        corrupt = bytearray(handle.read())
+    corrupt[-40] ^= 0xff
+    with open(copies['bgzf'], 'wb') as handle:
+        handle.write(bytes(corrupt))
+    with pytest.raises((ValueError, zlib.error)):
+        b''.join(compression.read_chunks(copies['bgzf']))
+
+
+@pytest.mark.skipif(compression.zstandard is None and shutil.which('zstd') is None, reason='zstd is not available')
+def test_read_zstd(tmpdir):
+    with open('tests/test_fastas/normal.fasta', 'rb') as handle:
+        data = handle.read()
+    compressed = str(tmpdir.join('normal.fasta.zst'))
+    if compression.zstandard is not None:
+        with open(compressed, 'wb') as handle:
+            handle.write(compression.zstandard.ZstdCompressor().compress(data))
+    else:
+        subprocess.check_call(['zstd', '-q', 'tests/test_fastas/normal.fasta', '-o', compressed])
+    assert compression.compression(compressed) == 'zstd'
+    assert b''.join(compression.read_chunks(compressed, chunk_size=10)) == data
+
+
+def test_scan_compressed(tmpdir):
+    for fasta in extract_features.find_files('tests/test_fastas'):
+        _, copies = compressed_copies(tmpdir, fasta)
+        for path in copies.values():
+            assert extract_features.fasta_scan(path) == extract_features.fasta_scan(fasta)
+            assert list(minhash.fasta_sequences(path)) == list(minhash.fasta_sequences(fasta))
+    assert extract_features.filer([str(tmpdir.join('normal.fasta.gz'))]) == {'normal': str(tmpdir.join(
+        'normal.fasta.gz'))}
+
+
+def test_stream_tools_in_turn(tmpdir, tools, monkeypatch):
+    _, copies = compressed_copies(tmpdir, 'tests/test_fastas/normal.fasta')
+    orf_dist = extract_features.sample_orfs('tests/test_fastas/normal.fasta')
+    processes = list()
+    running = list()
+    popen = subprocess.Popen
+
+    def start(command, **kwargs):
+        # Count the tools of the sample that are still running as each one starts
+        running.append(sum(process.poll() is None for process in processes))
+        processes.append(popen(command, **kwargs))
+        return processes[-1]
+    monkeypatch.setattr(subprocess, 'Popen', start)
+    _, genus, orfs = extract_features.stream_sample(copies['gzip'], refseq_database='refseq.msh')
+    assert (genus, orfs) == ('Escherichia', orf_dist)
+    assert running == [0, 0]
+
+
+def test_extract_compressed(tmpdir, tools):
+    plain_folder = str(tmpdir.join('plain'))
+    shutil.copytree('tests/test_fastas', plain_folder)
+    compressed_folder = tmpdir.mkdir('compressed')
+    for fasta in extract_features.find_files(plain_folder):
+        compressed_copies(compressed_folder, fasta)
+        os.remove(str(compressed_folder.join(os.path.basename(fasta) + '.bgz')))
+    stats, genus, orfs = extract_features.stream_sample(str(compressed_folder.join('normal.fasta.gz')),
+                                                        refseq_database='refseq.msh')
+    assert stats == extract_features.sample_stats(os.path.join(plain_folder, 'normal.fasta'))
+    assert genus == 'Escherichia'
+    assert orfs == extract_features.sample_orfs(os.path.join(plain_folder, 'normal.fasta'))
+    plain = extract_features.main(plain_folder, report=False, refseq_database='refseq.msh', num_threads=4)
+    compressed = extract_features.main(str(compressed_folder), report=False, refseq_database='refseq.msh',
+                                       num_threads=4)
+    assert compressed == plain
@@ -0,0 +1,69 @@
+# Tests for the results database of OLC Quality Assessment Tool
+import shutil
+from genomeqaml import cache, database, extract_features
+
+
+def make_rows(names, genus='Listeria'):
+    return [extract_features.feature_row(name, [40, 15, 8], 49.21, (5, 0, 1, 2, 2), genus) for name in names]
+
+
+def test_features_replaced(tmpdir):
+    with database.ResultsDatabase(str(tmpdir.join('results.db'))) as results:
+        results.add_features(make_rows(['a', 'b']), digests={'a': 'digest_a', 'b': 'digest_b'},
+                             created='2024-05-01 00:00:00')
+        # The same sample and contents replace the earlier row, while new contents are recorded alongside it
+        results.add_features(make_rows(['a'], genus='NA'), digests={'a': 'digest_a'}, created='2024-05-02 00:00:00')
+        results.add_features(make_rows(['a']), digests={'a': 'digest_c'}, created='2024-05-03 00:00:00')
+        rows = results.features(sample='a')
+        assert [(row['digest'], row['genus']) for row in rows] == [('digest_a', 'NA'), ('digest_c', 'Listeria')]
+        assert rows[0]['GC%'] == 49.21
+        assert rows[0]['TotalLength'] == 63
+        assert len(results.features(since='2024-05-02')) == 2
+        assert [row['sample'] for row in results.features(until='2024-05-02')] == ['b']
+
+
+def test_prediction_queries(tmpdir):
+    with database.ResultsDatabase(str(tmpdir.join('results.db'))) as results:
+        results.add_predictions([('a', 'Fail', 90.0, 10.0, 0.0), ('b', 'Pass', 0.0, 100.0, 0.0)],
+                                genera={'a': 'Listeria', 'b': 'Listeria'}, model_digest='model',
+                                created='2024-04-30 23:59:59')
+        results.add_predictions([('c', 'Fail', 60.0, 40.0, 0.0), ('d', 'Fail', 70.0, 30.0, 0.0)],
+                                genera={'c': 'Listeria', 'd': float('nan')}, model_digest='model',
+                                created='2024-05-01 00:00:00')
+        fails = results.predictions(prediction='Fail', genus='Listeria', since='2024-05-01')
+        assert [(row['sample'], row['percent_fail']) for row in fails] == [('c', 60.0)]
+        assert results.predictions(sample='d')[0]['genus'] == 'NA'
+
+
+def test_write_report(tmpdir):
+    sequencepath = str(tmpdir.join('fastas'))
+    shutil.copytree('tests/test_fastas', sequencepath)
+    file_dict = extract_features.filer(extract_features.find_files(sequencepath))
+    rows = make_rows(sorted(file_dict))
+    with database.ResultsDatabase(str(tmpdir.join('results.db'))) as results:
+        extract_features.write_report(rows, sequencepath, batch_size=4, results_database=results)
+        recorded = results.features()
+    assert sorted(row['sample'] for row in recorded) == sorted(file_dict)
+    assert all(row['digest'] == cache.file_digest(file_dict[row['sample']]) for row in recorded)
+    assert extract_features.read_report(sequencepath) == {row['SampleName']: row for row in rows}
+
+
+def test_digests_reused(tmpdir, monkeypatch):
+    sequencepath = str(tmpdir.join('fastas'))
+    shutil.copytree('tests/test_fastas', sequencepath)
+    file_dict = extract_features.filer(extract_features.find_files(sequencepath))
+    feature_cache = cache.FeatureCache(str(tmpdir.join('cache')), {'feature_version': cache.FEATURE_VERSION})
+    for file_name, fasta in file_dict.items():
+        feature_cache.put(cache.file_digest(fasta), make_rows([file_name])[0])
+    hashed = list()
+    file_digest = cache.file_digest
+    monkeypatch.setattr(cache, 'file_digest', lambda fasta: hashed.append(fasta) or file_digest(fasta))
+    # The digests of the cache lookups are recorded in the database, without reading the files again
+    digests = dict()
+    rows = [row for _, row in extract_features.extract_samples(file_dict, refseq_database='refseq.msh', num_threads=2,
+                                                               feature_cache=feature_cache, digests=digests)]
+    with database.ResultsDatabase(str(tmpdir.join('results.db'))) as results:
+        extract_features.write_report(rows, sequencepath, batch_size=2, results_database=results, digests=digests)
+        recorded = results.features()
+    assert sorted(hashed) == sorted(file_dict.values())
+    assert all(row['digest'] == digests[row['sample']] for row in recorded)
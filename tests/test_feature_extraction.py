@@ -164,3 +164,59 @@ def test_l90_dict_blank_contig():
 
 def test_n90_dict_normal():
     assert n90_dict['normal'] == 8
+
+
+def test_fasta_scan_blank_contig():
+    assert extract_features.fasta_scan('tests/test_fastas/blank_contig.fasta') == ([40, 0, 15], 27, 55)
+
+
+def test_fasta_scan_small_chunks():
+    assert extract_features.fasta_scan('tests/test_fastas/normal_with_lowercase.fasta', chunk_size=3) == \
+        extract_features.fasta_scan('tests/test_fastas/normal.fasta')
+
+
+def test_fasta_map_scan_blank_contig():
+    assert extract_features.fasta_map_scan('tests/test_fastas/blank_contig.fasta') == ([40, 0, 15], 27, 55, 0, 0)
+
+
+def test_fasta_map_scan_lowercase():
+    scan = extract_features.fasta_map_scan('tests/test_fastas/normal_with_lowercase.fasta')
+    assert scan[:3] == extract_features.fasta_scan('tests/test_fastas/normal.fasta')
+    assert (scan.n_count, scan.soft_masked) == (0, 9)
+
+
+def test_fasta_map_scan_masked_bases(tmpdir):
+    fasta = tmpdir.join('masked.fasta')
+    fasta.write('text before a header\n>seq1 description>\nACGTnnNN\r\nacgs \n>seq2\n\n>seq3\nGGCC')
+    assert extract_features.fasta_map_scan(str(fasta)) == ([12, 0, 4], 9, 16, 4, 6)
+    assert extract_features.fasta_map_scan(str(fasta))[:3] == extract_features.fasta_scan(str(fasta))
+
+
+def test_contig_metrics_custom_thresholds():
+    metrics = extract_features.contig_metrics([9, 8, 7, 6, 5, 4, 3, 2, 1], thresholds=(25, 95))
+    assert (metrics['N25'], metrics['L25'], metrics['N95'], metrics['L95']) == (8, 2, 2, 8)
+
+
+def test_contig_metrics_summary():
+    metrics = extract_features.contig_metrics([9, 8, 7, 6, 5, 4, 3, 2, 1])
+    assert (metrics['TotalLength'], metrics['NumContigs'], metrics['LongestContig']) == (45, 9, 9)
+
+
+def test_parse_genus_no_hits():
+    assert extract_features.parse_genus(list()) == 'NA'
+
+
+def test_contig_distribution_bin_edges():
+    assert extract_features.contig_distribution([1000001, 1000000, 5001, 5000]) == (1, 1, 0, 0, 0, 1, 1)
+
+
+def test_feature_row_columns():
+    row = extract_features.feature_row('normal', [40, 15, 8], 49.21, (5, 0, 1, 2, 2), 'Escherichia')
+    assert list(row) == extract_features.FEATURE_COLUMNS
+    assert (row['N50'], row['L90'], row['ORFs<500']) == (40, 3, 2)
+
+
+def test_orf_distribution_from_sco_lines():
+    sco = ['# Sequence Data: seqnum=1;seqlen=5000\n', '# Model Data: version=Prodigal.v2.6.3\n',
+           '>1_1_3500_+\n', '>2_10_1200_-\n', '>3_5_600_+\n', '>4_1_100_+\n']
+    assert extract_features.orf_distribution(sco) == (4, 1, 1, 1, 1)
@@ -0,0 +1,76 @@
+# Tests for the NumPy tree ensemble of OLC Quality Assessment Tool
+import pytest
+import numpy as np
+import pandas as pd
+from genomeqaml import classify, forest
+
+ensemble = pytest.importorskip('sklearn.ensemble')
+
+
+def fit(model, num_samples=300, num_features=8):
+    rng = np.random.RandomState(0)
+    x = pd.DataFrame(rng.normal(scale=1000, size=(num_samples, num_features)),
+                     columns=['feature{}'.format(i) for i in range(num_features)])
+    x['feature0'] = rng.randint(0, 2, num_samples)
+    return model.fit(x, rng.randint(0, 3, num_samples)), x
+
+
+def test_matches_extra_trees(tmpdir):
+    model, x = fit(ensemble.ExtraTreesClassifier(n_estimators=20, random_state=0))
+    forest_file = str(tmpdir.join('model.npz'))
+    forest.export_forest(model, forest_file, model_digest='digest')
+    array_forest = forest.load_forest(forest_file)
+    test = pd.DataFrame(np.random.RandomState(1).normal(scale=1000, size=(500, x.shape[1])), columns=x.columns)
+    # Include features that are exactly at a threshold, once rounded to float32
+    tree = model.estimators_[0].tree_
+    test.iloc[0, tree.feature[0]] = np.float32(tree.threshold[0])
+    assert np.array_equal(array_forest.predict_proba(test), model.predict_proba(test))
+    assert np.array_equal(array_forest.predict(test), model.predict(test))
+    assert array_forest.model_digest == 'digest'
+
+
+def test_matches_random_forest(tmpdir):
+    model, x = fit(ensemble.RandomForestClassifier(n_estimators=10, max_depth=5, random_state=0))
+    forest_file = str(tmpdir.join('model.npz'))
+    forest.export_forest(model, forest_file)
+    assert np.array_equal(forest.load_forest(forest_file).predict_proba(x), model.predict_proba(x))
+
+
+def test_wrong_features(tmpdir):
+    model, x = fit(ensemble.ExtraTreesClassifier(n_estimators=2, random_state=0))
+    forest_file = str(tmpdir.join('model.npz'))
+    forest.export_forest(model, forest_file)
+    array_forest = forest.load_forest(forest_file)
+    with pytest.raises(ValueError):
+        array_forest.predict(x.iloc[:, 1:])
+    if hasattr(model, 'feature_names_in_'):
+        # Only scikit-learn 1.0 and later record the names of the features a model was fitted with
+        with pytest.raises(ValueError):
+            array_forest.predict(x[list(reversed(x.columns))])
+
+
+def test_load_model(tmpdir):
+    model, x = fit(ensemble.ExtraTreesClassifier(n_estimators=5, random_state=0))
+    model_file = str(tmpdir.join('model.p'))
+    with open(model_file, 'wb') as model_pickle:
+        model_pickle.write(b'model')
+    forest_file = str(tmpdir.join('model.npz'))
+    forest.export_forest(model, forest_file, model_digest=classify.model_digest(model_file))
+    assert classify.model_digest(forest_file) == classify.model_digest(model_file)
+    assert np.array_equal(classify.load_model(forest_file).predict(x), model.predict(x))
+
+
+def test_bundled_model(tmpdir):
+    # model.p was pickled by scikit-learn 0.19.1, and can only be unpickled by versions close to it
+    model_file = classify.data_file('model.p')
+    try:
+        model = classify.load_model(model_file)
+    except (ImportError, AttributeError) as error:
+        pytest.skip('The bundled model cannot be loaded with this version of scikit-learn: {}'.format(error))
+    forest_file = str(tmpdir.join('model.npz'))
+    forest.export_forest(model, forest_file, model_digest=classify.model_digest(model_file))
+    array_forest = forest.load_forest(forest_file)
+    assert array_forest.n_features_in_ == len(classify.load_schema()['features'])
+    x = np.random.RandomState(0).uniform(0, 100000, size=(500, array_forest.n_features_in_))
+    assert np.array_equal(array_forest.predict_proba(x), model.predict_proba(x))
+    assert classify.model_digest(forest_file) == classify.model_digest(model_file)
@@ -0,0 +1,84 @@
+# Tests for the batch genus method of OLC Quality Assessment Tool
+import gzip
+import shutil
+from genomeqaml import extract_features, tools
+from benchmarks import run_benchmarks, synthetic
+
+
+def record_commands(monkeypatch):
+    commands = list()
+    run_once = tools.ToolRunner.run_once
+
+    def recorded(runner, command, parse):
+        commands.append(command)
+        return run_once(runner, command, parse)
+    monkeypatch.setattr(tools.ToolRunner, 'run_once', recorded)
+    return commands
+
+
+def expected_genus(fasta):
+    # The genus that the stand-in mash reports for a sample, after the Shigella remap
+    with open(fasta, 'rb') as sample:
+        return extract_features.parse_genus(extract_features.read_screen(
+            [synthetic.screen_line(synthetic.screen_genus(sample.read()))]))
+
+
+def test_read_dist():
+    dist_lines = ['/refs/Listeria/monocytogenes/a.fna\tq1.fasta\t0.04\t0\t400/1000\n',
+                  '/refs/Shigella/flexneri/b.fna\tq1.fasta\t0.01\t0\t800/1000\n',
+                  '/refs/Salmonella/enterica/c.fna\tq2.fasta\t0.02\t0\t700/1000\n']
+    hits = extract_features.read_dist(dist_lines)
+    assert [hit.query_id for hit in hits['q1.fasta']] == ['/refs/Shigella/flexneri/b.fna',
+                                                          '/refs/Listeria/monocytogenes/a.fna']
+    assert hits['q1.fasta'][0].identity == 0.99 and hits['q1.fasta'][0].shared_hashes == 800
+    assert extract_features.parse_genus(hits['q1.fasta']) == 'Escherichia'
+    assert extract_features.parse_genus(hits['q2.fasta']) == 'Salmonella'
+    assert extract_features.parse_genus(hits.get('q3.fasta', list())) == 'NA'
+
+
+def test_batch_genus(tmpdir, monkeypatch):
+    folder = str(tmpdir.join('genomes'))
+    genomes = synthetic.generate_folder(folder, 5, genome_size=20000)
+    with open(genomes['synthetic_00004'][0], 'rb') as plain, \
+            gzip.open(str(tmpdir.join('genomes', 'compressed.fasta.gz')), 'wb') as output:
+        shutil.copyfileobj(plain, output)
+    refseq_database = str(tmpdir.join('refseq.msh'))
+    files = extract_features.filer(extract_features.find_files(folder))
+    commands = record_commands(monkeypatch)
+    with run_benchmarks.stub_tools():
+        screened = dict(extract_features.extract_samples(files, refseq_database, num_threads=2))
+        del commands[:]
+        batched = dict(extract_features.extract_samples(files, refseq_database, num_threads=2, genus_method='batch'))
+        # Every sample is compared to the sketch by a single mash dist, including the compressed one
+        mash_commands = [command for command in commands if command[0] == 'mash']
+        assert len(mash_commands) == 1 and mash_commands[0][:2] == ['mash', 'dist']
+        assert sorted(mash_commands[0][-6:]) == sorted(files.values())
+        assert batched == screened
+        # Samples join a batch as they are started, and the last batch is screened once every sample has started
+        monkeypatch.setattr(extract_features, 'GENUS_BATCH_SIZE', 2)
+        del commands[:]
+        assert dict(extract_features.extract_samples(files, refseq_database, num_threads=1,
+                                                     genus_method='batch')) == screened
+        assert len([command for command in commands if command[0] == 'mash']) == 3
+        del commands[:]
+        genus_dict = extract_features.find_genus_batch(files, refseq_database, threads=1, batch_size=4)
+        assert len(commands) == 2
+        # find_genus keeps its signature, and screens each sample with mash screen
+        del commands[:]
+        assert extract_features.find_genus(files, refseq_database, folder, 2) == genus_dict
+        # The compressed sample is streamed to mash screen on its stdin, rather than run from the file
+        assert [command[:2] for command in commands] == [['mash', 'screen']] * 5
+    genomes['compressed'] = genomes['synthetic_00004']
+    assert genus_dict == {file_name: expected_genus(fasta) for file_name, (fasta, _, _) in genomes.items()}
+
+
+def test_batch_failure(tmpdir):
+    genomes = synthetic.generate_folder(str(tmpdir.join('genomes')), 3, genome_size=20000)
+    batch = [(file_name, fasta) for file_name, (fasta, _, _) in sorted(genomes.items())]
+    batch.insert(1, ('missing', str(tmpdir.join('missing.fasta'))))
+    with run_benchmarks.stub_tools():
+        genus_dict = extract_features.dist_genus(batch, str(tmpdir.join('refseq.msh')),
+                                                 tool_runner=tools.ToolRunner(retries=0))
+    # Only the sample that mash could not read fails
+    assert isinstance(genus_dict.pop('missing'), tools.ToolError)
+    assert sorted(genus_dict) == sorted(genomes) and 'NA' not in genus_dict.values()
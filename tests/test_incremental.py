@@ -0,0 +1,45 @@
+# Tests for incremental feature report updates of OLC Quality Assessment Tool
+import os
+import shutil
+from genomeqaml import extract_features
+
+
+def write_existing_report(sequencepath):
+    file_dict = extract_features.filer(extract_features.find_files(sequencepath))
+    rows = [extract_features.feature_row(file_name, [10], 50.0, (1, 0, 0, 0, 1), 'NA') for file_name in file_dict]
+    extract_features.write_report(rows, sequencepath)
+    extract_features.write_index({file_name: extract_features.file_state(fasta, digest=True)
+                                  for file_name, fasta in file_dict.items()}, sequencepath)
+
+
+def test_report_round_trip(tmpdir):
+    row = extract_features.feature_row('normal', [40, 15, 8], 49.21, (5, 0, 1, 2, 2), 'Escherichia')
+    extract_features.write_report([row], str(tmpdir))
+    assert extract_features.read_report(str(tmpdir)) == {'normal': row}
+
+
+def test_plan_update(tmpdir):
+    sequencepath = str(tmpdir.join('fastas'))
+    shutil.copytree('tests/test_fastas', sequencepath)
+    write_existing_report(sequencepath)
+    # Remove one sample, add another, change the contents of a third, and touch a fourth without changing it
+    os.remove(os.path.join(sequencepath, 'one_contig.fasta'))
+    shutil.copy(os.path.join(sequencepath, 'normal.fasta'), os.path.join(sequencepath, 'new.fasta'))
+    with open(os.path.join(sequencepath, 'normal.fasta'), 'a') as fasta:
+        fasta.write('>seq4\nGGGG\n')
+    os.utime(os.path.join(sequencepath, 'fifty_gc.fasta'), (0, 0))
+    file_dict = extract_features.filer(extract_features.find_files(sequencepath))
+    rows, stale_dict, index = extract_features.plan_update(file_dict, sequencepath)
+    assert sorted(stale_dict) == ['new', 'normal']
+    assert sorted(row['SampleName'] for row in rows) == sorted(index)
+    assert 'one_contig' not in index
+    assert 'fifty_gc' in index
+
+
+def test_batched_report(tmpdir):
+    rows = [extract_features.feature_row(name, [10], 50.0, (1, 0, 0, 0, 1), 'NA') for name in 'edcba']
+    consumed = list()
+    extract_features.write_report((consumed.append(row) or row for row in rows), str(tmpdir), batch_size=2)
+    assert len(consumed) == 5
+    assert list(extract_features.read_report(str(tmpdir))) == ['d', 'e', 'b', 'c', 'a']
+    assert [len(batch) for batch in extract_features.batches(range(5), 2)] == [2, 2, 1]
@@ -0,0 +1,47 @@
+# Tests for the instrumentation of OLC Quality Assessment Tool
+import sys
+import json
+import pstats
+import subprocess
+from genomeqaml import extract_features, instrument
+
+
+def test_stages(tmpdir):
+    metrics_file = str(tmpdir.join('metrics.jsonl'))
+    with instrument.Recorder(jsonl_file=metrics_file) as recorder:
+        with recorder.stage('outer'):
+            with recorder.stage('read', 'normal'):
+                with open('tests/test_fastas/normal.fasta', 'rb') as fasta:
+                    fasta.read()
+            with recorder.stage('child', 'normal'):
+                process = subprocess.Popen([sys.executable, '-c', 'sum(range(3000000))'])
+                assert instrument.wait_child(process) == 0
+        assert instrument.stage(None, 'unmeasured') is not None
+    with open(metrics_file) as metrics:
+        records = [json.loads(line) for line in metrics]
+    assert [(record['stage'], record['sample']) for record in records] == [('read', 'normal'), ('child', 'normal'),
+                                                                           ('outer', None)]
+    read, child, outer = records
+    assert read['bytes_read'] >= 100
+    assert child['child_cpu'] > 0
+    assert outer['wall'] >= read['wall'] + child['wall']
+    assert recorder.summary()['child']['count'] == 1
+    assert recorder.summary_table().splitlines()[0].split() == ['stage'] + instrument.SUMMARY_COLUMNS
+
+
+def test_extraction_stages(tmpdir, monkeypatch):
+    monkeypatch.setattr(extract_features, 'screen_genus', lambda screen_args, *_: (screen_args[0], 'Listeria'))
+    monkeypatch.setattr(extract_features, 'sample_orfs', lambda fasta, *_: (3, 0, 1, 1, 1))
+    hook = instrument.ProfileHook(str(tmpdir.join('profiles')))
+    recorder = instrument.Recorder(hook=hook)
+    extract_features.main('tests/test_fastas', report=False, refseq_database='refseq.msh', num_threads=2,
+                          instrumentation=recorder)
+    summary = recorder.summary()
+    assert {name: total['count'] for name, total in summary.items()} == {'stats': 9, 'genus': 9, 'orfs': 9,
+                                                                         'extract_features': 1}
+    assert {record['sample'] for record in recorder.records if record['stage'] == 'stats'} == \
+        set(extract_features.filer(extract_features.find_files('tests/test_fastas')))
+    profiles = sorted(hook.save())
+    assert [path.rsplit('/', 1)[1] for path in profiles] == sorted('{}.prof'.format(name) for name in summary)
+    stats_profile = pstats.Stats(str(tmpdir.join('profiles', 'stats.prof')))
+    assert any(function == 'fasta_map_scan' for _, _, function in stats_profile.stats)
@@ -0,0 +1,161 @@
+# Tests for the in-process mash screen of OLC Quality Assessment Tool
+import json
+import shutil
+import struct
+import subprocess
+import pytest
+import numpy as np
+from genomeqaml import minhash, extract_features
+
+# A genome and the dump (mash info -d) of its sketch by mash sketch -s 500, from the test data of sourmash
+MASH_GENOME = 'tests/test_mash/genome-s11.fa.gz'
+MASH_DUMP = 'tests/test_mash/genome-s11.fa.gz.msh.json'
+
+
+def struct_pointer(offset, data_words, pointer_words):
+    return ((offset & 0x3fffffff) << 2) | (data_words << 32) | (pointer_words << 48)
+
+
+def list_pointer(offset, element_size, count):
+    return ((offset & 0x3fffffff) << 2) | 1 | (element_size << 32) | (count << 35)
+
+
+def far_pointer(segment, pad):
+    return 2 | (pad << 3) | (segment << 32)
+
+
+def write_sketch(path, references, kmer_size=21):
+    """
+    Write a Cap'n Proto MinHash message laid out in the same way as a mash sketch, as in MinHash.capnp of mash. The hash
+    lists are written to a second segment, and reached through far pointers, as in large sketches
+    """
+    words = [0]
+    hash_words = list()
+
+    def allocate(num_words):
+        start = len(words)
+        words.extend([0] * num_words)
+        return start
+
+    def pack(data):
+        padded = data + b'\0' * ((8 - len(data) % 8) % 8)
+        return list(struct.unpack('<{}Q'.format(len(padded) // 8), padded))
+
+    def allocate_bytes(data):
+        packed = pack(data)
+        start = allocate(len(packed))
+        words[start:start + len(packed)] = packed
+        return start
+
+    # MinHash: kmerSize, windowSize, minHashesPerWindow, concatenated, error, noncanonical, preserveCase and hashSeed in
+    # three data words, then referenceList, referenceListOld, alphabet, and locusList
+    root = allocate(7)
+    words[0] = struct_pointer(root - 1, 3, 4)
+    words[root] = kmer_size
+    words[root + 2] = 42 << 32
+    reference_list = allocate(1)
+    words[root + 3] = struct_pointer(reference_list - root - 4, 0, 1)
+    alphabet = allocate_bytes(b'ACGT\0')
+    words[root + 5] = list_pointer(alphabet - root - 6, 2, 5)
+    # Reference: length and length64 in two data words, then sequence, quality, name, comment, hashes32, hashes64 and
+    # counts32
+    tag = allocate(1)
+    elements = allocate(len(references) * 9)
+    words[reference_list] = list_pointer(tag - reference_list - 1, 7, len(references) * 9)
+    words[tag] = struct_pointer(len(references), 2, 7)
+    for i, (name, hashes) in enumerate(references):
+        pointers = elements + i * 9 + 2
+        name_start = allocate_bytes(name.encode() + b'\0')
+        words[pointers + 2] = list_pointer(name_start - pointers - 3, 2, len(name) + 1)
+        # The landing pad of the far pointer is a list pointer to the hashes that follow it
+        pad = len(hash_words)
+        hash_words.append(list_pointer(0, 5, len(hashes)))
+        hash_words.extend(pack(np.sort(np.asarray(hashes, dtype='<u8')).tobytes()))
+        words[pointers + 5] = far_pointer(1, pad)
+    with open(path, 'wb') as sketch:
+        sketch.write(struct.pack('<IIII', 1, len(words), len(hash_words), 0))
+        sketch.write(struct.pack('<{}Q'.format(len(words)), *words))
+        sketch.write(struct.pack('<{}Q'.format(len(hash_words)), *hash_words))
+
+
+def fasta_hashes(fasta, kmer_size=21):
+    hashes = [h for sequence in minhash.fasta_sequences(fasta)
+              for h in minhash.kmer_hashes(sequence.upper(), kmer_size)]
+    return np.unique(np.concatenate(hashes))
+
+
+def test_murmurhash3():
+    words = np.frombuffer(b'ACGTACGTACGTACGTACGTA\0\0\0', dtype='<u8').reshape(1, 3)
+    assert minhash.murmurhash3_x64_64(words, 21, 42)[0] == 13036166743686632327
+
+
+def test_canonical_kmers():
+    assert list(minhash.kmer_hashes(b'AAAAAAAAAAAAAAAAAAAAA', 21))[0][0] == \
+        list(minhash.kmer_hashes(b'TTTTTTTTTTTTTTTTTTTTT', 21))[0][0]
+
+
+def test_kmers_with_ambiguous_bases_skipped():
+    assert len(list(minhash.kmer_hashes(b'ACGTACGTACNTACGTACGTACGTA', 21))[0]) == 0
+
+
+def test_read_sketch(tmpdir):
+    sketch_file = str(tmpdir.join('refseq.msh'))
+    write_sketch(sketch_file, [('/refs/Listeria/monocytogenes/a.fna', [3, 1, 2])])
+    sketch = minhash.read_sketch(sketch_file)
+    assert sketch['kmer_size'] == 21
+    assert sketch['hash_seed'] == 42
+    assert sketch['references'][0][0] == '/refs/Listeria/monocytogenes/a.fna'
+    assert sketch['references'][0][1].tolist() == [1, 2, 3]
+
+
+def test_screen_genus(tmpdir):
+    sketch_file = str(tmpdir.join('refseq.msh'))
+    query_hashes = fasta_hashes('tests/test_fastas/normal.fasta')
+    write_sketch(sketch_file, [('/refs/Listeria/monocytogenes/a.fna', [1, 2, 3]),
+                               ('/refs/Shigella/flexneri/b.fna', query_hashes)])
+    hits = minhash.ScreenIndex(minhash.read_sketch(sketch_file)).screen('tests/test_fastas/normal.fasta')
+    assert len(hits) == 1
+    assert hits[0].identity == 1.0
+    assert extract_features.parse_genus(hits) == 'Escherichia'
+
+
+def test_screen_identity_cutoff(tmpdir):
+    sketch_file = str(tmpdir.join('refseq.msh'))
+    # Only a quarter of the reference hashes are in the query - an identity of 0.25 ** (1 / 21), below the cutoff
+    query_hashes = fasta_hashes('tests/test_fastas/normal.fasta')
+    absent_hashes = np.arange(1, 3 * query_hashes.size + 1, dtype=np.uint64)
+    write_sketch(sketch_file, [('/refs/Listeria/monocytogenes/a.fna', np.concatenate((query_hashes, absent_hashes)))])
+    index = minhash.ScreenIndex(minhash.read_sketch(sketch_file))
+    assert index.screen('tests/test_fastas/normal.fasta') == list()
+    assert index.screen('tests/test_fastas/normal.fasta', min_identity=0.9)[0].shared_hashes == query_hashes.size
+
+
+def test_mash_hashes(tmpdir):
+    with open(MASH_DUMP) as dump:
+        sketch = json.load(dump)
+    assert (sketch['kmer'], sketch['hashSeed'], sketch['canonical']) == (21, 42, True)
+    hashes = sketch['sketches'][0]['hashes']
+    # The smallest hashes of the k-mers of the genome are the sketch made by mash
+    assert fasta_hashes(MASH_GENOME)[:len(hashes)].tolist() == hashes
+    sketch_file = str(tmpdir.join('genome.msh'))
+    write_sketch(sketch_file, [('/refs/Listeria/monocytogenes/genome-s11.fa.gz', hashes)])
+    hits = minhash.ScreenIndex(minhash.read_sketch(sketch_file)).screen(MASH_GENOME)
+    assert [(hit.identity, hit.shared_hashes) for hit in hits] == [(1.0, 500)]
+
+
+@pytest.mark.skipif(shutil.which('mash') is None, reason='mash is not installed')
+def test_mash_sketch(tmpdir):
+    sketch_file = str(tmpdir.join('genome.msh'))
+    subprocess.check_call(['mash', 'sketch', '-s', '500', '-o', sketch_file, MASH_GENOME])
+    with open(MASH_DUMP) as dump:
+        hashes = json.load(dump)['sketches'][0]['hashes']
+    sketch = minhash.read_sketch(sketch_file)
+    assert (sketch['kmer_size'], sketch['hash_seed']) == (21, 42)
+    assert [(name, reference_hashes.tolist()) for name, reference_hashes in sketch['references']] == \
+        [(MASH_GENOME, hashes)]
+    # The screen of the genome against its own sketch matches mash screen
+    screen_output = subprocess.check_output(['mash', 'screen', sketch_file, MASH_GENOME], universal_newlines=True)
+    expected = extract_features.read_screen(screen_output.splitlines())
+    hits = minhash.ScreenIndex(sketch).screen(MASH_GENOME)
+    assert [(hit.identity, '{}/{}'.format(hit.shared_hashes, hit.sketch_size), hit.query_id) for hit in hits] == \
+        [(result.identity, result.shared_hashes, result.query_id) for result in expected]
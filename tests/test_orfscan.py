@@ -0,0 +1,101 @@
+# Tests for the in-process ORF scan of OLC Quality Assessment Tool
+import gzip
+import random
+import shutil
+import numpy as np
+from genomeqaml import extract_features, orfscan
+from benchmarks import synthetic
+
+STARTS = {'ATG', 'GTG', 'TTG'}
+STOPS = {'TAA', 'TAG', 'TGA'}
+
+
+def brute_force_orfs(contigs, min_length, partial):
+    # Walk every frame of both strands codon by codon, as the scan is described
+    joined = 'NNN' + 'NNN'.join(contigs) + 'NNN'
+    orfs = list()
+    reverse = ''.join({'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A', 'N': 'N'}[base] for base in reversed(joined))
+    for strand, sequence in ((1, joined), (-1, reverse)):
+        for frame in range(3):
+            begin = None
+            after_edge = True
+            for i in range(frame, len(sequence) - 2, 3):
+                codon = sequence[i:i + 3]
+                if 'N' in codon or codon in STOPS:
+                    end = i if 'N' in codon else i + 3
+                    if begin is not None and (partial or 'N' not in codon) and end - begin >= min_length:
+                        orfs.append((begin, end) if strand == 1 else (len(joined) - end, len(joined) - begin))
+                    begin = None
+                    after_edge = 'N' in codon
+                    continue
+                if begin is None and (codon in STARTS or (after_edge and partial)):
+                    begin = i
+                after_edge = False
+    return sorted(orfs)
+
+
+def test_find_orfs():
+    rng = random.Random(5)
+    for trial in range(50):
+        contigs = [''.join(rng.choice('ACGT') for _ in range(rng.randint(1, 600))) for _ in range(rng.randint(1, 3))]
+        if trial % 3 == 0:
+            contigs[0] = contigs[0][:50] + 'NNNNN' + contigs[0][50:]
+        for partial in (True, False):
+            # Nothing is dropped with an overlap this large
+            begins, ends = orfscan.find_orfs([contig.encode() for contig in contigs], min_length=90,
+                                             max_overlap=10 ** 9, partial=partial)
+            assert sorted(zip(begins.tolist(), ends.tolist())) == brute_force_orfs(contigs, 90, partial)
+
+
+def test_overlapped():
+    begins = np.array([0, 100, 950, 1200, 2000])
+    ends = np.array([1000, 400, 1500, 1400, 2300])
+    ranks = np.argsort(np.argsort(ends - begins))
+    dropped = orfscan.overlapped(begins, ends, ranks, 60) | orfscan.overlapped(-ends, -begins, ranks, 60)
+    # Within the first, overlapping the first by 50 bases, within the third, and apart from the rest
+    assert dropped.tolist() == [False, True, False, True, False]
+    assert not orfscan.overlapped(np.array([], dtype=int), np.array([], dtype=int), np.array([], dtype=int)).size
+
+
+def test_gene():
+    gene = synthetic.gene_sequence(600, 0.5, random.Random(1))
+    flank = 'C' * 30
+    for sequence in (flank + gene + flank, synthetic.reverse_complement(flank + gene + flank),
+                     (flank + gene + flank).lower()):
+        assert orfscan.orf_distribution([sequence.encode()], partial=False) == (1, 0, 0, 1, 0)
+    # A gene that runs off the end of its contig is only counted if partial genes are
+    assert orfscan.orf_distribution([(flank + gene[:-3]).encode()], partial=False)[3] == 0
+    assert orfscan.orf_distribution([(flank + gene[:-3]).encode()])[3] == 1
+    assert orfscan.orf_distribution([]) == (0, 0, 0, 0, 0)
+
+
+def test_planted_genes(tmpdir):
+    genomes = synthetic.generate_folder(str(tmpdir), 2, genome_size=100000, num_contigs=5, coding=True)
+    for fasta, contig_lengths, _ in genomes.values():
+        planted = extract_features.orf_distribution(synthetic.sco_lines(contig_lengths))
+        found = orfscan.sample_orfs(fasta)
+        # Every long gene is found, and the ORFs of the other sizes are close
+        assert found[1] == planted[1]
+        assert abs(found[2] - planted[2]) <= 0.25 * planted[2]
+        assert abs(found[3] - planted[3]) <= 0.25 * planted[3]
+
+
+def test_extract_orfscan(tmpdir, monkeypatch):
+    # prodigal is never run
+    monkeypatch.setattr(extract_features, 'sample_orfs', None)
+    monkeypatch.setattr(extract_features, 'screen_genus', lambda screen_args, *_: (screen_args[0], 'Listeria'))
+    sequencepath = str(tmpdir.join('fastas'))
+    shutil.copytree('tests/test_fastas', sequencepath)
+    genomes = synthetic.generate_folder(str(tmpdir.join('coding')), 1, genome_size=50000, coding=True)
+    fasta = genomes['synthetic_00000'][0]
+    shutil.copy(fasta, sequencepath)
+    orf_dist_dict = extract_features.main(sequencepath, report=False, refseq_database='refseq.msh', num_threads=2,
+                                          orf_method='orfscan')[-1]
+    assert orf_dist_dict['synthetic_00000'] == orfscan.sample_orfs(fasta)
+    # Samples too short for prodigal have no ORFs, as with prodigal
+    assert orf_dist_dict['normal'] == (0, 0, 0, 0, 0)
+    # Compressed samples are scanned as they are streamed
+    compressed = str(tmpdir.join('compressed.fasta.gz'))
+    with open(fasta, 'rb') as plain, gzip.open(compressed, 'wb') as output:
+        shutil.copyfileobj(plain, output)
+    assert extract_features.stream_sample(compressed, orf_method='orfscan')[2] == orf_dist_dict['synthetic_00000']
@@ -0,0 +1,36 @@
+# Tests for the CPU budget of OLC Quality Assessment Tool
+from genomeqaml import resources
+
+
+def test_cgroup_v2_quota(tmpdir):
+    tmpdir.join('cpu.max').write('250000 100000\n')
+    assert resources.cgroup_cpu_quota(str(tmpdir)) == 2.5
+
+
+def test_cgroup_v2_unlimited(tmpdir):
+    tmpdir.join('cpu.max').write('max 100000\n')
+    assert resources.cgroup_cpu_quota(str(tmpdir)) is None
+
+
+def test_cgroup_v1_quota(tmpdir):
+    cpu = tmpdir.mkdir('cpu,cpuacct')
+    cpu.join('cpu.cfs_quota_us').write('400000\n')
+    cpu.join('cpu.cfs_period_us').write('100000\n')
+    assert resources.cgroup_cpu_quota(str(tmpdir)) == 4
+
+
+def test_available_cpus_respects_quota(tmpdir):
+    tmpdir.join('cpu.max').write('50000 100000\n')
+    assert resources.available_cpus(str(tmpdir)) == 1
+
+
+def test_split_cpus_many_samples():
+    assert resources.split_cpus(64, num_samples=500) == (64, 1)
+
+
+def test_split_cpus_few_samples():
+    assert resources.split_cpus(64, num_samples=4) == (4, 16)
+
+
+def test_split_cpus_fixed_tool_threads():
+    assert resources.split_cpus(8, num_samples=100, tool_threads=4) == (2, 4)
@@ -0,0 +1,83 @@
+# Tests for sharded feature extraction of OLC Quality Assessment Tool
+import os
+import json
+import shutil
+import pytest
+from genomeqaml import extract_features, shard
+
+
+def sample(name, size):
+    return {'name': name, 'file': name + '.fasta', 'size': size, 'digest': name}
+
+
+def test_assign_shards():
+    samples = [sample('s{:02d}'.format(i), size) for i, size in enumerate([90, 10, 50, 50, 40, 30, 20, 10, 100])]
+    shards = shard.assign_shards(samples, 3)
+    assert sorted(s['name'] for shard_samples in shards for s in shard_samples) == sorted(s['name'] for s in samples)
+    assert sorted(sum(s['size'] for s in shard_samples) for shard_samples in shards) == [130, 130, 140]
+    # Every worker calculates the same split, whatever the order of the manifest
+    assert shard.assign_shards(list(reversed(samples)), 3) == shards
+    assert shard.assign_shards(samples, 20)[-1] == list()
+
+
+def test_array_task():
+    environ = {'SLURM_ARRAY_TASK_ID': '5', 'SLURM_ARRAY_TASK_MIN': '1', 'SLURM_ARRAY_TASK_COUNT': '10'}
+    assert shard.array_task(environ=environ) == (4, 10)
+    assert shard.array_task(2, 3, environ=environ) == (2, 3)
+    with pytest.raises(ValueError):
+        shard.array_task(environ=dict())
+    with pytest.raises(ValueError):
+        shard.array_task(3, 3)
+
+
+def test_extract_and_merge(tmpdir, monkeypatch):
+    monkeypatch.setattr(extract_features, 'screen_genus', lambda screen_args, *_: (screen_args[0], 'Listeria'))
+    monkeypatch.setattr(extract_features, 'sample_orfs', lambda fasta, *_: (3, 0, 1, 1, 1))
+    sequencepath = str(tmpdir.join('fastas'))
+    shutil.copytree('tests/test_fastas', sequencepath)
+    manifest_file = str(tmpdir.join('manifest.json'))
+    shard.write_json(shard.build_manifest(sequencepath, num_threads=2), manifest_file)
+    output_dir = str(tmpdir.join('shards'))
+    for k in range(3):
+        shard.extract_shard(manifest_file, k, 3, output_dir, refseq_database='refseq.msh', num_threads=2)
+    merged = shard.merge_shards(manifest_file, output_dir, report_dir=str(tmpdir))
+    expected = extract_features.main(sequencepath, report=True, refseq_database='refseq.msh', num_threads=2)
+    assert extract_features.rows_to_dicts(merged) == expected
+    with open(str(tmpdir.join(extract_features.REPORT_FILE))) as merged_report:
+        with open(os.path.join(sequencepath, extract_features.REPORT_FILE)) as report:
+            assert merged_report.read() == report.read()
+    # A sample reported by two shards is refused
+    duplicate_folder = shard.shard_folder(output_dir, 1, 3)
+    rows = list(extract_features.read_report(duplicate_folder).values()) + \
+        list(extract_features.read_report(shard.shard_folder(output_dir, 0, 3)).values())[:1]
+    extract_features.write_report(rows, duplicate_folder)
+    record_file = os.path.join(duplicate_folder, shard.SHARD_RECORD)
+    with open(record_file) as record_json:
+        record = json.load(record_json)
+    record['samples'] = [row['SampleName'] for row in rows]
+    shard.write_json(record, record_file)
+    with pytest.raises(ValueError, match='more than one shard'):
+        shard.merge_shards(manifest_file, output_dir, num_shards=3, report_dir=str(tmpdir))
+    # As is an incomplete shard
+    os.remove(record_file)
+    with pytest.raises(ValueError, match='shard 1 is incomplete'):
+        shard.merge_shards(manifest_file, output_dir, num_shards=3, report_dir=str(tmpdir))
+
+
+def test_changed_sample(tmpdir, monkeypatch):
+    monkeypatch.setattr(extract_features, 'screen_genus', lambda screen_args, *_: (screen_args[0], 'Listeria'))
+    monkeypatch.setattr(extract_features, 'sample_orfs', lambda fasta, *_: (3, 0, 1, 1, 1))
+    sequencepath = str(tmpdir.join('fastas'))
+    shutil.copytree('tests/test_fastas', sequencepath)
+    manifest_file = str(tmpdir.join('manifest.json'))
+    shard.write_json(shard.build_manifest(sequencepath, num_threads=2), manifest_file)
+    # The contents change, but the size does not
+    fasta = os.path.join(sequencepath, 'normal.fasta')
+    with open(fasta) as handle:
+        contents = handle.read()
+    with open(fasta, 'w') as handle:
+        handle.write(contents.replace('A', 'C'))
+    output_dir = str(tmpdir.join('shards'))
+    with pytest.raises(ValueError, match='normal.fasta has changed'):
+        shard.extract_shard(manifest_file, 0, 1, output_dir, refseq_database='refseq.msh', num_threads=2)
+    assert not os.path.isfile(os.path.join(shard.shard_folder(output_dir, 0, 1), shard.SHARD_RECORD))
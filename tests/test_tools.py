@@ -0,0 +1,151 @@
+# Tests for running the external tools of OLC Quality Assessment Tool
+import os
+import sys
+import gzip
+import random
+import shutil
+import pytest
+from genomeqaml import extract_features, tools
+
+# Stand-in for prodigal, which fails on the samples named in FAIL_SAMPLES, and hangs on the samples in HANG_SAMPLES.
+# A sample read from stdin is named -. As with prodigal, samples shorter than 20 kbp are refused if they fail, and
+# stdin is copied to a file in the working directory, which is only removed once the sample has succeeded
+PRODIGAL = """#!{python}
+import os
+import sys
+import time
+name = sys.argv[sys.argv.index('-i') + 1] if '-i' in sys.argv else '-'
+lines = (open(name) if name != '-' else sys.stdin).readlines()
+copy = 'tmp.prodigal.stdin.{{}}'.format(os.getpid())
+if name == '-':
+    open(copy, 'w').writelines(lines)
+sample = os.path.basename(name).split('.')[0]
+if sample in os.environ.get('FAIL_SAMPLES', '').split(','):
+    if sum(len(line.strip()) for line in lines if not line.startswith('>')) < 20000:
+        sys.exit('Error:  Sequence must be 20000 characters')
+    sys.exit('Error: bad sequence in ' + name)
+if sample in os.environ.get('HANG_SAMPLES', '').split(','):
+    time.sleep(60)
+for i, line in enumerate(line for line in lines if line.startswith('>')):
+    print('>{{}}_1_{{}}_+'.format(i + 1, 400 * (i + 1)))
+if name == '-':
+    os.remove(copy)
+"""
+MASH = """#!{python}
+import sys
+sys.stdin.read() if '-' in sys.argv else None
+print('0.99\\t900/1000\\t1\\t0\\t/refs/Listeria/sp/GCF.fna\\tdesc')
+"""
+
+
+@pytest.fixture
+def stub_tools(tmpdir, monkeypatch):
+    bin_dir = tmpdir.mkdir('bin')
+    for name, script in (('prodigal', PRODIGAL), ('mash', MASH)):
+        path = bin_dir.join(name)
+        path.write(script.format(python=sys.executable))
+        path.chmod(0o755)
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ['PATH'])
+
+
+def write_long_sample(fasta, length=25000):
+    rng = random.Random(length)
+    with open(fasta, 'w') as output:
+        output.write('>contig_1\n{}\n'.format(''.join(rng.choice('ACGT') for _ in range(length))))
+
+
+def python(code):
+    return [sys.executable, '-c', code]
+
+
+def test_run():
+    runner = tools.ToolRunner(retries=0)
+    assert runner.run(python('print("a"); print("b")'), list) == ['a\n', 'b\n']
+    with pytest.raises(tools.ToolError) as error:
+        runner.run(python('import sys; sys.stderr.write("first\\nlast problem\\n"); sys.exit(3)'), list)
+    assert error.value.returncode == 3
+    assert 'exited with status 3: last problem' in str(error.value)
+    with pytest.raises(tools.ToolError) as error:
+        runner.run(['genomeqaml_missing_tool', '-h'], list)
+    assert not error.value.retry
+    with pytest.raises(tools.ToolError) as error:
+        runner.run(python('print("x")'), lambda lines: int(next(iter(lines))))
+    assert 'could not be parsed' in str(error.value)
+
+
+def test_timeout():
+    runner = tools.ToolRunner(timeout=0.5, retries=0)
+    with pytest.raises(tools.ToolError) as error:
+        runner.run(python('import time; print("started", flush=True); time.sleep(60)'), list)
+    assert 'timed out' in str(error.value)
+    assert runner.run(python('print("quick")'), list) == ['quick\n']
+
+
+def test_retry(tmpdir):
+    marker = str(tmpdir.join('attempts'))
+    # Fails on the first attempt only
+    flaky = python('import os, sys\n'
+                   'open({0!r}, "a").write("x")\n'
+                   'sys.exit(1 if os.path.getsize({0!r}) == 1 else 0)'.format(marker))
+    assert tools.ToolRunner(retries=1, backoff=0).run(flaky, list) == list()
+    with open(marker) as attempts:
+        assert attempts.read() == 'xx'
+    os.remove(marker)
+    with pytest.raises(tools.ToolError):
+        tools.ToolRunner(retries=0, backoff=0).run(flaky, list)
+    # Tools that are not installed are not tried again
+    calls = list()
+
+    def missing():
+        calls.append(1)
+        raise tools.ToolError(['missing'], 'could not be started', retry=False)
+    with pytest.raises(tools.ToolError):
+        tools.ToolRunner(retries=3, backoff=0).call(missing)
+    assert len(calls) == 1
+
+
+def test_failed_samples(tmpdir, stub_tools, monkeypatch):
+    sequencepath = str(tmpdir.join('fastas'))
+    shutil.copytree('tests/test_fastas', sequencepath)
+    write_long_sample(os.path.join(sequencepath, 'long.fasta'))
+    monkeypatch.setenv('FAIL_SAMPLES', 'normal,long')
+    failures = dict()
+    features = extract_features.main(sequencepath, report=False, refseq_database='refseq.msh', num_threads=2,
+                                     tool_runner=tools.ToolRunner(backoff=0), failures=failures)
+    assert list(failures) == ['long']
+    assert 'bad sequence' in failures['long']
+    gc_dict, orf_dist_dict = features[0], features[-1]
+    assert 'long' not in gc_dict
+    assert len(gc_dict) == len(orf_dist_dict) == 9
+    # prodigal refuses samples that are too short, which have no ORFs
+    assert orf_dist_dict['normal'] == (0, 0, 0, 0, 0)
+    assert orf_dist_dict['one_contig'] != (0, 0, 0, 0, 0)
+
+
+def test_failed_stream(tmpdir, stub_tools, monkeypatch):
+    normal = os.path.abspath('tests/test_fastas/normal.fasta')
+    work_dir = tmpdir.mkdir('work')
+    monkeypatch.chdir(work_dir)
+    plain = str(tmpdir.join('long.fasta'))
+    write_long_sample(plain)
+    compressed = str(tmpdir.join('long.fasta.gz'))
+    with open(plain, 'rb') as plain_file, gzip.open(compressed, 'wb') as output:
+        shutil.copyfileobj(plain_file, output)
+    _, genus, orfs = extract_features.stream_sample(compressed, refseq_database='refseq.msh')
+    assert genus == 'Listeria' and orfs == (1, 0, 0, 0, 1)
+    monkeypatch.setenv('FAIL_SAMPLES', '-')
+    with pytest.raises(tools.ToolError) as error:
+        extract_features.stream_sample(compressed, refseq_database='refseq.msh',
+                                       tool_runner=tools.ToolRunner(backoff=0))
+    assert error.value.command[0] == 'prodigal' and error.value.returncode == 1
+    short = str(tmpdir.join('normal.fasta.gz'))
+    with open(normal, 'rb') as plain_file, gzip.open(short, 'wb') as output:
+        shutil.copyfileobj(plain_file, output)
+    assert extract_features.stream_sample(short)[2] == (0, 0, 0, 0, 0)
+    monkeypatch.setenv('FAIL_SAMPLES', '')
+    monkeypatch.setenv('HANG_SAMPLES', '-')
+    with pytest.raises(tools.ToolError) as error:
+        extract_features.stream_sample(compressed, tool_runner=tools.ToolRunner(timeout=1, retries=0))
+    assert 'timed out' in str(error.value)
+    # The copies of stdin of the failed runs are not left in the working directory
+    assert work_dir.listdir() == []
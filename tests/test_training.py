@@ -0,0 +1,84 @@
+# Tests for model training of OLC Quality Assessment Tool
+import os
+import shutil
+import pytest
+import numpy as np
+import pandas as pd
+from genomeqaml import extract_features
+
+scikit_learn_test = pytest.importorskip('scikit_learn_test')
+
+PARAM_DICT = {'n_estimators': [5, 10],
+              'max_depth': [2, 5],
+              'max_leaf_nodes': [10],
+              'criterion': ['gini']}
+
+
+def training_dataframe(num_samples=90):
+    rng = np.random.RandomState(0)
+    rows = [extract_features.feature_row('sample{}'.format(i), list(rng.randint(100, 100000, rng.randint(1, 20))),
+                                         rng.uniform(30, 60), (10, 1, 2, 3, 4), ['Listeria', 'Salmonella', 'NA'][i % 3])
+            for i in range(num_samples)]
+    dataframe = pd.DataFrame(rows, columns=extract_features.FEATURE_COLUMNS)
+    dataframe['PassFail'] = [i % 3 for i in range(num_samples)]
+    return dataframe
+
+
+def test_search_resumes(tmpdir):
+    search_cache = str(tmpdir.join('search'))
+    scikit_learn_test.fit_model(training_dataframe(), n_jobs=2, search_cache=search_cache, param_dict=PARAM_DICT)
+    score_file, = [os.path.join(root, 'scores.jsonl') for root, _, files in os.walk(search_cache)
+                   if 'scores.jsonl' in files]
+    with open(score_file) as scores:
+        assert len(scores.readlines()) == 4 * 5
+    # A repeated search with the same data reuses every score
+    scikit_learn_test.fit_model(training_dataframe(), n_jobs=2, search_cache=search_cache, param_dict=PARAM_DICT)
+    with open(score_file) as scores:
+        assert len(scores.readlines()) == 4 * 5
+
+
+def test_halving_search():
+    model = scikit_learn_test.fit_model(training_dataframe(), search='halving', n_jobs=2, param_dict=PARAM_DICT,
+                                        factor=2)
+    assert model.n_estimators in (5, 10)
+    # Training data is ordered by class, as combine_csv_files builds it
+    dataframe = training_dataframe().sort_values('PassFail', kind='stable').reset_index(drop=True)
+    model = scikit_learn_test.fit_model(dataframe, search='halving', n_jobs=2, param_dict=PARAM_DICT, factor=2)
+    assert model.n_estimators in (5, 10)
+    search_state = scikit_learn_test.SearchState(dataframe.drop(columns=['SampleName', 'PassFail']),
+                                                 dataframe['PassFail'])
+    for fold in range(5):
+        # Every round of the search fits on all three classes, in proportion
+        train = search_state.subset(fold, 18)
+        assert len(train) == 18 and np.bincount(dataframe['PassFail'][train]).tolist() == [6, 6, 6]
+        assert search_state.subset(fold, None).tolist() == search_state.folds[fold][0].tolist()
+
+
+def test_random_search():
+    model = scikit_learn_test.fit_model(training_dataframe(), search='random', n_iter=2, n_jobs=2,
+                                        param_dict=PARAM_DICT)
+    assert model.max_depth in (2, 5)
+
+
+def test_extract_training_data(tmpdir, monkeypatch):
+    monkeypatch.setattr(extract_features, 'screen_genus', lambda screen_args, *_: (screen_args[0], 'Listeria'))
+    monkeypatch.setattr(extract_features, 'sample_orfs', lambda fasta, *_: (3, 0, 1, 1, 1))
+    # Every folder holds samples with the same names
+    folders = [str(tmpdir.join(name)) for name in ('fail', 'pass', 'ref', 'test')]
+    for folder in folders:
+        shutil.copytree('tests/test_fastas', folder)
+    fail_folder, pass_folder, ref_folder, test_folder = folders
+    labelled_folders = [(fail_folder, 0), (pass_folder, 1), (ref_folder, 2), (test_folder, None)]
+    dataframe = scikit_learn_test.extract_training_data(labelled_folders, refseq_database='refseq.msh', num_threads=4)
+    assert dataframe['PassFail'].tolist() == [0] * 9 + [1] * 9 + [2] * 9
+    combined = scikit_learn_test.combine_csv_files(pass_folder=pass_folder, fail_folder=fail_folder,
+                                                   ref_folder=ref_folder)
+    pd.testing.assert_frame_equal(dataframe, combined, check_dtype=False)
+    # Existing reports are read rather than extracted again
+    monkeypatch.setattr(extract_features, 'sample_orfs', None)
+    reused = scikit_learn_test.extract_training_data(labelled_folders, refseq_database='refseq.msh', reuse_reports=True)
+    pd.testing.assert_frame_equal(reused, dataframe, check_dtype=False)
+    # A folder given twice would have its samples labelled twice
+    with pytest.raises(ValueError):
+        scikit_learn_test.extract_training_data([(fail_folder, 0), (pass_folder, 1), (fail_folder + os.sep, None)],
+                                                refseq_database='refseq.msh')